@@ -52,6 +52,11 @@ restricted_users = ''
 # List of users that will be left password-less
 passwdless_users = ''
 
+# JSON install profile for unattended installs without any prompts (same as '--profile=PATH')
+# It replaces the partitioning & mounting menus and the password prompts; see 'Unattended installs' in README.md
+# def. ''
+install_profile = ''
+
 # Whether to ask root password when using sudo as a non-restricted user
 # def. 'True'
 sudo_ask_pass = False
@@ -75,11 +80,64 @@ optimize_compilation = False
 # def. 'False'
 optimize_cached_pkgs = False
 
+# Maximum amount of AUR packages built at the same time
+# The CPU threads are shared among the concurrent builds (MAKEFLAGS)
+# 0 = automatic (half the CPU threads, 2-4 builds)
+# def. '0'
+aur_build_jobs = 0
+
+# Compression of built AUR packages
+# zst = fast to compress & very fast to decompress
+# xz  = slightly smaller packages, much slower
+# Also: gz, bz2, lz4 & '' (uncompressed)
+# NOTE: Try them out on your cached packages with '--bench-compression'
+# def. 'zst'
+aur_pkg_compression = 'zst'
+
+# Compression level of built AUR packages (e.g. 1-19 for zst, 1-9 for xz)
+# 0 = the format's default
+# def. '0'
+aur_compress_level = 0
+
+# CPU threads used to compress built AUR packages (only zst, xz & gz compress in parallel)
+# 0 = all CPU threads
+# def. '0'
+aur_compress_threads = 0
+
 # Should parts of built packages be cached so the process will go much faster next time?
-# NOTE: Large amounts (configurable, by default up to 24 GB) of storage may be used over time
+# The cache is kept on the /pkgcache drive (separately for each CPU model) when present, otherwise in the first user's home
+# NOTE: Large amounts (see ccache_max_size) of storage may be used over time
 # def. 'False'
 use_ccache = True
 
+# Maximum size of the compiler cache; the least recently used parts are removed to stay under it
+# def. '24G'
+ccache_max_size = '24G'
+
+# Should package installs be planned & committed as a few large pacman transactions?
+# This avoids repeating dependency resolution, downloads & post-transaction hooks for every install step
+# NOTE: Failed installs are reported once the planned packages are installed instead of in the step's status
+# def. 'True'
+plan_pkg_installs = True
+
+# Should slow pacman hooks (e.g. initramfs generation & icon cache updates) run only once at the end of the install?
+# Otherwise they're run again after every package transaction
+# def. 'True'
+defer_pacman_hooks = True
+
+# Should commands be run through a few persistent shells instead of starting a new shell for each one?
+# def. 'True'
+use_worker_shells = True
+
+# Should independent setup steps (e.g. generating locales & creating users) be run at the same time?
+# NOTE: The messages of each step are shown only once it has finished
+# def. 'True'
+parallel_setup = True
+
+# Maximum amount of setup steps run at the same time
+# def. '4'
+parallel_jobs = 4
+
 # Should the testing repositories be enabled?
 # This is useful for running the most bleeding edge software at the cost of system stability
 # def. 'False'
@@ -8,7 +8,7 @@
 #
 
 # File IO, argv, run, sleep, ...
-import os, sys, subprocess, time, re, random
+import os, sys, subprocess, time, re, random, shlex, shutil, json, threading, concurrent.futures, atexit, bisect, glob, io, mmap, struct, tarfile, urllib.request, urllib.parse
 
 # Import configured user variables
 try:
@@ -53,18 +53,16 @@ def custom_setup():
 	# ------------ Wi-Fi setup
 
 	if vm_env == '':
-		wifi_setup = Cmd.suppress('lspci | egrep -i "wireless|wlan|wifi"') == 0
-		if wifi_setup:
+		if hw.wifi_present:
 			write_msg("Setting up Wi-Fi hardware...", 1)
 			errors = Pkg.install(f'crda {kernel}-headers')
 			errors += IO.uncomment_ln('/etc/conf.d/wireless-regdom', f'WIRELESS_REGDOM="{LC_ALL[3:5]}"') # e.g. "FI"
 
-			bcm_install = Cmd.suppress('lspci | egrep -i "bcm|broadcom"') == 0
-			if bcm_install:
+			if hw.has_pci('14e4'): # Broadcom
 				errors += Pkg.install('broadcom-wl-dkms')
 
 				# BCM4352
-				if Cmd.suppress('lspci | grep -i bcm4352') == 0:
+				if hw.has_pci('14e4', '43b1'):
 					errors += Pkg.aur_install('bcm20702a1-firmware')
 
 			write_status(errors, 0, 4)
@@ -73,18 +71,19 @@ def custom_setup():
 
 	if multibooting:
 		write_msg("Configuring custom 'Tela' GRUB theme...", 1)
-		errors = IO.replace_ln(grub_conf, '#GRUB_THEME=', 'GRUB_THEME="/usr/share/grub/themes/Tela/theme.txt"')
+		errors = GrubConfig.load().set('GRUB_THEME', '/usr/share/grub/themes/Tela/theme.txt', True)
 		errors += Cmd.exec('cd /tmp; git clone --depth 1 https://github.com/vinceliuice/grub2-themes.git &>>/setup.log && sed "/GRUB_THEME/d" -i grub2-themes/install.sh && grub2-themes/install.sh -t &>>/setup.log')
 		write_status(errors)
 
 	# ------------ TLP tweaks (TODO Move changes to laptop repo)
 
 	if bat_present:
-		file = '/etc/default/tlp'
-		IO.replace_ln(file, 'TLP_DEFAULT_MODE=', 'TLP_DEFAULT_MODE=BAT')
-		IO.replace_ln(file, '#CPU_SCALING_GOVERNOR_ON_AC=', 'CPU_SCALING_GOVERNOR_ON_AC=performance')
-		IO.uncomment_ln(file, 'CPU_SCALING_GOVERNOR_ON_BAT=') # powersave
-		IO.replace_ln(file, 'RESTORE_DEVICE_STATE_ON_STARTUP=', 'RESTORE_DEVICE_STATE_ON_STARTUP=1')
+		conf = ConfigFile('/etc/default/tlp')
+		conf.replace_ln('TLP_DEFAULT_MODE=', 'TLP_DEFAULT_MODE=BAT')
+		conf.replace_ln('#CPU_SCALING_GOVERNOR_ON_AC=', 'CPU_SCALING_GOVERNOR_ON_AC=performance')
+		conf.uncomment_ln('CPU_SCALING_GOVERNOR_ON_BAT=') # powersave
+		conf.replace_ln('RESTORE_DEVICE_STATE_ON_STARTUP=', 'RESTORE_DEVICE_STATE_ON_STARTUP=1')
+		conf.commit()
 
 
 
@@ -135,6 +134,12 @@ use_qt_apps = False       # Get Qt versions of apps
 unres_users = []          # List of users with admin rights
 aur_cache = ''            # Path of cached AUR packages e.g. '/pkgcache/pkgcache/aur/intel_6-60-4'
 pkgcache_enabled = os.path.exists('/pkgcache')
+hw = None                 # Probed hardware details; see HardwareInfo
+prebuild = False          # Only pre-build the AUR packages of the install ('--prebuild-aur')? See prebuild_aur()
+offline = False           # Install only from the package cache without internet ('-N')? See Pkg.offline_dbs()
+plan_only = False         # Only show the resolved package set of the install ('--plan')? See DryRun
+install_started = time.time() # Start of the base install, kept when entering the chroot; see DryRun.record()
+profile = None            # Unattended install profile ('--profile=PATH' / install_profile)? See Profile
 
 # Other vars
 lsblk_cmd = "lsblk | grep -v '^loop' | grep -v '^sr0'"
@@ -143,8 +148,70 @@ apps_path = '/usr/share/applications'
 cflags = '-march=native -O2 -pipe -fstack-protector-strong -fno-plt'
 mounts = '' # Current mounts e.g. '/efi:/dev/sda1,root:/dev/sda2'
 grub_conf = '/etc/default/grub'
-outdated_pkgs = ''
+grub_config = None # Changes to grub_conf written before generating the GRUB config; see GrubConfig
+outdated_pkgs = [] # Installed packages with updates available e.g. ['pacman', 'archlinux-keyring']
 menu_visit_counter = 0
+root_fs_types = [ 'ext4', 'XFS', 'F2FS', 'ReiserFS' ] # Filesystem types the root partition can be formatted with
+par_fs_types = root_fs_types + [ 'FAT32', 'exFAT', 'NTFS', 'swap' ] # Filesystem types other partitions can be formatted with
+par_mount_points = { 'R': '/', 'E': '/efi', 'B': '/boot', 'H': '/home', 'C': '/pkgcache', 'S': 'swap' } # Mount points of the mounting menu options
+pkg_plan = None # Pending package operations while planning installs; see Pkg.begin_plan()
+shell_workers = {} # Idle persistent shells per user e.g. { '': [<Shell>], 'aurhelper': [<Shell>] }
+shell_builtins = ('cd', 'shopt', 'export', 'type', 'source', '.', 'exit', 'set', 'unset', 'alias', 'umask', 'ulimit', 'exec', 'eval', 'read', 'wait', 'command', 'hash', 'echo', 'printf', 'test', '[', '[[', 'true', 'false', 'times', 'trap', 'let', 'declare', 'builtin', 'pushd', 'popd', 'kill', 'time', 'if', 'for', 'while', 'until', 'case', 'function', 'select', '{', '!') # Need a shell to run
+record_stats = True # Record resource usage of executed commands; see Stats
+slowest_cmds_shown = 10 # Amount of commands in the slowest steps summary
+stats_lock = threading.Lock() # Held while writing to the stats file
+stats_file = None # Stats file opened for appending, kept open until Stats.close()
+plan_lock = threading.RLock() # Held while changing or committing the install plan
+plan_committer = None # Thread ident of the thread committing the install plan
+plan_done = threading.Condition(plan_lock) # Notified when a commit of the install plan is done
+bootloader_failed = False # The GRUB install failed during the setup phases; see bootloader_fail_prompt()
+output_lock = threading.RLock() # Held while printing to the terminal
+thread_output = threading.local() # Output buffered by a running setup phase; see run_phases()
+log_lock = threading.RLock() # Held while buffering or writing log records
+log_buffer = [] # Log records waiting to be written as (time, level, text); see Log
+log_files = {} # Open log files e.g. { '/tmp/setup.log': <file>, '/tmp/setup.log.jsonl': <file> }
+log_flushed = 0.0 # Time of the last log flush
+log_flush_interval = 1.0 # Max seconds log records are kept in the buffer
+named_locks = {} # Locks of shared resources e.g. { 'pacman': <RLock>, '/etc/sudoers': <RLock> }
+state_fn = 'setup-state.json' # Details detected on the live environment in /root of the new system; see save_state()
+pci_ids_path = '/usr/share/hwdata/pci.ids'
+pci_vendors = { '10de': 'NVIDIA Corporation', '1002': 'Advanced Micro Devices, Inc. [AMD/ATI]', '8086': 'Intel Corporation', '15ad': 'VMware', '80ee': 'InnoTek Systemberatung GmbH', '14e4': 'Broadcom Inc. and subsidiaries' } # Fallback PCI vendor names
+aur_rpc_url = 'https://aur.archlinux.org/rpc/' # AUR RPC interface endpoint
+aur_index = None # Index of cached AUR packages; see AurCache
+aur_rpc_batch = 100 # Max packages looked up per AUR RPC request
+aur_build_dir = '/home/aurhelper/build' # Build directories of AUR package bases; see AurBuild
+aur_repo = 'aurcache' # Name of the pacman repository of cached AUR packages; see AurCache.register()
+aur_pkgs_fn = 'aur-pkgs.txt' # List of requested AUR packages in aur_cache; see AurCache.record()
+config_prefix_len = 3 # Length of line prefixes indexed by ConfigFile
+base_pkgs = 'openresolv base linux-firmware device-mapper logrotate which less usbutils inetutils diffutils man-db man-pages python' # Installed with pacstrap
+prefetch_dir = '/tmp/pkgstage' # Staging cache of packages downloaded in the background; see Prefetch
+prefetch_chunk = 40 # Packages downloaded per 'pacman -Sw' in the background
+prefetch_thread = None # Thread downloading packages in the background; see Prefetch.start()
+prefetch_de_pkgs = { 'gnome': 'gdm gnome-shell gnome-control-center nautilus gnome-terminal', 'mate': 'mate mate-extra', 'kde': 'sddm plasma', 'xfce': 'xfce4 xfce4-goodies', 'dde': 'deepin-session-ui deepin-terminal', 'cinnamon': 'cinnamon', 'budgie': 'budgie-desktop gnome-control-center', 'lxde': 'lxde', 'lxqt': 'sddm lxqt-session lxqt-panel pcmanfm-qt qterminal', 'i3': 'i3-gaps rofi dunst picom' } # Main packages & groups of each DE
+mirror_status_url = 'https://archlinux.org/mirrors/status/json/' # Mirror status used to choose ranking candidates
+mirror_probe_path = 'core/os/x86_64/core.db' # Small file downloaded from each mirror when ranking them
+mirror_probe_timeout = 5 # Max seconds to wait for a mirror
+mirror_candidates = 25 # Amount of mirrors probed
+mirror_count = 10 # Amount of fastest mirrors written to the mirrorlist
+mirror_rank_max_age = 6 * 3600 # Max seconds a saved mirror ranking is reused
+pkgdb_dir = '/tmp/setup-pkgdb' # Memory-mapped package database indexes; see PkgDb
+pkg_db = None # Shared package database reader; see PkgDb.get()
+pacman_conf = '/etc/pacman.conf' # pacman config the repositories are set up in; a temporary copy for '--plan', see DryRun.isolate()
+pacman_db_path = '/var/lib/pacman' # pacman database directory e.g. '/tmp/setup-plan/db' for '--plan'
+plan_dir = '/tmp/setup-plan' # Temporary pacman config & databases of '--plan', so the live system isn't changed
+dry_run = None # Packages collected by install steps while dry running them; see DryRun.run()
+plan_history_fn = 'install-history.jsonl' # Installed sizes & durations of earlier installs in the package cache; see DryRun.record()
+plan_history_len = 10 # Amount of recent installs used for estimates
+pkg_compressors = { 'zst': ('zstd -c -z -q{threads}{level} -', ' -T{}', 'zstd -d -c -q'), 'xz': ('xz -c -z{threads}{level} -', ' --threads={}', 'xz -d -c'), 'gz': ('pigz -c -f -n{threads}{level}', ' -p {}', 'gzip -d -c'), 'bz2': ('bzip2 -c -f{level}', '', 'bzip2 -d -c'), 'lz4': ('lz4 -q{level}', '', 'lz4 -d -c -q'), '': ('cat', '', 'cat') } # Compressor, thread argument & decompressor of package formats; see PkgCompression
+compress_bench_count = 5 # Amount of the largest cached packages used by '--bench-compression'
+ccache_dir = '/pkgcache/ccache' # Compiler caches of AUR builds per CPU & compiler flags; see Ccache
+deferred_hooks = ('90-mkinitcpio-install', 'gtk-update-icon-cache', 'fontconfig', 'update-desktop-database', 'man-db', '30-systemd-daemon-reload', 'update-mime-database', 'glib-compile-schemas', 'gio-querymodules', 'texinfo-install') # Post-transaction hooks run once at the end; see PacmanHooks
+hook_dir = '/usr/share/libalpm/hooks' # Hooks installed by packages
+hook_override_dir = '/etc/pacman.d/hooks' # Hooks overriding the ones with the same name in hook_dir
+hook_state_dir = '/var/lib/setup-hooks' # Targets recorded for deferred hooks
+hook_triggers = { '90-mkinitcpio-install': (True, 'Install Upgrade', [ 'usr/lib/modules/*/vmlinuz', 'usr/lib/initcpio/*', 'usr/lib/firmware/*', 'usr/src/*/dkms.conf' ]), 'gtk-update-icon-cache': (True, 'Install Upgrade Remove', [ 'usr/share/icons/*/' ]), 'fontconfig': (False, 'Install Upgrade Remove', [ 'usr/share/fonts/*' ]), 'update-desktop-database': (False, 'Install Upgrade Remove', [ 'usr/share/applications/*.desktop' ]), 'man-db': (False, 'Install Upgrade Remove', [ 'usr/share/man/*' ]), '30-systemd-daemon-reload': (False, 'Install Upgrade Remove', [ 'usr/lib/systemd/system/*' ]), 'update-mime-database': (False, 'Install Upgrade Remove', [ 'usr/share/mime/packages/*.xml' ]), 'glib-compile-schemas': (False, 'Install Upgrade Remove', [ 'usr/share/glib-2.0/schemas/*.gschema.xml', 'usr/share/glib-2.0/schemas/*.gschema.override' ]), 'gio-querymodules': (False, 'Install Upgrade Remove', [ 'usr/lib/gio/modules/*.so' ]), 'texinfo-install': (True, 'Install Upgrade', [ 'usr/share/info/*' ]) } # NeedsTargets, operations & path triggers of deferred hooks that aren't installed yet; see PacmanHooks.known()
+hooks_deferred = None # Deferred hooks overridden while deferring e.g. { 'man-db': True }, False when overridden before the hook was installed; see PacmanHooks.defer()
+deferrable_cmds = ('systemctl enable ', 'systemctl disable ', 'systemctl mask ', 'gpasswd -a ', 'usermod -aG ') # Steps which may wait for planned packages
 
 
 
@@ -194,8 +261,22 @@ def write(text):
 	if '\\§' in text: text = text.replace('\\§', '§') # '\§' => '§'
 	elif '§' in text: text = color_str(text)
 
-	sys.stdout.write(text)
-	sys.stdout.flush()
+	buffer = getattr(thread_output, 'buffer', None)
+	if buffer is not None: # Running in a setup phase => print all at once after it; see run_phases()
+		buffer.append(text)
+		return
+	with output_lock:
+		sys.stdout.write(text)
+		sys.stdout.flush()
+
+# Prints all buffered output of the current setup phase at once
+def flush_output():
+	buffer = getattr(thread_output, 'buffer', None)
+	if buffer is None or len(buffer) == 0: return
+	with output_lock:
+		sys.stdout.write(''.join(buffer))
+		sys.stdout.flush()
+	buffer.clear()
 
 # Writes a line of text to stdout with optional coloring; see color_str()
 def write_ln(text='', new_line_count=1):
@@ -242,13 +323,94 @@ def write_status(ret_val=0, expected_val=0, error_status=3):
 		status_msg = status_mgs.get(error_status)
 		write_ln(f'\r§{color}>> [ {status_msg} ]')
 
+# Returns: human readable size e.g. '1.2G' / '-' for unknown sizes
+def size_str(num_bytes):
+	if num_bytes is None: return '-'
+	size = float(num_bytes)
+	for unit in ('B', 'K', 'M', 'G'):
+		if size < 1024 or unit == 'G': break
+		size /= 1024
+	return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+
+# Returns: lock shared by everything using the same resource e.g. 'pacman' or '/etc/sudoers'
+def named_lock(name):
+	return named_locks.setdefault(name, threading.RLock())
+
 # Logging
 
-# Log a new line to /(tmp/)setup.log
+# Log a new line to /(tmp/)setup.log; see Log
 # Returns: 0 = Success, 1 = Error
 def log(text):
-	path = '' if in_chroot else '/tmp'
-	return IO.write_ln(f'{path}/setup.log', text)
+	return Log.write(text)
+
+# Buffered writer of the setup log & it's JSON Lines twin with timestamped & leveled records e.g.
+#   {"time":1569868467.512,"level":"WARN","msg":"[setup.py:locale_setup()] WARN: Couldn't find locale 'xx_XX'"}
+# Records are written at least every log_flush_interval seconds, before commands write to the log & at exit
+class Log:
+	# Returns: path of the setup log e.g. '/tmp/setup.log' or '/setup.log' in chroot
+	@staticmethod
+	def path():
+		return ('' if in_chroot else '/tmp') + '/setup.log'
+
+	# Buffer a log record; the level is inferred from e.g. 'WARN:' in the text when not defined
+	# Returns: 0 = Success, 1 = Error
+	@staticmethod
+	def write(text, level=''):
+		if len(level) == 0:
+			level = 'ERROR' if 'ERROR:' in text else ('WARN' if 'WARN:' in text else 'INFO')
+		with log_lock:
+			log_buffer.append((time.time(), level, text))
+			if time.time() - log_flushed >= log_flush_interval:
+				return Log.flush()
+		return 0
+
+	# Write all buffered records to the log files
+	# Returns: 0 = Success, 1 = Error
+	@staticmethod
+	def flush():
+		global log_flushed
+		with log_lock:
+			log_flushed = time.time()
+			if len(log_buffer) == 0: return 0
+			records = log_buffer[:]
+			log_buffer.clear()
+			try:
+				text_log = Log.file(Log.path())
+				text_log.write(''.join(f'{text}\n' for _, _, text in records))
+				text_log.flush()
+				json_log = Log.file(Log.path() + '.jsonl')
+				json_log.write(''.join(json.dumps({ 'time': round(started, 3), 'level': level, 'msg': text.strip('\n') }, separators=(',', ':')) + '\n' for started, level, text in records))
+				json_log.flush()
+			except OSError:
+				return 1
+		return 0
+
+	# Returns: log file opened for appending, kept open until Log.close()
+	@staticmethod
+	def file(f_path):
+		if f_path not in log_files:
+			log_files[f_path] = open(f_path, 'a', encoding='utf-8', errors='replace')
+		return log_files[f_path]
+
+	# Write all buffered records & close the log files
+	@staticmethod
+	def close():
+		with log_lock:
+			Log.flush()
+			for f in log_files.values():
+				try: f.close()
+				except OSError: pass
+			log_files.clear()
+
+	# Remove the log files & everything still buffered e.g. a possible old log when debugging
+	@staticmethod
+	def clear():
+		with log_lock:
+			log_buffer.clear()
+			Log.close()
+			for f_path in (Log.path(), Log.path() + '.jsonl'):
+				try: os.remove(f_path)
+				except OSError: pass
 
 # File I/O class to read from & write to files
 
@@ -268,6 +430,7 @@ class IO:
 	# Returns: 0 = Success, 1 = Error
 	@staticmethod
 	def write(f_path, text, append=False):
+		if dry_run is not None: return 0
 		try:
 			mode = 'a' if append else 'w'
 			with open(f_path, f'{mode}+') as f:
@@ -288,70 +451,671 @@ class IO:
 	def write_ln(f_path, text='', append=True):
 		return IO.write(f_path, text + '\n', append)
 
-	# Replace a line with another in a file
+	# Replace a line with another in a file; see ConfigFile for many edits to the same file
 	# Returns: 0 = Replaced, 1 = Line not found, 2 = Error
 	@staticmethod
 	def replace_ln(file_path, search_ln, replace_ln, only_first_match=True):
-		try:
-			found = False
-			file_lines = ''
-			with open(file_path) as lines:
-				for line in lines:
-					line = line.rstrip() # e.g. 'line\n' => 'line'
-					if not only_first_match or (only_first_match and not found):
-						if line.startswith(search_ln):
-							found = True
-							line = replace_ln
-					file_lines += f'{line}\n'
-			if found:
-				with open(file_path, 'w') as f:
-					f.write(file_lines.rstrip())
-				return 0
-			else:
-				return 1
-		except:
-			return 2
+		conf = ConfigFile(file_path)
+		ret_val = conf.replace_ln(search_ln, replace_ln, only_first_match)
+		return conf.commit() if ret_val == 0 else ret_val
 
 	# Uncomments a line in a file
 	# Returns: 0 = Uncommented, 1 = Line not found, 2 = Error
 	# TODO Return uncommented line & use for future purposes
 	@staticmethod
 	def uncomment_ln(file_path, search_ln, comment_prefix='#'):
+		conf = ConfigFile(file_path)
+		ret_val = conf.uncomment_ln(search_ln, comment_prefix)
+		return conf.commit() if ret_val == 0 else ret_val
+
+	# Returns: line number of found line, -1 when not found
+	@staticmethod
+	def get_ln_number(file_path, search_ln):
+		return ConfigFile(file_path).get_ln_number(search_ln)
+
+# Transaction of line edits to a file: read once, edited in memory & written once with an atomic rename e.g.
+#   conf = ConfigFile('/etc/makepkg.conf')
+#   conf.replace_ln('#MAKEFLAGS="', 'MAKEFLAGS="-j$(nproc)"') # => 0
+#   conf.uncomment_ln('BUILDDIR=')                           # => 0
+#   errors = conf.commit()
+# Lines are indexed by their first few characters to find them without scanning the whole file
+class ConfigFile:
+	def __init__(self, file_path):
+		Pkg.need_file(file_path)
+		self.path = file_path
+		self.lines = None   # Lines without trailing whitespace / None if the file couldn't be read
+		self.index = None   # Line indexes by prefix e.g. { 'CFL': [39], '#MA': [43] }; rebuilt on demand
+		self.changed = False
 		try:
-			found = False
-			file_lines = ''
 			with open(file_path) as lines:
-				for line in lines:
-					line = line.rstrip() # e.g. 'line\n' => 'line'
-					if not found and line.startswith(comment_prefix + search_ln):
-						found = True
-						line = line[len(comment_prefix):]
-					file_lines += f'{line}\n'
-			if found:
-				with open(file_path, 'w') as f:
-					f.write(file_lines.rstrip())
-				return 0
-			else:
-				return 1
+				self.lines = [ line.rstrip() for line in lines ] # e.g. 'line\n' => 'line'
+		except:
+			pass
+
+	# Returns: index of the first line starting with 'search_ln' from line index 'start' onwards / -1 when not found
+	def find(self, search_ln, start=0):
+		if len(search_ln) < config_prefix_len: # Too short for the index
+			for i in range(start, len(self.lines)):
+				if self.lines[i].startswith(search_ln): return i
+			return -1
+		if self.index is None:
+			self.index = {}
+			for i, line in enumerate(self.lines):
+				self.index.setdefault(line[:config_prefix_len], []).append(i)
+		for i in self.index.get(search_ln[:config_prefix_len], []):
+			if i >= start and self.lines[i].startswith(search_ln): return i
+		return -1
+
+	# Change the line at index 'i' keeping the index up-to-date
+	def set_ln(self, i, line):
+		if self.index is not None:
+			self.index[self.lines[i][:config_prefix_len]].remove(i)
+			bisect.insort(self.index.setdefault(line[:config_prefix_len], []), i)
+		self.lines[i] = line
+		self.changed = True
+
+	# Replace a line starting with 'search_ln'
+	# Returns: 0 = Replaced, 1 = Line not found, 2 = Error
+	def replace_ln(self, search_ln, replace_ln, only_first_match=True):
+		if self.lines is None: return 2
+		i = self.find(search_ln)
+		if i == -1: return 1
+		while i != -1:
+			self.set_ln(i, replace_ln)
+			i = -1 if only_first_match else self.find(search_ln, i + 1)
+		return 0
+
+	# Uncomment the first line starting with 'search_ln' after the comment prefix
+	# Returns: 0 = Uncommented, 1 = Line not found, 2 = Error
+	def uncomment_ln(self, search_ln, comment_prefix='#'):
+		if self.lines is None: return 2
+		i = self.find(comment_prefix + search_ln)
+		if i == -1: return 1
+		self.set_ln(i, self.lines[i][len(comment_prefix):])
+		return 0
+
+	# Insert a new line after (or before) the first line starting with 'search_ln'
+	# Returns: 0 = Inserted, 1 = Line not found, 2 = Error
+	def insert_ln(self, search_ln, new_ln, after=True):
+		if self.lines is None: return 2
+		i = self.find(search_ln)
+		if i == -1: return 1
+		self.lines.insert(i + 1 if after else i, new_ln)
+		self.index = None # Following line indexes changed
+		self.changed = True
+		return 0
+
+	# Append lines to the end of the file
+	# Returns: 0 = Appended, 2 = Error
+	def append_ln(self, *new_lns):
+		if self.lines is None: return 2
+		self.lines.extend(new_lns)
+		self.index = None
+		self.changed = True
+		return 0
+
+	# Remove 'count' lines starting from the first line starting with 'search_ln'
+	# Returns: 0 = Removed, 1 = Line not found, 2 = Error
+	def remove_ln(self, search_ln, count=1):
+		if self.lines is None: return 2
+		i = self.find(search_ln)
+		if i == -1: return 1
+		del self.lines[i:i + count]
+		self.index = None
+		self.changed = True
+		return 0
+
+	# Returns: line number of the first line starting with 'search_ln', -1 when not found, -2 on error
+	def get_ln_number(self, search_ln):
+		if self.lines is None: return -2
+		i = self.find(search_ln)
+		return i + 1 if i != -1 else -1
+
+	# Write all edits to the file at once by replacing it with a temporary copy
+	# Returns: 0 = Written (or nothing to write), 2 = Error
+	def commit(self):
+		if self.lines is None: return 2
+		if dry_run is not None: return 0
+		if not self.changed: return 0
+		f_path = os.path.realpath(self.path) # Keep e.g. symlinked configs as symlinks
+		tmp_path = f'{f_path}.setup-tmp'
+		try:
+			stat = os.stat(f_path)
+			with open(tmp_path, 'w') as f:
+				f.write('\n'.join(self.lines).rstrip() + '\n')
+			os.chmod(tmp_path, stat.st_mode)
+			os.chown(tmp_path, stat.st_uid, stat.st_gid)
+			os.replace(tmp_path, f_path)
 		except:
+			try: os.remove(tmp_path)
+			except OSError: pass
 			return 2
+		self.changed = False
+		return 0
+
+# Model of /etc/default/grub shared by the whole install: GRUB_* keys & kernel parameters as ordered sets e.g.
+#   grub = GrubConfig.load()
+#   grub.set('GRUB_TIMEOUT', '0')
+#   grub.add_params('apparmor=1 security=apparmor') # => GRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet apparmor=1 security=apparmor"
+#   update_grub() # Written once & followed by a single 'grub-mkconfig'
+# The edits are recorded & replayed onto the file as it is when committing, so changes others made to it
+# in the meantime (e.g. the grub2-themes installer or copied config repos) aren't overwritten
+class GrubConfig(ConfigFile):
+	def __init__(self):
+		super().__init__(grub_conf)
+		self.ops = [] # Recorded edits e.g. [('set', ('GRUB_TIMEOUT', '0', False)), ('add_params', ('quiet', True))]
+
+	# Returns: the shared model, (re)read when the file couldn't be read before e.g. before GRUB was installed
+	@staticmethod
+	def load():
+		global grub_config
+		with named_lock(grub_conf):
+			if grub_config is None or grub_config.lines is None:
+				grub_config = GrubConfig()
+			return grub_config
+
+	# Returns: value of a key without quotes e.g. 'loglevel=3 quiet' for 'GRUB_CMDLINE_LINUX_DEFAULT' / None when not set
+	def get(self, key):
+		if self.lines is None: return None
+		i = self.find(f'{key}=')
+		return self.lines[i].split('=', 1)[1].strip('"\'') if i != -1 else None
+
+	# Set a key replacing it's (commented) line or appending it e.g. 'GRUB_THEME="/usr/share/grub/themes/Tela/theme.txt"'
+	# Returns: 0 = Set, 2 = Error
+	def set(self, key, value, quoted=False):
+		with named_lock(grub_conf):
+			self.ops.append(('set', (key, value, quoted)))
+			return self.put(key, value, quoted)
+
+	# Uncomment a line like ConfigFile.uncomment_ln()
+	# Returns: 0 = Uncommented, 1 = Line not found, 2 = Error
+	def uncomment_ln(self, search_ln, comment_prefix='#'):
+		with named_lock(grub_conf):
+			self.ops.append(('uncomment_ln', (search_ln, comment_prefix)))
+			return super().uncomment_ln(search_ln, comment_prefix)
+
+	# Set a key without recording it; see GrubConfig.set()
+	def put(self, key, value, quoted=False):
+		line = f'{key}="{value}"' if quoted else f'{key}={value}'
+		with named_lock(grub_conf):
+			if self.lines is None: return 2
+			for search_ln in (f'{key}=', f'#{key}='):
+				if self.replace_ln(search_ln, line) == 0: return 0
+			return self.append_ln(line)
+
+	# Returns: kernel parameters of a key by their name e.g. { 'loglevel': 'loglevel=3', 'quiet': 'quiet' }
+	def params(self, key='GRUB_CMDLINE_LINUX_DEFAULT'):
+		return { param.split('=', 1)[0]: param for param in (self.get(key) or '').split() }
+
+	# Add kernel parameters to 'GRUB_CMDLINE_LINUX_DEFAULT' (& 'GRUB_CMDLINE_LINUX') replacing earlier values of the same ones
+	# Returns: 0 = Added, 2 = Error
+	def add_params(self, parameters, only_default=True):
+		errors = 0
+		with named_lock(grub_conf):
+			self.ops.append(('add_params', (parameters, only_default)))
+			for key in ['GRUB_CMDLINE_LINUX_DEFAULT'] + ([] if only_default else ['GRUB_CMDLINE_LINUX']):
+				params = self.params(key)
+				for param in parameters.split():
+					params[param.split('=', 1)[0]] = param # e.g. 'loglevel=3' => 'loglevel=4'
+				errors = max(errors, self.put(key, ' '.join(params.values()), True))
+		return errors
+
+	# Replay the recorded edits onto a fresh read of the file & write it
+	# Returns: 0 = Written (or nothing to write), 2 = Error
+	def commit(self):
+		with named_lock(grub_conf):
+			if len(self.ops) == 0: return 0
+			current = GrubConfig()
+			for name, args in self.ops:
+				getattr(current, name)(*args)
+			ret_val = ConfigFile.commit(current)
+			if ret_val == 0:
+				self.lines, self.index, self.ops = (current.lines, None, [])
+			return ret_val
+
+# Batch of repository changes to /etc/pacman.conf with a single package database refresh once committed e.g.
+#   repos = Repos()
+#   repos.enable('multilib')                     # => 0
+#   repos.add('aurcache', 'Server = file:///...') # => 0
+#   errors = repos.commit()
+class Repos:
+	def __init__(self):
+		self.conf = ConfigFile(pacman_conf)
+		self.changed = False # Any repositories changed => refresh on commit
+
+	# Uncomment a repository section e.g. '#[multilib]' & it's 'Include = ...' line
+	# Returns: 0 = Enabled (or already enabled), 1 = Not found, 2 = Error
+	def enable(self, repo):
+		if self.conf.lines is None: return 2
+		if self.conf.find(f'[{repo}]') != -1: return 0
+		i = self.conf.find(f'#[{repo}]')
+		if i == -1: return 1
+		self.conf.set_ln(i, self.conf.lines[i][1:])
+		if i + 1 < len(self.conf.lines) and self.conf.lines[i + 1].startswith('#Include'):
+			self.conf.set_ln(i + 1, self.conf.lines[i + 1][1:])
+		self.changed = True
+		return 0
+
+	# Add a new repository section to the end e.g. add('aurcache', 'SigLevel = Optional TrustAll', 'Server = file:///...')
+	# Returns: 0 = Added (or already present), 2 = Error
+	def add(self, repo, *lines):
+		if self.conf.lines is None: return 2
+		if self.conf.find(f'[{repo}]') != -1: return 0
+		self.changed = True
+		return self.conf.append_ln('', f'[{repo}]', *lines)
+
+	# Write all changes & refresh the package databases once if repositories changed
+	# Returns: 0 = Success, 2 = Couldn't write pacman.conf / pacman exit code
+	def commit(self):
+		ret_val = self.conf.commit()
+		if ret_val == 0 and self.changed:
+			ret_val = Pkg.refresh_dbs(False, False)
+			self.changed = False
+		return ret_val
 
-	# Returns: line number of found line, -1 when not found
+# Package metadata read straight from pacman's sync & local databases without running pacman e.g.
+#   db = PkgDb.get()
+#   db.info('grub')        # => { 'name': 'grub', 'repo': 'core', 'version': '2:2.04-8', 'csize': 6860000, 'isize': 31000000, 'groups': [], 'provides': [...], 'depends': [...] }
+#   db.group('xfce4')      # => ['exo', 'garcon', ...]
+#   db.providers('sh')     # => ['bash']
+#   db.installed('grub')   # => '2:2.04-7' / None
+#   db.outdated()          # => ['grub', ...]
+# The databases are indexed into files in pkgdb_dir which are memory-mapped & searched in place;
+# an index is only rebuilt when the databases it was built from change
+class PkgDb:
+	def __init__(self):
+		self.sync = PkgDb.Index('sync', PkgDb.sync_sources(), PkgDb.read_sync)
+		self.local = PkgDb.Index('local', [f'{pacman_db_path}/local'], PkgDb.read_local)
+
+	# Returns: the shared instance with up-to-date indexes
 	@staticmethod
-	def get_ln_number(file_path, search_ln):
+	def get():
+		global pkg_db
+		with named_lock('pkgdb'):
+			if pkg_db is None:
+				pkg_db = PkgDb()
+			else:
+				pkg_db.sync.refresh(PkgDb.sync_sources())
+				pkg_db.local.refresh([f'{pacman_db_path}/local'])
+			return pkg_db
+
+	# Returns: details of a package in the sync databases (first repository wins) / None when not found; see PkgDb
+	def info(self, name):
+		fields = self.sync.find('pkgs', name)
+		if fields is None: return None
+		repo, version, csize, isize, groups, provides, depends = fields
+		return { 'name': name, 'repo': repo, 'version': version, 'csize': int(csize), 'isize': int(isize),
+			'groups': groups.split(), 'provides': provides.split(), 'depends': depends.split() }
+
+	# Returns: members of a package group e.g. ['exo', 'garcon', ...] / [] when not found
+	def group(self, name):
+		fields = self.sync.find('groups', name)
+		return fields[0].split() if fields is not None else []
+
+	# Returns: packages providing a name e.g. ['bash'] for 'sh' (packages called 'sh' not included) / []
+	def providers(self, name):
+		fields = self.sync.find('provides', name)
+		return fields[0].split() if fields is not None else []
+
+	# Returns: installed version of a package e.g. '2:2.04-7' / None when not installed
+	def installed(self, name):
+		fields = self.local.find('pkgs', name)
+		return fields[0] if fields is not None else None
+
+	# Returns: names of all installed packages
+	def installed_names(self):
+		return self.local.keys('pkgs')
+
+	# Returns: installed packages with newer versions in the sync databases e.g. ['pacman', 'archlinux-keyring']
+	def outdated(self):
+		outdated = []
+		for name in self.installed_names():
+			info = self.info(name)
+			if info is not None and PkgDb.vercmp(info['version'], self.installed(name)) > 0:
+				outdated.append(name)
+		return outdated
+
+	# Returns: paths of the sync databases in pacman.conf order e.g. ['/var/lib/pacman/sync/core.db', ...]
+	@staticmethod
+	def sync_sources():
+		repos = []
 		try:
-			line_num = -1
-			with open(file_path) as lines:
-				ln = 1
+			with open(pacman_conf) as f:
+				repos = [ln.strip()[1:-1] for ln in f if ln.startswith('[') and ln.strip() != '[options]']
+		except OSError:
+			pass
+		try: f_names = sorted(os.listdir(f'{pacman_db_path}/sync'))
+		except OSError: f_names = []
+		repos += [f_name[:-3] for f_name in f_names if f_name.endswith('.db') and f_name[:-3] not in repos]
+		return [f'{pacman_db_path}/sync/{repo}.db' for repo in repos if f'{repo}.db' in f_names]
+
+	# Returns: tables of packages in sync databases e.g. { 'pkgs': { 'grub': ['core', '2:2.04-8', ...] }, 'groups': {...}, 'provides': {...} }
+	@staticmethod
+	def read_sync(sources):
+		pkgs, groups, provides = ({}, {}, {})
+		for f_path in sources:
+			repo = os.path.basename(f_path)[:-3] # e.g. 'core'
+			for desc in PkgDb.read_tar(f_path):
+				name = desc.get('NAME', [''])[0]
+				if len(name) == 0 or name in pkgs: continue # Packages in earlier repositories win like in pacman
+				pkg_groups, pkg_provides = (desc.get('GROUPS', []), desc.get('PROVIDES', []))
+				pkgs[name] = [repo, desc.get('VERSION', [''])[0], desc.get('CSIZE', ['0'])[0], desc.get('ISIZE', ['0'])[0],
+					' '.join(pkg_groups), ' '.join(pkg_provides), ' '.join(desc.get('DEPENDS', []))]
+				for group in pkg_groups:
+					groups.setdefault(group, []).append(name)
+				for provide in pkg_provides:
+					provides.setdefault(re.split(r'[<>=]', provide, 1)[0], []).append(name) # e.g. 'sh=5.0' => 'sh'
+		return { 'pkgs': pkgs, 'groups': { key: [' '.join(val)] for key, val in groups.items() }, 'provides': { key: [' '.join(val)] for key, val in provides.items() } }
+
+	# Returns: parsed 'desc' (& 'depends') entries of a sync database e.g. [{ 'NAME': ['grub'], 'VERSION': ['2:2.04-8'], ... }, ...]
+	@staticmethod
+	def read_tar(f_path):
+		entries = {}
+		try:
+			with open(f_path, 'rb') as f:
+				compressed = f.read()
+			if compressed.startswith(b'\x28\xb5\x2f\xfd'): # zstd isn't supported by tarfile
+				compressed = subprocess.run(['zstd', '-dcq'], input=compressed, stdout=subprocess.PIPE, check=True).stdout
+			with tarfile.open(fileobj=io.BytesIO(compressed), mode='r:*') as tar:
+				for member in tar:
+					if not member.isfile() or os.path.basename(member.name) not in ('desc', 'depends'): continue
+					desc = entries.setdefault(os.path.dirname(member.name), {})
+					desc.update(PkgDb.parse_desc(tar.extractfile(member).read().decode('utf-8', 'replace')))
+		except (OSError, tarfile.TarError, subprocess.CalledProcessError) as e:
+			log(f"[setup.py:PkgDb.read_tar()] WARN: Couldn't read package database '{f_path}': {e}")
+		return list(entries.values())
+
+	# Returns: tables of installed packages e.g. { 'pkgs': { 'grub': ['2:2.04-7', '31000000'] } }
+	@staticmethod
+	def read_local(sources):
+		pkgs = {}
+		try: dirs = os.listdir(sources[0])
+		except OSError: dirs = []
+		for pkg_dir in dirs:
+			try:
+				with open(f'{sources[0]}/{pkg_dir}/desc') as f:
+					desc = PkgDb.parse_desc(f.read())
+			except OSError:
+				continue
+			if 'NAME' in desc: pkgs[desc['NAME'][0]] = [desc.get('VERSION', [''])[0], desc.get('SIZE', ['0'])[0]]
+		return { 'pkgs': pkgs }
+
+	# Returns: sections of a package 'desc' file e.g. { 'NAME': ['grub'], 'DEPENDS': ['sh', 'xz'] }
+	@staticmethod
+	def parse_desc(text):
+		desc, key = ({}, None)
+		for ln in text.split('\n'):
+			if ln.startswith('%') and ln.endswith('%'):
+				key = ln[1:-1]
+				desc[key] = []
+			elif len(ln) > 0 and key is not None:
+				desc[key].append(ln)
+		return desc
+
+	# Compare package versions like pacman's vercmp
+	# Returns: -1 = 'a' is older, 0 = same version, 1 = 'a' is newer
+	@staticmethod
+	def vercmp(a, b):
+		if a == b: return 0
+		(epoch_a, ver_a, rel_a), (epoch_b, ver_b, rel_b) = (PkgDb.parse_evr(a), PkgDb.parse_evr(b))
+		ret = PkgDb.rpmvercmp(epoch_a, epoch_b)
+		if ret == 0:
+			ret = PkgDb.rpmvercmp(ver_a, ver_b)
+			if ret == 0 and rel_a is not None and rel_b is not None:
+				ret = PkgDb.rpmvercmp(rel_a, rel_b)
+		return ret
+
+	# Returns: epoch, version & release of a version e.g. ('2', '2.04', '8') for '2:2.04-8'
+	@staticmethod
+	def parse_evr(evr):
+		match = re.match(r'^(\d*):(.*)$', evr)
+		epoch, version = ((match.group(1) or '0'), match.group(2)) if match is not None else ('0', evr)
+		version, sep, release = version.rpartition('-')
+		return (epoch, version, release) if len(sep) > 0 else (epoch, release, None)
+
+	# Compare version segments the way RPM (& pacman) does
+	# Returns: -1 / 0 / 1; see PkgDb.vercmp()
+	@staticmethod
+	def rpmvercmp(a, b):
+		if a == b: return 0
+		alnum = lambda c: c.isascii() and c.isalnum()
+		i, j = (0, 0)
+		while i < len(a) and j < len(b):
+			start_a, start_b = (i, j)
+			while i < len(a) and not alnum(a[i]): i += 1
+			while j < len(b) and not alnum(b[j]): j += 1
+			if i >= len(a) or j >= len(b): break
+			if i - start_a != j - start_b: # Different separator lengths
+				return -1 if i - start_a < j - start_b else 1
+			start_a, start_b = (i, j)
+			is_num = a[i].isdigit()
+			same_kind = (lambda c: c.isascii() and c.isdigit()) if is_num else (lambda c: c.isascii() and c.isalpha())
+			while i < len(a) and same_kind(a[i]): i += 1
+			while j < len(b) and same_kind(b[j]): j += 1
+			seg_a, seg_b = (a[start_a:i], b[start_b:j])
+			if len(seg_b) == 0: return 1 if is_num else -1 # Numeric segments are newer than alpha ones
+			if is_num:
+				seg_a, seg_b = (seg_a.lstrip('0'), seg_b.lstrip('0'))
+				if len(seg_a) != len(seg_b): return 1 if len(seg_a) > len(seg_b) else -1
+			if seg_a != seg_b: return 1 if seg_a > seg_b else -1
+		if i >= len(a) and j >= len(b): return 0
+		# A remaining alpha segment never beats an empty one
+		return -1 if (i >= len(a) and not (b[j].isascii() and b[j].isalpha())) or (i < len(a) and a[i].isascii() and a[i].isalpha()) else 1
+
+	# Memory-mapped index file of tables sorted by key; each table is a count, offsets & lines of tab separated fields:
+	#   b'PKGIDX1\n' | header length | JSON header: sources' signature & table positions | tables...
+	# The index is shared by all threads (e.g. the install path & Prefetch), so reloads & reads hold it's lock
+	# to never read a map closed by a reload or mix the positions of two maps
+	class Index:
+		def __init__(self, name, sources, reader):
+			self.path = f'{pkgdb_dir}/{name}.idx'
+			self.reader = reader # Function returning the tables of the sources; see PkgDb.read_sync()
+			self.lock = threading.RLock()
+			self.map = None
+			self.tables = {}
+			self.signature = None
+			self.refresh(sources)
+
+		# Returns: modification times & sizes of the sources e.g. [['/var/lib/pacman/sync/core.db', 1589000000000000000, 135000]]
+		@staticmethod
+		def sign(sources):
+			signature = []
+			for f_path in sources:
+				try:
+					stat = os.stat(f_path)
+					signature.append([f_path, stat.st_mtime_ns, stat.st_size])
+				except OSError:
+					signature.append([f_path, 0, 0])
+			return signature
+
+		# (Re)load the index, rebuilding it first if the sources changed
+		def refresh(self, sources):
+			signature = PkgDb.Index.sign(sources)
+			with self.lock:
+				if signature == self.signature: return
+				if not self.load(signature):
+					self.build(sources, signature)
+					if not self.load(signature):
+						log(f"[setup.py:PkgDb.Index.refresh()] WARN: Couldn't use the package index '{self.path}'")
+
+		# Map the index file if it was built from the same sources
+		# Returns: Boolean representing whether the index was loaded
+		def load(self, signature):
+			try:
+				with open(self.path, 'rb') as f:
+					index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (OSError, ValueError):
+				return False
+			try:
+				header_len = struct.unpack_from('<I', index_map, 8)[0]
+				header = json.loads(index_map[12:12 + header_len])
+				if index_map[:8] != b'PKGIDX1\n' or header['signature'] != signature:
+					index_map.close()
+					return False
+			except (struct.error, ValueError, KeyError):
+				index_map.close()
+				return False
+			with self.lock:
+				if self.map is not None: self.map.close()
+				self.map, self.tables, self.signature = (index_map, header['tables'], signature)
+			return True
+
+		# Write a new index of the sources with an atomic rename
+		def build(self, sources, signature):
+			tables, blobs, pos = ({}, [], 0)
+			for table, rows in self.reader(sources).items():
+				lines = [('\t'.join([key] + fields) + '\n').encode() for key, fields in sorted(rows.items())]
+				offsets, offset = ([], 0)
 				for line in lines:
-					line = line.rstrip() # e.g. 'line\n' => 'line'
-					if line.startswith(search_ln):
-						line_num = ln
-						break
-					ln += 1
-			return line_num
-		except:
-			return -2
+					offsets.append(offset)
+					offset += len(line)
+				blob = struct.pack(f'<{len(offsets)}I', *offsets) + b''.join(lines)
+				tables[table] = [pos, len(lines)] # Relative to the end of the header
+				blobs.append(blob)
+				pos += len(blob)
+			header = json.dumps({ 'signature': signature, 'tables': tables }, separators=(',', ':')).encode()
+			try:
+				os.makedirs(pkgdb_dir, exist_ok=True)
+				with open(f'{self.path}.tmp', 'wb') as f:
+					f.write(b'PKGIDX1\n' + struct.pack('<I', len(header)) + header + b''.join(blobs))
+				os.replace(f'{self.path}.tmp', self.path)
+			except OSError:
+				log(f"[setup.py:PkgDb.Index.build()] WARN: Couldn't write the package index '{self.path}'")
+
+		# Returns: position of a table's offsets & lines in the map & it's row count
+		def table(self, table):
+			if self.map is None or table not in self.tables: return (0, 0, 0)
+			start, count = self.tables[table]
+			start += 12 + struct.unpack_from('<I', self.map, 8)[0]
+			return (start, start + 4 * count, count)
+
+		# Returns: the line at row 'i' of a table as bytes
+		def row(self, offsets, lines, i):
+			start = lines + struct.unpack_from('<I', self.map, offsets + 4 * i)[0]
+			return self.map[start:self.map.find(b'\n', start)]
+
+		# Binary search a table for a key
+		# Returns: fields following the key e.g. ['core', '2:2.04-8', ...] / None when not found
+		def find(self, table, key):
+			key_bytes = key.encode()
+			with self.lock:
+				offsets, lines, count = self.table(table)
+				low, high = (0, count)
+				while low < high:
+					mid = (low + high) // 2
+					row = self.row(offsets, lines, mid)
+					row_key = row.split(b'\t', 1)[0]
+					if row_key == key_bytes: return row.decode().split('\t')[1:]
+					if row_key < key_bytes: low = mid + 1
+					else: high = mid
+			return None
+
+		# Returns: all keys of a table
+		def keys(self, table):
+			with self.lock:
+				offsets, lines, count = self.table(table)
+				return [self.row(offsets, lines, i).split(b'\t', 1)[0].decode() for i in range(count)]
+
+		# Returns: keys & fields of every row in a table e.g. [['grub', '2:2.04-7', '31000000'], ...]
+		def rows(self, table):
+			with self.lock:
+				offsets, lines, count = self.table(table)
+				return [self.row(offsets, lines, i).decode().split('\t') for i in range(count)]
+
+# Deferral of expensive pacman post-transaction hooks (e.g. initramfs & icon cache rebuilds) to the end of the install
+# Each hook in deferred_hooks is overridden in hook_override_dir by a copy with the same triggers which only records
+# the hook's targets; once deferring ends, every triggered hook runs exactly once with all of it's recorded targets e.g.
+#   PacmanHooks.defer()
+#   Pkg.install('gnome') # => '/var/lib/setup-hooks/gtk-update-icon-cache' lists the icon theme directories touched
+#   PacmanHooks.run()    # => one 'gtk-update-icon-cache' run
+class PacmanHooks:
+	# Start deferring the hooks
+	@staticmethod
+	def defer():
+		global hooks_deferred
+		os.makedirs(hook_state_dir, exist_ok=True)
+		hooks_deferred = {}
+		PacmanHooks.sync() # Also covers hooks installed by the first transaction e.g. mkinitcpio's
+
+	# Returns: Boolean representing whether hooks are being deferred
+	@staticmethod
+	def deferring():
+		return hooks_deferred is not None
+
+	# Override deferred hooks installed since the last transaction; called before every pacman transaction
+	# Hooks that aren't installed yet are overridden using their known triggers & replaced by a copy of the real one once it is
+	@staticmethod
+	def sync():
+		for name in deferred_hooks:
+			src, dest = (f'{hook_dir}/{name}.hook', f'{hook_override_dir}/{name}.hook')
+			installed = os.path.isfile(src)
+			if hooks_deferred.get(name) or (name not in hooks_deferred and os.path.exists(dest)): continue # Keep existing overrides
+			if installed: hook = PacmanHooks.parse(src)
+			elif name in hook_triggers and name not in hooks_deferred: hook = PacmanHooks.known(name)
+			else: continue
+			if hook.get('When') != 'PostTransaction' or 'Exec' not in hook: continue
+			state = f'{hook_state_dir}/{name}'
+			record = f"Exec = /usr/bin/sh -c 'cat >>{state}'" if hook['NeedsTargets'] else f'Exec = /usr/bin/touch {state}' # Only hooks with NeedsTargets get the targets on stdin
+			lines = [ln for ln in hook['lines'] if not re.match(r'\s*(Exec|Depends|AbortOnFail)\s*(=|$)', ln)]
+			lines.insert(lines.index(hook['action']) + 1, record)
+			os.makedirs(hook_override_dir, exist_ok=True)
+			if IO.write(dest, '\n'.join(lines) + '\n') == 0:
+				hooks_deferred[name] = installed
+
+	# Returns: a hook that isn't installed yet built from hook_triggers in the format of PacmanHooks.parse(); it's action is replaced anyway
+	@staticmethod
+	def known(name):
+		needs_targets, operations, targets = hook_triggers[name]
+		lines = [ '[Trigger]', 'Type = Path' ] + [f'Operation = {op}' for op in operations.split()] + [f'Target = {target}' for target in targets]
+		lines += [ '', '[Action]', f'Description = Recording {name} triggers...', 'When = PostTransaction' ] + ([ 'NeedsTargets' ] if needs_targets else [])
+		return { 'lines': lines, 'action': '[Action]', 'When': 'PostTransaction', 'Exec': '', 'NeedsTargets': needs_targets }
+
+	# Returns: contents of a hook file e.g. { 'lines': [...], 'action': '[Action]', 'When': 'PostTransaction', 'Exec': '/usr/bin/fc-cache -s', 'NeedsTargets': True }
+	@staticmethod
+	def parse(f_path):
+		hook = { 'lines': [], 'action': None, 'NeedsTargets': False }
+		try:
+			with open(f_path) as f:
+				hook['lines'] = f.read().rstrip('\n').split('\n')
+		except OSError:
+			return hook
+		section = ''
+		for ln in hook['lines']:
+			stripped = ln.strip()
+			if stripped.startswith('['):
+				section = stripped
+				if section == '[Action]': hook['action'] = ln
+			elif section == '[Action]' and len(stripped) > 0 and not stripped.startswith('#'):
+				key, _, val = stripped.partition('=')
+				hook[key.strip()] = val.strip() if len(_) > 0 else True
+		return hook
+
+	# Stop deferring & run every triggered hook once; hooks with their own caches run in parallel
+	# Returns: amount of failed hooks
+	@staticmethod
+	def run():
+		global hooks_deferred
+		if hooks_deferred is None: return 0
+		names, hooks_deferred = (list(hooks_deferred), None)
+		if len(names) > 0:
+			Cmd.log('rm -f ' + ' '.join(f'{hook_override_dir}/{name}.hook' for name in names))
+		triggered = [name for name in names if os.path.isfile(f'{hook_state_dir}/{name}')]
+		log(f"[setup.py:PacmanHooks.run()] INFO: Running {len(triggered)} deferred hooks: {', '.join(triggered)}")
+		errors = 0
+		if len(triggered) > 0:
+			with concurrent.futures.ThreadPoolExecutor(max(1, parallel_jobs)) as pool:
+				errors = sum(1 for ret_val in pool.map(PacmanHooks.run_hook, sorted(triggered)) if ret_val != 0)
+		Cmd.log(f'rm -rf {hook_state_dir}')
+		return errors
+
+	# Run a hook's action with it's recorded targets
+	# Returns: exit code of the hook
+	@staticmethod
+	def run_hook(name):
+		hook = PacmanHooks.parse(f'{hook_dir}/{name}.hook')
+		if 'Exec' not in hook: return 0 # Removed since
+		targets = f'sort -u {hook_state_dir}/{name} | ' if hook['NeedsTargets'] else ''
+		return Cmd.log(f"{targets}{hook['Exec']}")
 
 # Package management
 
@@ -362,7 +1126,10 @@ class Pkg:
 	def refresh_dbs(force_refresh=False, quit_on_fail=True):
 		cmd = 'pacman -Sy'
 		cmd += 'y' if force_refresh else ''
+		if pacman_conf != '/etc/pacman.conf': cmd += f' --config {pacman_conf} --dbpath {pacman_db_path}' # e.g. '--plan'; see DryRun.isolate()
+		if not offline and not force_refresh: Pkg.restore_dbs() # Unchanged databases aren't downloaded again
 		ret_val = Cmd.log(cmd)
+		if ret_val == 0 and not offline: Pkg.save_dbs()
 		if ret_val != 0 and quit_on_fail:
 			log_path = 'mnt' if in_chroot else 'tmp'
 			write_ln(f'§2ERROR: §0Database refreshing failed. Check /{log_path}/setup.log for details')
@@ -370,11 +1137,79 @@ class Pkg:
 			exit(exit_code) # 7 = Couldn't synchronize databases, 8 = Force-refresh failed
 		return ret_val
 
+	# Returns: package cache directory e.g. '/mnt/pkgcache/pkgcache' on the live environment
+	@staticmethod
+	def cache_dir():
+		return ('' if in_chroot else '/mnt') + '/pkgcache/pkgcache'
+
+	# Snapshot changed sync databases to the package cache for later installs; see Pkg.restore_dbs() & Pkg.offline_dbs()
+	# The modification times pacman sets from the servers' 'Last-Modified' headers are kept
+	# Returns: cp exit code
+	@staticmethod
+	def save_dbs():
+		sync_dir = f'{Pkg.cache_dir()}/sync'
+		if not pkgcache_enabled or plan_only or not os.path.isdir(Pkg.cache_dir()): return 0
+		dbs = [f_path for f_path, cached_path in Pkg.sync_dbs(f'{pacman_db_path}/sync', sync_dir) if Pkg.db_mtime(f_path) != Pkg.db_mtime(cached_path)]
+		if len(dbs) == 0: return 0
+		return Cmd.log(f'mkdir -p {sync_dir} && cp -p {" ".join(dbs)} {sync_dir}/')
+
+	# Copy sync databases newer than the local ones from the package cache, so pacman only downloads
+	# databases modified since (the 'If-Modified-Since' request header is based on the local copy)
+	# Returns: cp exit code
+	@staticmethod
+	def restore_dbs():
+		sync_dir = f'{Pkg.cache_dir()}/sync'
+		if not pkgcache_enabled or not os.path.isdir(sync_dir): return 0
+		dbs = [f_path for f_path, local_path in Pkg.sync_dbs(sync_dir, f'{pacman_db_path}/sync') if Pkg.db_mtime(f_path) > Pkg.db_mtime(local_path)]
+		if len(dbs) == 0: return 0
+		return Cmd.log(f'cp -p {" ".join(dbs)} {pacman_db_path}/sync/')
+
+	# Returns: pairs of sync database paths in 'src' & 'dest' e.g. [('/var/lib/pacman/sync/core.db', '/pkgcache/pkgcache/sync/core.db'), ...]
+	@staticmethod
+	def sync_dbs(src, dest):
+		try: f_names = sorted(os.listdir(src))
+		except OSError: return []
+		return [(f'{src}/{f_name}', f'{dest}/{f_name}') for f_name in f_names if f_name.endswith('.db') and f_name != f'{aur_repo}.db']
+
+	# Returns: modification time of a database / 0 if it doesn't exist
+	@staticmethod
+	def db_mtime(f_path):
+		try: return int(os.stat(f_path).st_mtime)
+		except OSError: return 0
+
+	# Use the sync database snapshot in the package cache as a local 'file://' server for all repositories
+	# so nothing is downloaded; packages are only taken from the package cache; see Pkg.save_dbs()
+	# Returns: 0 = Success, 1 = No snapshot found / pacman exit code
+	@staticmethod
+	def offline_dbs():
+		sync_dir = f'{Pkg.cache_dir()}/sync'
+		if not os.path.isdir(sync_dir) or len(os.listdir(sync_dir)) == 0:
+			log(f"[setup.py:Pkg.offline_dbs()] ERROR: No cached package databases found in '{sync_dir}'")
+			return 1
+		mirrorlist = '/etc/pacman.d/mirrorlist'
+		if not os.path.isfile(f'{mirrorlist}.online'):
+			Cmd.log(f'cp {mirrorlist} {mirrorlist}.online')
+		IO.write(mirrorlist, f'# Offline install from the package cache (setup.py -N)\nServer = file://{sync_dir}\n')
+		return Pkg.refresh_dbs(True, False)
+
+	# Restore the mirrors replaced for an offline install; see Pkg.offline_dbs()
+	@staticmethod
+	def online_dbs():
+		mirrorlist = '/etc/pacman.d/mirrorlist'
+		if os.path.isfile(f'{mirrorlist}.online'):
+			Cmd.log(f'mv {mirrorlist}.online {mirrorlist}')
+
 	# Install packages from the Arch repositories (core, extra, community)
 	# or optionally a local package with the absolute path defined
-	# Returns: pacman exit code
+	# now: install right away even while planning, for callers checking the result e.g. to fall back to other packages
+	# Returns: pacman exit code (0 for planned installs; failures are reported once committed, see Pkg.run_plan())
 	@staticmethod
-	def install(pkgs, only_needed=True):
+	def install(pkgs, only_needed=True, now=False):
+		if dry_run is not None:
+			return DryRun.add('repo', pkgs)
+		if Pkg.planning():
+			if not now: return Pkg.plan_install(pkgs, only_needed)
+			Pkg.commit_plan() # Whatever the packages might depend on
 		pac_args = '--needed' if only_needed else ''
 		local = ('/' in pkgs)
 		if pkgcache_enabled and in_chroot and not local:
@@ -389,24 +1224,34 @@ class Pkg:
 	# Returns: pacman exit code
 	@staticmethod
 	def install_group(groups, excluded_pkgs='', only_needed=True):
-		tmp_pkgs = ''
-		if len(excluded_pkgs) > 0:
-			for pkg in excluded_pkgs.split(' '):
-				tmp_pkgs += pkg + '|'
-			excluded_pkgs = tmp_pkgs[:-1] # Remove last '|'
-		pkgs = f'$(pacman -Sg {groups} | cut -d" " -f2'
-		pkgs += (f' | egrep -v "{excluded_pkgs}"' if len(excluded_pkgs) > 0 else '') + ')'
-		pac_args = '--needed' if only_needed else ''
-		if pkgcache_enabled and in_chroot:
-			pac_args += ' --cachedir /pkgcache/pkgcache'
-		if len(pac_args) > 0: pac_args = ' ' + pac_args.strip()
-		ret_val = Cmd.log(f'pacman -S {pkgs} --noconfirm --noprogressbar{pac_args}')
-		return ret_val
+		pkgs = Pkg.group_members(groups, excluded_pkgs)
+		if len(pkgs) == 0:
+			log(f"[setup.py:Pkg.install_group()] WARN: No packages found in group(s) '{groups}'")
+			return 1
+		return Pkg.install(pkgs, only_needed)
+
+	# Members of Arch package groups from the sync databases, optionally ignoring some of them by their exact names
+	# Returns: space separated package names e.g. 'gpicview lxappearance ...' for groups 'lxde' & excluded_pkgs 'lxdm'
+	@staticmethod
+	def group_members(groups, excluded_pkgs=''):
+		db = PkgDb.get()
+		excluded = set(excluded_pkgs.split())
+		pkgs = []
+		for group in groups.split():
+			members = db.group(group)
+			if len(members) == 0:
+				log(f"[setup.py:Pkg.group_members()] WARN: Package group '{group}' wasn't found")
+			pkgs += [pkg for pkg in members if pkg not in excluded]
+		return ' '.join(dict.fromkeys(pkgs))
 
 	# Remove installed packages on a system
 	# Returns: pacman exit code
 	@staticmethod
 	def remove(pkgs, also_deps=False, log_cmd=True):
+		if dry_run is not None:
+			return DryRun.add('remove', pkgs)
+		if Pkg.planning():
+			return Pkg.plan_remove(pkgs, also_deps)
 		pac_args = '-Rn' + ('sc' if also_deps else '') + ' --noconfirm --noprogressbar'
 		ret_val = Cmd.log(f'pacman {pac_args} {pkgs}', '', log_cmd)
 		return ret_val
@@ -415,28 +1260,42 @@ class Pkg:
 	# Returns: pacman exit code
 	@staticmethod
 	def aur_install(pkgs, only_needed=True):
+		if dry_run is not None:
+			return DryRun.add('aur', pkgs)
 		if in_chroot:
 			if enable_aur:
 				yay_args = '--needed' if only_needed else ''
 				if len(yay_args) > 0: yay_args = ' ' + yay_args.strip()
 				errors = 0
-				ccache_args = 'export PATH=/usr/lib/ccache/bin:$PATH USE_CCACHE=1; ' if use_ccache else '' # TODO Optimize, use 'env' instead?
+				ccache_args = Ccache.env()
 				pkgs = pkgs.strip() # To mitigate user error
+				if offline: # Only cached packages from the cache repository are available; see prebuild_aur()
+					return Pkg.install(pkgs, only_needed, True)
+				if pkgcache_enabled: AurCache.record(pkgs.split())
+				errors = AurBuild.install(pkgs, only_needed)
+				if errors is not None: return errors
+				log(f"[setup.py:Pkg.aur_install('{pkgs}')] WARN: Resolving AUR dependencies failed, falling back to yay")
+				errors = 0
 				if pkgcache_enabled:
-					for pkg in pkgs.split(' '):
-						pkg = pkg.strip() # To mitigate user error
-						# TODO Check version differently for '-git' packages e.g. 'pulseaudio-modules-bt-git' report old pkg versions on yay query
-						ver = Cmd.output(f'$ yay -Si {pkg} | grep Version', 'aurhelper').split(':', 1)[1].strip() # e.g. '3.3.0-1'
-						latest_pkg = ''
-						try: latest_pkg = str(Cmd.output(f'ls {aur_cache}/ | grep {pkg} | grep {ver}')).split('\n')[0].strip() # e.g. 'polybar-3.3.0-1-x86_64.pkg.tar.xz'
-						except: pass
-						if len(latest_pkg) > 0: # Up-to-date cached version found => install it instead
-							errors += Pkg.install(f'{aur_cache}/{latest_pkg}', only_needed)
-						else: # Cached version not found => fetch from the AUR
-							ret_val = Cmd.log(f'$ {ccache_args}yay -Sq --noconfirm{yay_args} {pkg}', 'aurhelper')
-							if ret_val == 0: # Installed => try caching package
-								Cmd.log(f'cp /home/aurhelper/.cache/yay/{pkg}/*.pkg.tar.xz {aur_cache}/')
-							errors += ret_val
+					pkgs = pkgs.split() # e.g. ['polybar', 'yay-bin']
+					# TODO Check version differently for '-git' packages e.g. 'pulseaudio-modules-bt-git' report old pkg versions on yay query
+					versions = Pkg.aur_versions(pkgs) # e.g. { 'polybar': '3.3.0-1' }
+					cached, missing = ([], [])
+					for pkg in pkgs:
+						f_name = AurCache.lookup(pkg, versions.get(pkg, '')) # e.g. 'polybar-3.3.0-1-x86_64.pkg.tar.xz'
+						if f_name is not None: cached.append(f'{aur_cache}/{f_name}')
+						else: missing.append(pkg)
+
+					# Up-to-date cached versions found => install them all at once instead
+					if len(cached) > 0 and Pkg.install(' '.join(cached), only_needed, True) != 0:
+						log(f'[setup.py:Pkg.aur_install()] WARN: Installing cached AUR packages failed, building them instead')
+						missing = pkgs
+
+					for pkg in missing: # Cached version not found => fetch from the AUR
+						ret_val = Cmd.log(f'$ {ccache_args}yay -Sq --noconfirm{yay_args} {pkg}', 'aurhelper')
+						if ret_val == 0: # Installed => try caching package
+							AurCache.add([f_path for f_path in glob.glob(f'/home/aurhelper/.cache/yay/{pkg}/*.pkg.tar.*') if AurCache.parse(f_path)[0] is not None])
+						errors += ret_val
 				else:
 					errors = Cmd.log(f'$ {ccache_args}yay -Sq --noconfirm{yay_args} {pkgs}', 'aurhelper')
 				return errors
@@ -446,14 +1305,914 @@ class Pkg:
 			log(f"[setup.py:Pkg.aur_install('{pkgs}')] WARN: Ignoring installation since not in chroot.")
 		return 1
 
+	# Look up the latest versions of AUR packages with a single AUR RPC request
+	# Returns: versions by package name e.g. { 'polybar': '3.3.0-1' } / {} on errors
+	@staticmethod
+	def aur_versions(pkgs):
+		infos = Pkg.aur_info(pkgs)
+		return { name: info['Version'] for name, info in infos.items() } if infos is not None else {}
+
+	# Look up AUR package details (version, package base, dependencies, ...) with as few AUR RPC requests as possible
+	# Returns: details by package name e.g. { 'polybar': { 'Version': '3.3.0-1', 'Depends': [...], ... } } / None on errors
+	@staticmethod
+	def aur_info(pkgs):
+		infos = {}
+		for i in range(0, len(pkgs), aur_rpc_batch):
+			query = urllib.parse.urlencode([ ('v', 5), ('type', 'info') ] + [ ('arg[]', pkg) for pkg in pkgs[i:i + aur_rpc_batch] ])
+			try:
+				with urllib.request.urlopen(f'{aur_rpc_url}?{query}', timeout=30) as res:
+					results = json.load(res).get('results', [])
+				infos.update({ info['Name']: info for info in results })
+			except (OSError, ValueError, KeyError, AttributeError, TypeError) as e:
+				log(f"[setup.py:Pkg.aur_info()] WARN: AUR RPC request failed: {e}")
+				return None
+		return infos
+
+	# Install planning
+
+	# Start registering Pkg.install(), Pkg.install_group() & Pkg.remove() calls in an install plan
+	# instead of running a pacman transaction for each of them; see Pkg.commit_plan()
+	@staticmethod
+	def begin_plan():
+		global pkg_plan
+		with plan_lock:
+			if pkg_plan is None:
+				pkg_plan = { 'remove': {}, 'install': {}, 'deferred': [], 'errors': 0 }
+
+	# Commit everything still planned & stop planning package operations
+	# Returns: amount of failed transactions & deferred steps during the whole plan
+	@staticmethod
+	def end_plan():
+		global pkg_plan
+		while True:
+			Pkg.commit_plan()
+			with plan_lock:
+				if pkg_plan is None: return 0
+				if plan_committer is None and not Pkg.pending():
+					errors = pkg_plan['errors']
+					pkg_plan = None
+					return errors
+
+	# Returns: Boolean representing whether the install plan has uncommitted package operations or deferred steps
+	@staticmethod
+	def pending():
+		return pkg_plan is not None and len(pkg_plan['remove']) + len(pkg_plan['install']) + len(pkg_plan['deferred']) > 0
+
+	# Returns: Boolean representing whether package operations are being planned
+	# (never while the current thread is committing the plan)
+	@staticmethod
+	def planning():
+		return pkg_plan is not None and plan_committer != threading.get_ident()
+
+	# Register packages to be installed in the install plan
+	# Returns: 0
+	@staticmethod
+	def plan_install(pkgs, only_needed=True):
+		while Pkg.add_install(pkgs, only_needed) != 0: # Reinstall of a planned removal => keep the order
+			Pkg.commit_plan()
+		return 0
+
+	# Returns: 0 when added to the install plan / 1 when a package of it is planned to be removed first
+	@staticmethod
+	def add_install(pkgs, only_needed=True):
+		flags, names = ([], [])
+		for pkg in pkgs.split():
+			(flags if pkg.startswith('-') else names).append(pkg) # e.g. '--asexplicit'
+		with plan_lock:
+			for remove_pkgs in pkg_plan['remove'].values():
+				if any(name in remove_pkgs for name in names): return 1
+			action = 'U' if '/' in pkgs else 'S'
+			pkg_plan['install'].setdefault((action, only_needed, ' '.join(flags)), []).append(names)
+		return 0
+
+	# Register packages to be removed in the install plan; removals are committed before installs
+	# Returns: 0
+	@staticmethod
+	def plan_remove(pkgs, also_deps=False):
+		with plan_lock:
+			return Pkg.add_remove(pkgs, also_deps)
+
+	@staticmethod
+	def add_remove(pkgs, also_deps=False):
+		names = pkgs.split()
+		for key, entries in pkg_plan['install'].items(): # Don't install what is removed anyway
+			pkg_plan['install'][key] = [[pkg for pkg in entry if pkg not in names] for entry in entries]
+		remove_pkgs = pkg_plan['remove'].setdefault(also_deps, [])
+		remove_pkgs.extend([name for name in names if name not in remove_pkgs])
+		return 0
+
+	# Defer an imperative step like 'systemctl enable ...' until the planned packages are installed
+	# or commit the install plan right away when the step might depend on them; see Pkg.needs_plan()
+	# Returns: Boolean representing whether the step was deferred
+	@staticmethod
+	def defer_cmd(cmd, exec_user='', io_stream_type=0):
+		with plan_lock:
+			if pkg_plan is None: return False
+			pending = len(pkg_plan['remove']) + len(pkg_plan['install']) > 0
+			if pending and io_stream_type == 2 and cmd.startswith(deferrable_cmds):
+				pkg_plan['deferred'].append((cmd, exec_user))
+				return True
+			committing = plan_committer is not None # On another thread, it might install what the step needs
+		if (pending or committing) and Pkg.needs_plan(cmd, exec_user):
+			Pkg.commit_plan()
+		return False
+
+	# Returns: Boolean representing whether a command might depend on planned packages i.e. it runs as a user (e.g. AUR builds),
+	# uses pacman or a program that isn't installed yet, or refers to a path that doesn't exist yet
+	# e.g. "sed 's/^#greeter-session=/.../' -i /etc/lightdm/lightdm.conf" before lightdm is installed
+	@staticmethod
+	def needs_plan(cmd, exec_user=''):
+		if exec_user != '' or cmd.startswith('$ '): return True
+		progs = Cmd.programs(cmd)
+		if progs is None: return True
+		for words in progs:
+			if os.path.basename(words[0]) in ('pacman', 'yay', 'makepkg'): return True # Package queries e.g. 'pacman -Qq | grep eog'
+			if words[0] not in shell_builtins and shutil.which(words[0]) is None: return True
+			for word in words[1:]:
+				path = word.split('=')[-1] # e.g. '--file=/etc/x' => '/etc/x'
+				if path.startswith('/') and not os.path.exists(path): return True
+		return False
+
+	# Commit the install plan before accessing a file that a planned package might provide
+	@staticmethod
+	def need_file(f_path):
+		if Pkg.planning() and not os.path.exists(f_path):
+			Pkg.commit_plan()
+
+	# Commit planned package operations as the fewest possible pacman transactions & run the steps
+	# deferred while planning afterwards; a failed transaction is retried per original install call
+	# The plan is taken out under plan_lock & run without it, so other threads keep planning meanwhile;
+	# a commit started during one in progress on another thread waits for it to finish first
+	# Returns: amount of failed transactions & deferred steps
+	@staticmethod
+	def commit_plan():
+		global pkg_plan, plan_committer
+		with plan_lock:
+			if plan_committer == threading.get_ident(): return 0
+			while plan_committer is not None: plan_done.wait()
+			if not Pkg.pending(): return 0
+			plan = pkg_plan
+			pkg_plan = { 'remove': {}, 'install': {}, 'deferred': [], 'errors': plan['errors'] }
+			plan_committer = threading.get_ident() # Run everything below for real
+		errors = 0
+		try:
+			errors = Pkg.run_plan(plan)
+		finally:
+			with plan_lock:
+				plan_committer = None
+				pkg_plan['errors'] += errors
+				plan_done.notify_all()
+		return errors
+
+	# Run the package operations & deferred steps of a plan; see Pkg.commit_plan()
+	# Returns: amount of failed transactions & deferred steps
+	@staticmethod
+	def run_plan(plan):
+		errors = 0
+		for also_deps, names in plan['remove'].items():
+			db = PkgDb.get()
+			installed = [name for name in names if db.installed(name) is not None]
+			if len(installed) > 0:
+				errors += 1 if Pkg.remove(' '.join(installed), also_deps) != 0 else 0
+
+		for (action, only_needed, flags), entries in plan['install'].items():
+			entries = [entry for entry in entries if len(entry) > 0]
+			names = []
+			for entry in entries:
+				names.extend([pkg for pkg in entry if pkg not in names])
+			if len(names) == 0: continue
+			log(f'\n[setup.py:Pkg.commit_plan()] INFO: Installing {len(names)} planned packages in a single transaction')
+			ret_val = Pkg.install(f'{flags} {" ".join(names)}'.strip(), only_needed)
+			if ret_val != 0 and len(entries) > 1: # Find out which of the install calls failed
+				log(f'[setup.py:Pkg.commit_plan()] WARN: Planned transaction failed, retrying {len(entries)} installs separately')
+				for entry in entries:
+					if Pkg.install(f'{flags} {" ".join(entry)}'.strip(), only_needed) != 0:
+						Pkg.plan_failed(entry)
+						errors += 1
+			elif ret_val != 0:
+				Pkg.plan_failed(names)
+				errors += 1
+
+		for cmd, exec_user in plan['deferred']:
+			errors += 1 if Cmd.log(cmd, exec_user) != 0 else 0
+		return errors
+
+	# Report a failed planned install; it's step had already been shown as done when it was planned
+	@staticmethod
+	def plan_failed(names):
+		log(f"[setup.py:Pkg.run_plan()] ERROR: Planned install of '{' '.join(names)}' failed")
+		write_msg(f"Planned install of '{' '.join(names)}' failed, see {Log.path()}", 3)
+
+# Index of cached AUR package files e.g. { 'polybar': { '3.3.0-1': 'polybar-3.3.0-1-x86_64.pkg.tar.xz' } }
+# It's saved next to the cache directory & rebuilt whenever the directory is modified
+
+class AurCache:
+	# Returns: path of the saved index e.g. '/pkgcache/pkgcache/aur/intel_6-60-4.index.json'
+	@staticmethod
+	def index_path():
+		return f'{aur_cache}.index.json'
+
+	# Returns: file name of a cached package version e.g. 'polybar-3.3.0-1-x86_64.pkg.tar.xz' / None when not cached
+	@staticmethod
+	def lookup(pkg, version):
+		return AurCache.index().get(pkg, {}).get(version)
+
+	# Returns: the index loaded once per run; see AurCache
+	@staticmethod
+	def index():
+		global aur_index
+		try: mtime = os.stat(aur_cache).st_mtime_ns
+		except OSError: return {}
+		if aur_index is None:
+			try:
+				with open(AurCache.index_path(), 'r') as f:
+					aur_index = json.load(f)
+			except (OSError, ValueError):
+				pass
+		if aur_index is None or aur_index.get('mtime') != mtime:
+			aur_index = { 'mtime': mtime, 'pkgs': AurCache.scan() }
+			AurCache.save()
+		return aur_index['pkgs']
+
+	# Returns: index of the package files in the cache directory; see AurCache
+	@staticmethod
+	def scan():
+		pkgs = {}
+		for f_name in os.listdir(aur_cache):
+			name, version = AurCache.parse(f_name)
+			if name is not None:
+				pkgs.setdefault(name, {})[version] = f_name
+		return pkgs
+
+	# Returns: package name & version of a package file e.g. ('polybar', '3.3.0-1') for 'polybar-3.3.0-1-x86_64.pkg.tar.xz'
+	# / (None, None) for other files like signatures
+	@staticmethod
+	def parse(f_name):
+		match = re.match(r'^(.+)-([^-]+)-([^-]+)-([^-]+)\.pkg\.tar(\.\w+)?$', os.path.basename(f_name))
+		if match is None: return (None, None)
+		return (match.group(1), f'{match.group(2)}-{match.group(3)}')
+
+	# Copy built package files to the cache & add them to it's pacman repository
+	# Returns: amount of errors
+	@staticmethod
+	def add(f_paths):
+		if len(f_paths) == 0: return 0
+		os.makedirs(aur_cache, exist_ok=True)
+		errors = Cmd.log(f'cp {" ".join(f_paths)} {aur_cache}/')
+		cached = ' '.join(f'{aur_cache}/{os.path.basename(f_path)}' for f_path in f_paths)
+		with named_lock(AurCache.db_path()):
+			errors += Cmd.log(f'repo-add -q {AurCache.db_path()} {cached}')
+		return errors
+
+	# Cached packages as a pacman repository
+
+	# Returns: path of the repository database e.g. '/pkgcache/pkgcache/aur/intel_6-60-4/aurcache.db.tar.gz'
+	@staticmethod
+	def db_path():
+		return f'{aur_cache}/{aur_repo}.db.tar.gz'
+
+	# Register the cache as a pacman repository so cached packages install like official ones
+	# Packages cached before it had a database are added to it first
+	# Returns: amount of errors
+	@staticmethod
+	def register(repos):
+		write_msg(f"Enabling cached AUR packages as the '{aur_repo}' repo...", 1)
+		errors = 0
+		if not os.path.isfile(AurCache.db_path()) and len(AurCache.index()) > 0:
+			f_paths = [f'{aur_cache}/{f_name}' for versions in AurCache.index().values() for f_name in versions.values()]
+			f_paths.sort(key=os.path.getmtime) # Newest versions last so they win
+			errors += Cmd.log(f'repo-add -q {AurCache.db_path()} {" ".join(f_paths)}')
+		if os.path.isfile(AurCache.db_path()):
+			errors += repos.add(aur_repo, 'SigLevel = Optional TrustAll', f'Server = file://{aur_cache}')
+		write_status(errors)
+		return errors
+
+	# Remove the repository from the new system's pacman.conf once the cache isn't available anymore
+	@staticmethod
+	def unregister():
+		conf = ConfigFile('/etc/pacman.conf')
+		if conf.remove_ln(f'[{aur_repo}]', 3) == 0:
+			conf.commit()
+			Cmd.log(f'rm -f /var/lib/pacman/sync/{aur_repo}.db')
+
+	# Returns: versions of packages in the registered repository e.g. { 'polybar': '3.3.0-1' }
+	@staticmethod
+	def repo_versions():
+		pkgs = {}
+		for ln in str(Cmd.output(f'pacman -Sl {aur_repo}', '', False)).split('\n'):
+			fields = ln.split() # e.g. ['aurcache', 'polybar', '3.3.0-1', '[installed]']
+			if len(fields) >= 3 and fields[0] == aur_repo: pkgs[fields[1]] = fields[2]
+		return pkgs
+
+	# Remember requested AUR packages for reference e.g. when cleaning up the cache
+	@staticmethod
+	def record(pkgs):
+		f_path = f'{aur_cache}/{aur_pkgs_fn}'
+		with named_lock(f_path):
+			recorded = AurCache.recorded()
+			new_pkgs = [pkg for pkg in dict.fromkeys(pkgs) if pkg not in recorded]
+			if len(new_pkgs) > 0 and os.path.isdir(aur_cache):
+				IO.write(f_path, ''.join(f'{pkg}\n' for pkg in new_pkgs), True)
+
+	# Returns: all recorded AUR packages e.g. ['polybar', 'yay-bin']; lines starting with '#' are ignored
+	@staticmethod
+	def recorded():
+		try:
+			with open(f'{aur_cache}/{aur_pkgs_fn}') as f:
+				return [ln.strip() for ln in f if len(ln.strip()) > 0 and not ln.startswith('#')]
+		except OSError:
+			return []
+
+	# Save the index for the next run
+	@staticmethod
+	def save():
+		tmp_path = f'{AurCache.index_path()}.tmp'
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(aur_index, f, separators=(',', ':'))
+			os.replace(tmp_path, AurCache.index_path())
+		except OSError:
+			log(f"[setup.py:AurCache.save()] WARN: Couldn't save the AUR cache index to '{AurCache.index_path()}'")
+
+# AUR build engine: the AUR dependency graph of the requested packages is resolved up front via the AUR RPC,
+# independent package bases are built concurrently in their own directories & the results are installed
+# with 'pacman -U'; cached packages are used instead of building them when available
+
+class AurBuild:
+	# Build & install AUR packages along with their AUR dependencies
+	# 'install_targets' = False only builds & caches the requested packages; see prebuild_aur()
+	# Returns: amount of failed builds & transactions / None when the dependency graph couldn't be resolved
+	@staticmethod
+	def install(pkgs, only_needed=True, install_targets=True):
+		graph = AurBuild.resolve(pkgs, only_needed)
+		if graph is None: return None
+		targets, bases, levels, repo_deps = (graph['targets'], graph['bases'], graph['levels'], graph['repo_deps'])
+		errors = len(graph['missing'])
+		if len(repo_deps) > 0:
+			errors += 1 if Pkg.install('--asdeps ' + ' '.join(repo_deps)) != 0 else 0
+
+		# Packages in the cache repository install by name, others from their files
+		repo_versions = AurCache.repo_versions() if pkgcache_enabled else {}
+		files, failed, installed = ({}, set(), set()) # e.g. { 'polybar': '/home/aurhelper/build/polybar/polybar-3.3.0-1-x86_64.pkg.tar.xz', 'yay-bin': 'yay-bin' }
+		for i, level in enumerate(levels):
+			to_build = []
+			for base in level:
+				if any(dep in failed for dep in bases[base]['deps']): # Can't be built without it's dependencies
+					log(f"[setup.py:AurBuild.install()] WARN: Skipping build of '{base}' since it's dependencies failed")
+					failed.update(bases[base]['names'])
+					errors += 1
+					continue
+				version = bases[base]['version']
+				if pkgcache_enabled and all(repo_versions.get(name) == version for name in bases[base]['names']):
+					files.update({ name: name for name in bases[base]['names'] })
+					continue
+				cached = { name: AurCache.lookup(name, version) if pkgcache_enabled else None for name in bases[base]['names'] }
+				if all(f_name is not None for f_name in cached.values()):
+					files.update({ name: f'{aur_cache}/{f_name}' for name, f_name in cached.items() })
+				else:
+					to_build.append(base)
+
+			if len(to_build) > 0:
+				jobs = min(len(to_build), AurBuild.jobs())
+				with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+					built = list(pool.map(lambda base: AurBuild.build(base, bases[base]['names'], jobs), to_build))
+				for base, base_files in zip(to_build, built):
+					if base_files is None:
+						failed.update(bases[base]['names'])
+						errors += 1
+						continue
+					files.update(base_files)
+					if pkgcache_enabled: AurCache.add(list(base_files.values()))
+
+			if i < len(levels) - 1: # Dependencies of later package bases must be installed before building them
+				needed = [name for base in level for name in bases[base]['names'] if name in files and name in graph['aur_deps']]
+				errors += AurBuild.install_files([files[name] for name in needed if name not in targets], '--asdeps ', False)
+				errors += AurBuild.install_files([files[name] for name in needed if name in targets], '', only_needed) # Requested => explicitly installed
+				installed.update(needed)
+
+		target_files = [files[name] for name in targets if name in files and name not in installed]
+		if install_targets and len(target_files) > 0:
+			log(f'\n[setup.py:AurBuild.install()] INFO: Installing {len(target_files)} AUR packages in a single transaction')
+			errors += AurBuild.install_files(target_files, '', only_needed)
+		return errors
+
+	# Install built package files & packages from the cache repository (by name)
+	# Returns: amount of failed transactions
+	@staticmethod
+	def install_files(files, flags='', only_needed=True):
+		errors = 0
+		for pkgs in ([f for f in files if '/' not in f], [f for f in files if '/' in f]):
+			if len(pkgs) > 0:
+				errors += 1 if Pkg.install(flags + ' '.join(pkgs), only_needed) != 0 else 0
+		return errors
+
+	# Resolve the AUR dependency graph of packages with one AUR RPC request per level of dependencies
+	# Returns: dict with 'targets' (to install), 'bases' e.g. { 'polybar': { 'names': ['polybar'], 'version': '3.3.0-1', 'deps': [...] } },
+	# 'levels' (lists of package bases buildable at the same time in build order), 'aur_deps', 'repo_deps' & 'missing' packages
+	# / None when the AUR RPC can't be reached
+	@staticmethod
+	def resolve(pkgs, only_needed=True):
+		db = PkgDb.get()
+		infos, aur_deps, repo_deps, missing = ({}, set(), [], [])
+		queue = [pkg for pkg in dict.fromkeys(pkgs.split())]
+		while len(queue) > 0:
+			found = Pkg.aur_info(queue)
+			if found is None: return None
+			deps = []
+			for name in queue:
+				info = found.get(name)
+				if info is None:
+					if name in aur_deps: repo_deps.append(name) # e.g. provided by a repository package like 'java-runtime'
+					else:
+						log(f"[setup.py:AurBuild.resolve()] WARN: Package '{name}' wasn't found in the AUR")
+						missing.append(name)
+					continue
+				infos[name] = info
+				for dep in AurBuild.deps(info):
+					dep = re.split(r'[<>=]', dep, 1)[0] # e.g. 'polybar>=3.3' => 'polybar'
+					if dep in infos or dep in deps or dep in queue: pass
+					elif db.installed(dep) is not None: continue
+					elif db.info(dep) is not None or len(db.providers(dep)) > 0:
+						if dep not in repo_deps: repo_deps.append(dep)
+						continue
+					else: deps.append(dep)
+					aur_deps.add(dep)
+			queue = deps
+
+		targets = [name for name in dict.fromkeys(pkgs.split()) if name in infos]
+		if only_needed: # Up-to-date targets don't need building
+			targets = [name for name in targets if name in aur_deps or db.installed(name) != infos[name]['Version']]
+		bases = {}
+		for name, info in infos.items():
+			if name not in targets and name not in aur_deps: continue
+			base = bases.setdefault(info.get('PackageBase', name), { 'names': [], 'version': info['Version'], 'deps': set() })
+			base['names'].append(name)
+			for dep in AurBuild.deps(info):
+				dep = re.split(r'[<>=]', dep, 1)[0]
+				if dep in infos and dep != name: base['deps'].add(dep)
+
+		# Group the package bases by the order they can be built in
+		levels, done = ([], set())
+		pending = list(bases)
+		while len(pending) > 0:
+			level = [base for base in pending if all(dep in done or dep in bases[base]['names'] for dep in bases[base]['deps'])]
+			if len(level) == 0: # Circular dependencies => let makepkg report the failures
+				log(f"[setup.py:AurBuild.resolve()] WARN: Circular AUR dependencies between '{' '.join(pending)}'")
+				level = pending
+			levels.append(level)
+			for base in level: done.update(bases[base]['names'])
+			pending = [base for base in pending if base not in level]
+		return { 'targets': targets, 'bases': bases, 'levels': levels, 'aur_deps': aur_deps, 'repo_deps': repo_deps, 'missing': missing }
+
+	# Returns: dependencies needed to build & run a package from it's AUR RPC details e.g. ['qt5-base', 'cmake>=3.1']
+	# CheckDepends are left out as check() isn't run (BUILDENV has '!check' in /etc/makepkg.conf)
+	@staticmethod
+	def deps(info):
+		return info.get('Depends', []) + info.get('MakeDepends', [])
+
+	# Build an AUR package base in it's own directory as the aurhelper user
+	# The PGP keys the sources are signed with (validpgpkeys) are imported first like yay does; when the keyserver
+	# can't be reached makepkg is still run & reports the unknown keys itself
+	# Returns: built package files by name e.g. { 'polybar': '/home/aurhelper/build/polybar/polybar-3.3.0-1-x86_64.pkg.tar.xz' } / None on errors
+	@staticmethod
+	def build(base, names, jobs=1):
+		build_dir = f'{aur_build_dir}/{base}'
+		ccache_args = Ccache.env()
+		make_jobs = max(1, (os.cpu_count() or 1) // jobs) # Share the CPU threads among the concurrent builds
+		import_keys = "{ keys=$(sed -n 's/^\\s*validpgpkeys = //p' .SRCINFO); [ -z \"$keys\" ] || gpg --batch -q --recv-keys $keys || true; }"
+		ret_val = Cmd.log(f'$ rm -rf {build_dir} && git clone -q --depth 1 https://aur.archlinux.org/{base}.git {build_dir} && cd {build_dir} && {import_keys} && {ccache_args}MAKEFLAGS=-j{make_jobs} makepkg -f --noconfirm --noprogressbar', 'aurhelper')
+		if ret_val != 0:
+			log(f"[setup.py:AurBuild.build('{base}')] WARN: Building the package failed")
+			return None
+		files = {}
+		for f_path in str(Cmd.output(f'$ cd {build_dir} && makepkg --packagelist', 'aurhelper', False)).split():
+			name = AurCache.parse(f_path)[0]
+			if name in names and os.path.isfile(f_path): files[name] = f_path
+		return files if len(files) == len(names) else None
+
+	# Returns: amount of AUR package bases built at the same time; see 'aur_build_jobs'
+	@staticmethod
+	def jobs():
+		if aur_build_jobs > 0: return aur_build_jobs
+		return min(4, max(2, (os.cpu_count() or 1) // 2))
+
+# Compression of built AUR packages (PKGEXT in /etc/makepkg.conf) & a benchmark of the formats on cached packages e.g.
+#   PkgCompression.compress_cmd('zst', 19, 8) # => 'zstd -c -z -q -T8 -19 -'
+
+class PkgCompression:
+	# Returns: configured package compression format e.g. 'zst' / '' for uncompressed packages; see 'aur_pkg_compression'
+	@staticmethod
+	def fmt():
+		fmt = aur_pkg_compression.strip().lower().replace('.pkg.tar', '').lstrip('.') # e.g. '.pkg.tar.zst' => 'zst'
+		if fmt not in pkg_compressors:
+			log(f"[setup.py:PkgCompression.fmt()] WARN: Unknown package compression '{aur_pkg_compression}', using 'zst' instead")
+			return 'zst'
+		return fmt
+
+	# Returns: command line compressing stdin to stdout e.g. 'zstd -c -z -q -T8 -19 -'
+	# level: 0 = the format's default, threads: 0 = all CPU threads (for formats compressing in parallel)
+	@staticmethod
+	def compress_cmd(fmt, level=0, threads=0):
+		cmd, threads_arg = pkg_compressors[fmt][:2]
+		threads_arg = threads_arg.format(threads if threads > 0 else (os.cpu_count() or 1))
+		level_arg = (' --ultra' if fmt == 'zst' and level > 19 else '') + f' -{level}' if level > 0 else ''
+		return cmd.format(threads=threads_arg, level=level_arg)
+
+	# Returns: format of a package file e.g. 'zst' for 'polybar-3.3.0-1-x86_64.pkg.tar.zst'
+	@staticmethod
+	def file_fmt(f_path):
+		return f_path.rsplit('.pkg.tar', 1)[1].lstrip('.')
+
+	# Set the compressors & package extension in makepkg.conf
+	@staticmethod
+	def configure(conf):
+		fmt = PkgCompression.fmt()
+		for other in pkg_compressors:
+			if other == '': continue # Uncompressed
+			line = f"COMPRESS{other.upper()}=({PkgCompression.compress_cmd(other, aur_compress_level if other == fmt else 0, aur_compress_threads)})"
+			if conf.replace_ln(f'COMPRESS{other.upper()}=(', line) == 1 and other == fmt: # e.g. 'COMPRESSZST' missing from older configs
+				conf.append_ln(line)
+		conf.replace_ln('PKGEXT=', f"PKGEXT='.pkg.tar{'.' + fmt if fmt != '' else ''}'")
+
+	# Compare the time packages take to compress when built & decompress when installed in every available format
+	# using the largest packages of a cache directory
+	# Returns: 0 = Success, 1 = No packages to compare with
+	@staticmethod
+	def bench(cache_dir):
+		f_paths = [f_path for f_path in glob.glob(f'{cache_dir}/*.pkg.tar*') if AurCache.parse(f_path)[0] is not None and PkgCompression.file_fmt(f_path) in pkg_compressors]
+		f_paths = sorted(f_paths, key=os.path.getsize, reverse=True)[:compress_bench_count]
+		if len(f_paths) == 0:
+			write_msg(f"No cached packages found in '{cache_dir}' to compare the formats with", 3)
+			return 1
+
+		bench_dir = '/tmp/setup-bench'
+		os.makedirs(bench_dir, exist_ok=True)
+		write_msg(f'Decompressing the {len(f_paths)} largest cached packages...', 1)
+		tars = []
+		for i, f_path in enumerate(f_paths):
+			tars.append(f'{bench_dir}/{i}.tar')
+			PkgCompression.run(pkg_compressors[PkgCompression.file_fmt(f_path)][2], f_path, tars[-1])
+		tar_size = sum(os.path.getsize(tar) for tar in tars)
+		write_status()
+
+		results = []
+		for fmt in pkg_compressors:
+			level = aur_compress_level if fmt == PkgCompression.fmt() else 0
+			compress_cmd, decompress_cmd = (PkgCompression.compress_cmd(fmt, level, aur_compress_threads), pkg_compressors[fmt][2])
+			if not Cmd.exists(compress_cmd.split()[0]) or not Cmd.exists(decompress_cmd.split()[0]):
+				log(f"[setup.py:PkgCompression.bench()] INFO: Skipping '{fmt}' since '{compress_cmd}' isn't available")
+				continue
+			write_msg(f"Compressing with '{compress_cmd}'...", 1)
+			compress_time, decompress_time, size = (0, 0, 0)
+			for tar in tars:
+				compress_time += PkgCompression.run(compress_cmd, tar, f'{tar}.out')
+				decompress_time += PkgCompression.run(decompress_cmd, f'{tar}.out', '/dev/null')
+				size += os.path.getsize(f'{tar}.out')
+			write_status()
+			results.append((compress_time + decompress_time, fmt or 'none', level, size, compress_time, decompress_time))
+		Cmd.log(f'rm -rf {bench_dir}')
+
+		header = f"{'format':<8}{'level':>6}{'size':>10}{'ratio':>8}{'build':>9}{'install':>9}{'total':>9}"
+		lines = [f"{fmt:<8}{level or '-':>6}{size_str(size):>10}{size / max(tar_size, 1):>8.2f}{compress_time:>8.1f}s{decompress_time:>8.1f}s{total:>8.1f}s" for total, fmt, level, size, compress_time, decompress_time in sorted(results)]
+		write_ln()
+		write_ln(f'§7{header}')
+		for ln in lines: write_ln(ln)
+		log(f'\n[setup.py:PkgCompression.bench()] Compression of {len(tars)} packages ({size_str(tar_size)} uncompressed):\n{header}\n' + '\n'.join(lines))
+		return 0
+
+	# Run a (de)compressor from one file to another
+	# Returns: wall time (s)
+	@staticmethod
+	def run(cmd, src, dest):
+		started = time.monotonic()
+		with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+			subprocess.run(shlex.split(cmd), stdin=f_in, stdout=f_out, stderr=subprocess.DEVNULL)
+		return time.monotonic() - started
+
+# Compiler cache of AUR builds; kept on the package cache drive in a directory per CPU & compiler flags when present
+# so later installs start warm, with a size quota enforced by ccache evicting the least recently used entries
+
+class Ccache:
+	# Returns: cache directory e.g. '/pkgcache/ccache/intel_6-60-4-cflags' / '/home/aurhelper/.ccache' without the package cache
+	@staticmethod
+	def path():
+		if not pkgcache_enabled: return '/home/aurhelper/.ccache'
+		optimized = optimize_compilation and optimize_cached_pkgs # Same condition as the CFLAGS of AUR builds; see aur_setup()
+		return f"{ccache_dir}/{cpu_identifier}-{'cflags' if optimized else 'default'}"
+
+	# Returns: environment of commands building AUR packages e.g. 'export PATH=/usr/lib/ccache/bin:$PATH USE_CCACHE=1 CCACHE_DIR=...; '
+	@staticmethod
+	def env():
+		if not use_ccache: return ''
+		return f'export PATH=/usr/lib/ccache/bin:$PATH USE_CCACHE=1 CCACHE_DIR={Ccache.path()}; '
+
+	# Prepare the cache directory with the size quota & reset it's statistics for Ccache.report()
+	# Returns: amount of errors
+	@staticmethod
+	def setup():
+		path = Ccache.path()
+		errors = 0
+		if pkgcache_enabled: # Group writable so the aurhelper user of every install can use it
+			errors += Cmd.log(f'mkdir -p {path} && chgrp users {path} && chmod 2775 {path}')
+		errors += Cmd.log(f'$ umask 002 && {Ccache.env()}ccache --set-config=umask=002 && ccache -M {ccache_max_size} && ccache -z', 'aurhelper')
+		return errors
+
+	# Returns: statistics counters of the cache e.g. { 'direct_cache_hit': 120, 'cache_miss': 145, 'cache_size_kibibyte': 8400000, ... }
+	@staticmethod
+	def stats():
+		out = str(Cmd.output(f'CCACHE_DIR={Ccache.path()} ccache --print-stats', '', False))
+		stats = {}
+		for ln in out.split('\n'):
+			key, _, val = ln.partition('\t')
+			if val.strip().isdigit(): stats[key] = int(val)
+		return stats
+
+	# Show the hit rate of the install's builds & an estimate of the compiler output reused
+	#   >> [ INFO ] Compiler cache: 45% hit rate (120/265 compilations), ~1.2G reused, 8.1G/24G used
+	@staticmethod
+	def report():
+		stats = Ccache.stats()
+		hits = stats.get('direct_cache_hit', 0) + stats.get('preprocessed_cache_hit', 0)
+		total = hits + stats.get('cache_miss', 0)
+		if total == 0:
+			log('[setup.py:Ccache.report()] INFO: No compilations went through the compiler cache')
+			return
+		size = stats.get('cache_size_kibibyte', 0) * 1024
+		saved = hits * size // max(stats.get('files_in_cache', 0), 1) # Average size of a cached result
+		msg = f'Compiler cache: {100 * hits // total}% hit rate ({hits}/{total} compilations), ~{size_str(saved)} reused, {size_str(size)}/{ccache_max_size} used'
+		write_msg(msg, 5)
+		log(f'[setup.py:Ccache.report()] {msg}')
+
+# Background download of the official packages implied by config.py while partitioning & mounting
+# Packages are staged in prefetch_dir & moved to the package cache (or the new root's cache) once it's mounted
+# The download uses a copy of the sync databases so it never waits for or blocks other pacman transactions
+
+class Prefetch:
+	# Start downloading in the background
+	@staticmethod
+	def start():
+		global prefetch_thread
+		if prefetch_thread is not None or offline: return
+		prefetch_thread = threading.Thread(target=Prefetch.download, name='prefetch', daemon=True)
+		prefetch_thread.start()
+
+	# Wait for the background download to finish & move everything to the cache used by pacstrap
+	@staticmethod
+	def finish():
+		if prefetch_thread is None: return
+		if prefetch_thread.is_alive():
+			write_msg('Waiting for packages downloaded in the background, please wait...', 1)
+			prefetch_thread.join()
+			write_status()
+		Prefetch.migrate()
+
+	# Returns: official packages & groups implied by config.py e.g. ['base', 'linux', 'grub', ...]
+	# NOTE: This is only the bulk of them; anything missed is downloaded during the install as usual
+	@staticmethod
+	def pkgs():
+		pkgs = base_pkgs.split() + [kernel, f'{kernel}-headers', 'dkms', 'grub', 'openssh']
+		if len(users) > 0: pkgs.append('sudo')
+		if font.startswith('ter-'): pkgs.append('terminus-font')
+		if enable_aur: pkgs += ['pigz', 'base-devel', 'git'] + (['ccache'] if use_ccache else [])
+		if boot_mode == 'UEFI': pkgs.append('efibootmgr')
+		if hw.vm_env == '': pkgs.append(cpu_identifier.split('_', 1)[0] + '-ucode') # e.g. 'intel-ucode'
+		if use_networkmanager: pkgs.append('networkmanager')
+		if xorg_install_type == 1: pkgs += ['xorg-server', 'xorg-xinit', 'xf86-input-libinput']
+		elif xorg_install_type == 2: pkgs.append('xorg')
+		if use_pulseaudio: pkgs += ['pulseaudio', 'pulseaudio-alsa', 'alsa-utils', 'pamixer', 'gst-libav', 'gst-plugins-good']
+		if enable_printing: pkgs += ['avahi', 'nss-mdns', 'cups']
+		pkgs += prefetch_de_pkgs.get(de, '').split()
+
+		# Leave out names the sync databases don't know about as they would fail the whole download
+		db = PkgDb.get()
+		return [pkg for pkg in dict.fromkeys(pkgs) if db.info(pkg) is not None or len(db.group(pkg)) > 0]
+
+	# Returns: cache directory the packages should end up in e.g. '/mnt/pkgcache/pkgcache' / prefetch_dir until mounted
+	@staticmethod
+	def dest():
+		if pkgcache_enabled and os.path.ismount('/mnt/pkgcache'): return '/mnt/pkgcache/pkgcache'
+		if os.path.ismount('/mnt'): return '/mnt/var/cache/pacman/pkg'
+		return prefetch_dir
+
+	# Download packages in chunks, moving finished ones to the mounted cache in between
+	@staticmethod
+	def download():
+		db_path = f'{prefetch_dir}/db'
+		ret_val = Cmd.log(f'mkdir -p {db_path}/local && cp -r /var/lib/pacman/sync {db_path}/')
+		pkgs = Prefetch.pkgs() if ret_val == 0 else []
+		log(f'[setup.py:Prefetch.download()] INFO: Downloading {len(pkgs)} packages in the background')
+		for i in range(0, len(pkgs), prefetch_chunk):
+			Prefetch.migrate()
+			# Packages already in any of the caches aren't downloaded again
+			cache_dirs = dict.fromkeys([Prefetch.dest(), prefetch_dir, '/mnt/pkgcache/pkgcache', '/mnt/var/cache/pacman/pkg'])
+			cache_args = ' '.join(f'--cachedir {cache_dir}' for cache_dir in cache_dirs if os.path.isdir(cache_dir))
+			Cmd.log(f'pacman -Sw --noconfirm --noprogressbar --dbpath {db_path} {cache_args} {" ".join(pkgs[i:i + prefetch_chunk])}')
+		Prefetch.migrate()
+
+	# Move downloaded packages from the staging & previous caches to the current destination
+	@staticmethod
+	def migrate():
+		dest = Prefetch.dest()
+		if dest == prefetch_dir: return
+		os.makedirs(dest, exist_ok=True)
+		for src in (prefetch_dir, '/mnt/var/cache/pacman/pkg'):
+			if src == dest or not os.path.isdir(src): continue
+			f_names = [f_name for f_name in os.listdir(src) if '.pkg.tar.' in f_name and not f_name.endswith('.part')]
+			if len(f_names) > 0:
+				Cmd.log(f'cd {src} && mv -f {" ".join(f_names)} {dest}/')
+
+# Mirror ranking by time-to-first-byte & throughput of a small file probed from many mirrors at once
+# The ranking is saved with a timestamp & reused by installs within mirror_rank_max_age
+
+class Mirrors:
+	# Returns: base URLs of up-to-date HTTPS mirrors by their status score e.g. ['https://mirror.example.org/archlinux/', ...]
+	# / the servers of the current mirrorlist when the mirror status can't be fetched
+	@staticmethod
+	def candidates():
+		try:
+			with urllib.request.urlopen(mirror_status_url, timeout=10) as res:
+				status = json.load(res)
+			mirrors = [m for m in status['urls'] if m.get('protocol') == 'https' and m.get('active', True) and m.get('completion_pct') == 1 and m.get('score') is not None and m.get('delay') is not None and m['delay'] < 24 * 3600]
+			mirrors.sort(key=lambda m: m['score'])
+			return [m['url'] for m in mirrors[:mirror_candidates]]
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			log(f"[setup.py:Mirrors.candidates()] WARN: Couldn't fetch the mirror status, ranking the current mirrors instead: {e}")
+		urls = []
+		for f_path in ('/etc/pacman.d/mirrorlist.bak', '/etc/pacman.d/mirrorlist'):
+			try:
+				with open(f_path) as f: # e.g. 'Server = https://mirror.example.org/archlinux/$repo/os/$arch'
+					urls = [ln.split('=', 1)[1].strip().split('$repo')[0] for ln in f if ln.startswith('Server')]
+			except OSError:
+				continue
+			if len(urls) > 0: break
+		return urls[:mirror_candidates]
+
+	# Returns: mirrors which responded ordered from the fastest e.g. [{ 'url': 'https://...', 'ttfb': 0.08, 'rate': 2400000 }, ...]
+	@staticmethod
+	def rank(urls):
+		if len(urls) == 0: return []
+		with concurrent.futures.ThreadPoolExecutor(min(len(urls), 16)) as pool:
+			results = [res for res in pool.map(Mirrors.probe, urls) if res is not None]
+		results.sort(key=lambda res: (-res['rate'], res['ttfb']))
+		log(f'[setup.py:Mirrors.rank()] INFO: {len(results)}/{len(urls)} mirrors responded; fastest: ' + ', '.join(f"{res['url']} ({size_str(res['rate'])}/s)" for res in results[:3]))
+		return results[:mirror_count]
+
+	# Download the probe file from a mirror
+	# Returns: dict with the time-to-first-byte (s) & throughput (bytes/s) e.g. { 'url': 'https://...', 'ttfb': 0.08, 'rate': 2400000 } / None on errors
+	@staticmethod
+	def probe(url):
+		started = time.monotonic()
+		try:
+			with urllib.request.urlopen(url + mirror_probe_path, timeout=mirror_probe_timeout) as res:
+				size = len(res.read(1))
+				ttfb = time.monotonic() - started
+				size += len(res.read())
+		except (OSError, ValueError):
+			return None
+		elapsed = max(time.monotonic() - started, 0.001)
+		return { 'url': url, 'ttfb': round(ttfb, 3), 'rate': int(size / elapsed) }
+
+	# Returns: paths a ranking is saved in, preferring the package cache over the new root
+	@staticmethod
+	def paths():
+		paths = ['/mnt/pkgcache/pkgcache/mirror-ranking.json'] if pkgcache_enabled and os.path.ismount('/mnt/pkgcache') else []
+		return paths + ['/mnt/var/cache/pacman/mirror-ranking.json']
+
+	# Returns: saved ranking e.g. { 'time': 1589000000.0, 'mirrors': [...] } / None when there's no fresh one
+	@staticmethod
+	def load():
+		for f_path in Mirrors.paths():
+			try:
+				with open(f_path) as f:
+					ranking = json.load(f)
+				if time.time() - ranking['time'] < mirror_rank_max_age and len(ranking['mirrors']) > 0:
+					return ranking
+			except (OSError, ValueError, KeyError, TypeError):
+				pass
+		return None
+
+	# Save a ranking with the current time; see Mirrors.load()
+	@staticmethod
+	def save(mirrors):
+		f_path = Mirrors.paths()[0]
+		try:
+			os.makedirs(os.path.dirname(f_path), exist_ok=True)
+			with open(f'{f_path}.tmp', 'w') as f:
+				json.dump({ 'time': time.time(), 'mirrors': mirrors }, f, separators=(',', ':'))
+			os.replace(f'{f_path}.tmp', f_path)
+		except OSError:
+			log(f"[setup.py:Mirrors.save()] WARN: Couldn't save the mirror ranking to '{f_path}'")
+
+	# Write ranked mirrors to the mirrorlist
+	# Returns: 0 = Success, 1 = Error
+	@staticmethod
+	def write(mirrors):
+		text = '# Ranked by setup.py; fastest first\n' + ''.join(f"Server = {m['url']}$repo/os/$arch\n" for m in mirrors)
+		return IO.write('/etc/pacman.d/mirrorlist', text)
+
+	# Returns: age of a saved ranking e.g. '25m' / '3h'
+	@staticmethod
+	def age_str(ranking):
+		age = int(time.time() - ranking['time'])
+		return f'{age // 3600}h' if age >= 3600 else f'{age // 60}m'
+
 # Command execution
 
+# Long-lived bash process that runs commands sent over a pipe, reporting exit codes after a sentinel
+class Shell:
+	# Start a worker shell for root or 'exec_user'
+	def __init__(self, exec_user=''):
+		self.user = exec_user
+		self.token = f'__setup.py_{os.getpid()}_{random.randint(100000, 999999)}__' # Marks the end of command output
+		args = ['sudo', '-i', '-u', exec_user, '-H', 'bash'] if len(exec_user) > 0 else ['bash']
+		self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', errors='replace')
+		self.child_times = (0.0, 0.0) # Total user & sys CPU time of finished commands
+		self.pid = self.proc.pid # bash PID for resource accounting (differs from the sudo PID of user shells)
+		self.proc.stdin.write(f'echo "{self.token} $$"\n')
+		self.proc.stdin.flush()
+		for line in self.proc.stdout: # Skip possible login shell output
+			if line.startswith(self.token):
+				self.pid = int(line.split(' ')[1])
+				break
+
+	# Run a command in a subshell of the worker to keep 'cd', 'exit' etc. from affecting later commands
+	# io_stream_type: see Cmd.exec(); output is appended to 'log_path' when defined for io_stream_type=2
+	# Returns: (exit code, captured stdout, resource usage; see Cmd.run()) / None if the worker died
+	def run(self, cmd, io_stream_type, log_path=''):
+		redirect = {
+				1: '2>/dev/null',
+				2: f'&>>{log_path}' if len(log_path) > 0 else '&>/dev/null',
+				3: '&>/dev/null'
+		}.get(io_stream_type)
+		try:
+			io_before = Cmd.proc_io(self.pid)
+			# Reaped subshells add to the CPU time reported by 'times' & the worker's /proc/<pid>/io
+			# eval makes a syntax error (e.g. an unterminated quote) a non-zero exit instead of bash waiting for the rest of it
+			self.proc.stdin.write(f'(eval {shlex.quote(cmd)}) </dev/null {redirect}\nprintf "\\n{self.token} %d\\n" $?; times\n')
+			self.proc.stdin.flush()
+			out = []
+			for line in self.proc.stdout:
+				if line.startswith(self.token): # e.g. '__setup.py_123_456789__ 0'
+					ret_val = line.split(' ')[1]
+					self.proc.stdout.readline() # Worker shell's own times
+					times = re.findall(r'(\d+)m([\d.]+)s', self.proc.stdout.readline()) # e.g. '0m1.520s 0m0.310s'
+					utime, stime = [int(m) * 60 + float(sec) for m, sec in times]
+					usage = Cmd.usage(utime - self.child_times[0], stime - self.child_times[1], io_before, Cmd.proc_io(self.pid))
+					self.child_times = (utime, stime)
+					return (int(ret_val), ''.join(out)[:-1], usage) # Strip the sentinel's leading '\n'
+				out.append(line)
+		except (OSError, ValueError):
+			pass
+		self.stop()
+		return None
+
+	# Stop the worker shell
+	def stop(self):
+		try:
+			self.proc.stdin.close()
+			self.proc.wait(5)
+		except:
+			self.proc.kill()
+
+	# Run a command on an idle worker shell of 'exec_user', starting a new one when required
+	# Returns: subprocess.CompletedProcess / None when no worker could run the command
+	@staticmethod
+	def exec(cmd, exec_user, io_stream_type, log_path=''):
+		idle = shell_workers.setdefault(exec_user, [])
+		try: shell = idle.pop() # Atomic even when setup phases run concurrently
+		except IndexError: shell = None
+		if shell is None:
+			try: shell = Shell(exec_user)
+			except OSError: return None
+		res = shell.run(cmd, io_stream_type, log_path)
+		if res is None: return None
+		idle.append(shell)
+		ret = subprocess.CompletedProcess(cmd, res[0], res[1] if io_stream_type == 1 else None)
+		ret.usage = res[2]
+		return ret
+
+	# Stop all worker shells or only the ones of 'exec_user' e.g. before deleting the user
+	@staticmethod
+	def stop_all(exec_user=None):
+		for user, idle in shell_workers.items():
+			if exec_user is None or user == exec_user:
+				for shell in idle: shell.stop()
+				idle.clear()
+
 class Cmd:
 	# Run a command on the shell with an optional io stream
 	# io_stream_type: 0 = none, 1 = stdout, 2 = logged, 3 = all_supressed
 	# Returns: command exit code / output when io_stream_type=2
 	@staticmethod
 	def exec(cmd, exec_user='', log_cmd=True, io_stream_type=0):
+		if dry_run is not None:
+			if log_cmd: log(f'\n# (dry run) {cmd}')
+			return '' if io_stream_type == 1 else 0
+
+		# Planned packages must be installed before anything else that might depend on them runs
+		if Pkg.planning() and Pkg.defer_cmd(cmd, exec_user, io_stream_type):
+			return 0
+
 		user_exec = cmd.startswith('$ ')
 		exec_cmd = cmd
 
@@ -462,7 +2221,7 @@ class Cmd:
 				exec_user = users.split(',')[0]
 			cmd = cmd[2:] # Remove '$ ' from user_exec commands
 			if len(exec_user) > 0:
-				exec_cmd = f"sudo -i -u {exec_user} -H bash -c '{cmd}'"
+				exec_cmd = f"sudo -i -u {exec_user} -H bash -c {shlex.quote(cmd)}"
 			else:
 				log(f"[setup.py:Cmd.exec({str(io_stream_type)})] WARN: Ignoring '{cmd}' execution, since no user was defined.")
 				return 1
@@ -475,18 +2234,40 @@ class Cmd:
 		if log_cmd and io_stream_type % 2 == 0: # Log executed command line ()
 			start = '# ' + (f'({exec_user}) $ ' if user_exec else '')
 			log(f'\n{start}{cmd}') # e.g. '# pacman -Syu'
+		if logged or 'setup.log' in cmd: Log.flush() # Keep the order of records & command output
 
-		end = ''
+		end, log_path = ('', '')
 		if suppress or logged:
 			path = '' if in_chroot else '/tmp'
 			log_path = f'{path}/setup.log' # e.g. '/tmp/setup.log' or '/setup.log' in chroot
 			#end = ' &>>' + (log_path if (logged and log_cmd) else '/dev/null')
 			end = ' ' + f'&>>{log_path}' if logged and log_cmd else '&>/dev/null'
 
-		cmd = exec_cmd + end
-		# TODO Log cmd line when debugging
-		if use_stdout: res = subprocess.run(cmd, shell=True, encoding='utf-8', capture_output=use_stdout)
-		else: res = subprocess.run(cmd, shell=True)
+		shown_cmd = (f'({exec_user}) $ ' if user_exec else '') + cmd # e.g. '(aurhelper) $ yay -Sq polybar'
+		started = time.time()
+
+		# Only one pacman transaction or package installing AUR build may run at a time when setup phases run concurrently
+		# (commands using their own database like background downloads don't count)
+		pacman_lock = named_lock('pacman') if Cmd.uses_pacman(cmd) else None
+		if pacman_lock is not None: pacman_lock.acquire()
+		try:
+			if pacman_lock is not None and PacmanHooks.deferring(): PacmanHooks.sync() # Transactions may install new hooks to defer
+			# Plain command line => run it without a shell, otherwise reuse a persistent shell when the output isn't meant for the terminal
+			res, backend = (None, '')
+			argv = None if user_exec else Cmd.argv(cmd)
+			if argv is not None:
+				res, backend = (Cmd.run(argv, io_stream_type, log_path if logged and log_cmd else ''), 'argv')
+			elif use_worker_shells and io_stream_type > 0:
+				res, backend = (Shell.exec(cmd, exec_user if user_exec else '', io_stream_type, log_path if logged and log_cmd else ''), 'worker')
+
+			cmd = exec_cmd + end
+			# TODO Log cmd line when debugging
+			if res is None:
+				res, backend = (Cmd.run(cmd, 1 if use_stdout else 0, '', True), 'shell')
+		finally:
+			if pacman_lock is not None: pacman_lock.release()
+
+		Stats.record(shown_cmd, backend, started, time.time() - started, res)
 
 		if log_cmd and io_stream_type % 2 == 0 and res.returncode != 0:
 			log(f'\n# Command non-zero exit code: {res.returncode}')
@@ -494,6 +2275,118 @@ class Cmd:
 		returns = res.stdout if use_stdout else res.returncode
 		return returns
 
+	# Split a command line into arguments when it doesn't need a shell i.e. no pipes, redirections,
+	# globbing, variables, builtins etc.; quoted arguments are fine
+	# Returns: list of arguments e.g. ['systemctl', 'enable', 'sddm'] / None when a shell is needed
+	@staticmethod
+	def argv(cmd):
+		quote = ''
+		for c in cmd:
+			if quote == "'": # Everything is literal until the closing quote
+				if c == "'": quote = ''
+			elif quote == '"':
+				if c == '"': quote = ''
+				elif c in '$`\\!': return None
+			elif c in '\'"':
+				quote = c
+			elif c in '|&;<>()$`\\*?[]{}~#!\n':
+				return None
+		if len(quote) > 0: return None
+		try:
+			argv = shlex.split(cmd)
+		except ValueError:
+			return None
+		if len(argv) == 0 or '=' in argv[0] or argv[0] in shell_builtins: # e.g. 'LANG=C ls', 'cd /tmp'
+			return None
+		return argv
+
+	# Split a command line into the programs it runs, skipping env assignments & wrappers like 'sudo'
+	# Returns: list of programs with their arguments incl. redirection targets / None when it can't be parsed
+	# e.g. [['pacman', '-Qq'], ['grep', 'eog']] for 'LANG=C pacman -Qq | grep eog'
+	@staticmethod
+	def programs(cmd):
+		lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+		lexer.whitespace_split = True
+		try:
+			tokens = list(lexer)
+		except ValueError:
+			return None
+		progs, words = ([], [])
+		for token in tokens + [ ';' ]:
+			if token in ('|', '||', '&&', ';', ';;', '&', '(', ')'):
+				if len(words) > 0: progs.append(words)
+				words = []
+			elif set(token) <= set('<>&|'): # Redirection e.g. '>>', '&>'
+				continue
+			elif len(words) > 0 or not (re.match(r'^\w+=', token) or token in ('sudo', 'exec', 'command', 'time', 'nice', 'env')):
+				words.append(token)
+		return progs
+
+	# Returns: Boolean representing whether a command line runs a pacman transaction or a package installing AUR build
+	# e.g. True for 'pacman -S vim' & 'makepkg -si' but not for "sed -i '...' /etc/pacman.conf" or background downloads using their own database
+	@staticmethod
+	def uses_pacman(cmd):
+		progs = Cmd.programs(cmd)
+		if progs is None: return re.search(r'\b(pacman|yay|makepkg)\b', cmd) is not None # Unbalanced quotes => better safe than sorry
+		for words in progs:
+			prog, args = (os.path.basename(words[0]), words[1:])
+			if '--dbpath' in args or any(arg.startswith('--dbpath=') for arg in args): continue
+			if prog in ('pacman', 'yay'): return True
+			if prog == 'makepkg' and any(re.match(r'^(-\w*[si]\w*|--(syncdeps|install))$', arg) for arg in args): return True
+		return False
+
+	# Run a list of arguments (or a command line on the shell) with the output redirected by Python
+	# io_stream_type: see Cmd.exec(); output is appended to 'log_path' when defined for io_stream_type=2
+	# Returns: subprocess.CompletedProcess including resource usage as 'usage'; see Cmd.usage()
+	@staticmethod
+	def run(args, io_stream_type=0, log_path='', shell=False):
+		out = open(log_path, 'a') if len(log_path) > 0 else None
+		stdout, stderr = (out, out) if out is not None else (None, None)
+		if io_stream_type == 1: stdout, stderr = (subprocess.PIPE, subprocess.DEVNULL)
+		elif io_stream_type > 0 and out is None: stdout, stderr = (subprocess.DEVNULL, subprocess.DEVNULL)
+		try:
+			try:
+				proc = subprocess.Popen(args, shell=shell, stdout=stdout, stderr=stderr, encoding='utf-8', errors='replace')
+			except OSError as e: # Mimic the shell e.g. 127 = command not found
+				prog = args[0] if isinstance(args, list) else (args.split() or [ args ])[0] # e.g. 'ls' of 'ls -l'
+				if out is not None: out.write(f'{prog}: {e.strerror}\n')
+				ret_val = 127 if isinstance(e, FileNotFoundError) else 126
+				return subprocess.CompletedProcess(args, ret_val, '' if io_stream_type == 1 else None)
+			output = proc.stdout.read() if io_stream_type == 1 else None
+			io_after = None
+			try: # Keep the exited child around to read its I/O counters before reaping it
+				os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+				io_after = Cmd.proc_io(proc.pid)
+			except OSError:
+				pass
+			status, rusage = os.wait4(proc.pid, 0)[1:]
+			proc.returncode = os.waitstatus_to_exitcode(status)
+			if proc.stdout is not None: proc.stdout.close()
+		finally:
+			if out is not None: out.close()
+		res = subprocess.CompletedProcess(args, proc.returncode, output)
+		res.usage = Cmd.usage(rusage.ru_utime, rusage.ru_stime, {}, io_after)
+		return res
+
+	# Returns: I/O counters of a process e.g. { 'read_bytes': 4096, 'write_bytes': 0, ... } / None if unavailable
+	@staticmethod
+	def proc_io(pid):
+		try:
+			with open(f'/proc/{pid}/io') as f:
+				return { key: int(val) for key, val in (line.split(': ') for line in f) }
+		except (OSError, ValueError):
+			return None
+
+	# Returns: resource usage of a command e.g. { 'utime': 1.2, 'stime': 0.3, 'read_bytes': 4096, 'write_bytes': None }
+	# I/O byte counts are None when the counters weren't available
+	@staticmethod
+	def usage(utime, stime, io_before=None, io_after=None):
+		usage = { 'utime': round(utime, 3), 'stime': round(stime, 3), 'read_bytes': None, 'write_bytes': None }
+		if io_before is not None and io_after is not None:
+			for key in ('read_bytes', 'write_bytes'):
+				usage[key] = io_after.get(key, 0) - io_before.get(key, 0)
+		return usage
+
 	# Run a command on the shell while capturing all it's output
 	# New lines are seperated with a '\n'
 	# Returns: command exit code
@@ -520,6 +2413,77 @@ class Cmd:
 		ret_val = Cmd.suppress(f'type {cmd}') # command -v
 		return (ret_val == 0)
 
+# Resource accounting of executed commands
+
+class Stats:
+	# Returns: path of the stats file next to the setup log e.g. '/tmp/setup-stats.jsonl'
+	@staticmethod
+	def path():
+		return ('' if in_chroot else '/tmp') + '/setup-stats.jsonl'
+
+	# Record the wall time, CPU time & I/O of a command as a line of JSON in the stats file
+	@staticmethod
+	def record(cmd, backend, started, wall, res):
+		if not record_stats: return
+		usage = getattr(res, 'usage', Cmd.usage(0, 0))
+		entry = { 'time': round(started, 3), 'cmd': cmd, 'backend': backend, 'ret': res.returncode, 'wall': round(wall, 3) }
+		entry.update(usage)
+		global stats_file
+		with stats_lock:
+			try:
+				if stats_file is None: stats_file = open(Stats.path(), 'a')
+				stats_file.write(json.dumps(entry) + '\n')
+			except OSError:
+				pass
+
+	# Write everything buffered & close the stats file; it's reopened by the next record
+	@staticmethod
+	def close():
+		global stats_file
+		with stats_lock:
+			if stats_file is None: return
+			try: stats_file.close()
+			except OSError: pass
+			stats_file = None
+
+	# Append the commands recorded on the live environment (e.g. pacstrap, partitioning & mirror ranking)
+	# to the chroot's stats file, so the summary at the end of the install covers them as well
+	# Returns: 0 = Success, 1 = Error
+	@staticmethod
+	def share(sys_root='/mnt/'):
+		Stats.close()
+		try:
+			with open(Stats.path()) as src, open(f'{sys_root}setup-stats.jsonl', 'a') as dest:
+				shutil.copyfileobj(src, dest)
+		except FileNotFoundError:
+			return 0
+		except OSError:
+			return 1
+		return 0
+
+	# Print a summary of the slowest recorded commands
+	#   >> [ INFO ] Slowest steps (1204 commands took 842s):
+	#         210.4s  cpu   98.2s  r/w 1.2G/3.4G  pacman -S --noconfirm ...
+	@staticmethod
+	def print_slowest(count=10):
+		Stats.close()
+		try:
+			with open(Stats.path()) as f:
+				entries = [json.loads(line) for line in f if len(line.strip()) > 0]
+		except (OSError, ValueError):
+			return
+		if len(entries) == 0: return
+		total = sum(entry['wall'] for entry in entries)
+		entries.sort(key=lambda entry: entry['wall'], reverse=True)
+		write_msg(f'Slowest steps ({len(entries)} commands took {total:.0f}s):', 5)
+		log(f'\n[setup.py:Stats.print_slowest()] Slowest steps ({len(entries)} commands took {total:.0f}s):')
+		for entry in entries[:count]:
+			cpu = entry['utime'] + entry['stime']
+			details = f"{entry['wall']:8.1f}s  cpu {cpu:6.1f}s  r/w {size_str(entry['read_bytes'])}/{size_str(entry['write_bytes'])}"
+			cmd = entry['cmd'].replace('\n', ' ')
+			write_ln(f'   §7{details}  §0{cmd[:60]}' + ('...' if len(cmd) > 60 else ''))
+			log(f'{details}  {cmd}')
+
 # Checking user details
 
 class User:
@@ -566,6 +2530,607 @@ class User:
 
 		return unres_users_lst
 
+# Hardware details probed from /proc & /sys in-process instead of parsing command output
+
+class HardwareInfo:
+	# Probe all hardware details once or restore them from a snapshot; see HardwareInfo.to_dict()
+	# PCI device names are only looked up when needed
+	def __init__(self, details=None):
+		self.cpu_vendor = ''            # 'intel' / 'amd'
+		self.cpu_family = ''            # CPU family number e.g. '6'
+		self.cpu_model = ''             # CPU model number e.g. '60'
+		self.cpu_cores = 0              # Amount of logical CPUs e.g. 4
+		self.hypervisor = False         # Running virtualized?
+		self.vm_env = ''                # Virtualized env: '','vbox','vmware','qemu','other'
+		self.dmi = {}                   # DMI strings e.g. { 'board_name': 'Z270N-WIFI', 'chassis_vendor': 'QEMU', ... }
+		self.pci = []                   # PCI devices e.g. [ { 'slot': '0000:01:00.0', 'class': '030000', 'vendor': '10de', 'device': '13c2' } ]
+		self.usb_classes = set()        # USB interface classes e.g. { 'e0/01/01', '0e/01/00' }
+		self.bat_present = False        # Any battery present?
+		self.disc_tray_present = False  # Any disc tray present?
+		self.camera_present = False     # Any camera device present?
+		self.bt_present = False         # Any BT device present?
+		self.wifi_present = False       # Any PCI(e) Wi-Fi card present?
+		self.backlight_present = False  # Any controllable display backlight present?
+		self.pci_names = None           # Vendor & device names from the PCI ID database; see HardwareInfo.names()
+		self.gpu_list = None            # GPU descriptions of a restored snapshot
+
+		if details is not None:
+			for key, val in details.items(): setattr(self, key, val)
+			self.usb_classes = set(self.usb_classes)
+			return
+
+		self.probe_cpu()
+		self.probe_buses()
+		self.probe_devices()
+
+	# Read /proc/cpuinfo
+	def probe_cpu(self):
+		cpuinfo = HardwareInfo.read('/proc/cpuinfo') or ''
+		self.cpu_vendor = 'intel' if 'intel' in cpuinfo.lower() else 'amd'
+		for line in cpuinfo.split('\n'):
+			key, val = [part.strip() for part in (line.split(':', 1) + [''])[:2]] # e.g. 'cpu family', '6'
+			if key == 'processor': self.cpu_cores += 1
+			elif key == 'cpu family' and self.cpu_family == '': self.cpu_family = val
+			elif key == 'model' and self.cpu_model == '': self.cpu_model = val
+			elif key == 'flags' and 'hypervisor' in val.split(): self.hypervisor = True
+
+	# Read DMI strings & the vendor/device IDs of PCI devices & USB interfaces
+	def probe_buses(self):
+		for key in ('board_name', 'chassis_vendor', 'product_name', 'sys_vendor'):
+			val = HardwareInfo.read(f'/sys/devices/virtual/dmi/id/{key}')
+			if val is not None and len(val) > 0: self.dmi[key] = val
+
+		pci_path = '/sys/bus/pci/devices'
+		for slot in HardwareInfo.list_dir(pci_path):
+			dev = { 'slot': slot }
+			for key in ('class', 'vendor', 'device'):
+				dev[key] = (HardwareInfo.read(f'{pci_path}/{slot}/{key}') or '0x')[2:] # e.g. '0x10de' => '10de'
+			self.pci.append(dev)
+
+		usb_path = '/sys/bus/usb/devices'
+		for dev in HardwareInfo.list_dir(usb_path):
+			if ':' not in dev: continue # Only interfaces e.g. '1-1:1.0'
+			usb_class = [ HardwareInfo.read(f'{usb_path}/{dev}/bInterface{key}') for key in ('Class', 'SubClass', 'Protocol') ]
+			if None not in usb_class: self.usb_classes.add('/'.join(usb_class))
+
+	# Detect device presence from /sys/class & the probed bus details
+	def probe_devices(self):
+		self.bat_present = any('bat' in dev.lower() for dev in HardwareInfo.list_dir('/sys/class/power_supply'))
+
+		# SCSI optical drives & anything else registered by the cdrom driver
+		cdrom_info = re.search(r'^drive name:(.*)$', HardwareInfo.read('/proc/sys/dev/cdrom/info') or '', re.M)
+		self.disc_tray_present = any(dev.startswith('sr') for dev in HardwareInfo.list_dir('/sys/class/block')) \
+			or (cdrom_info is not None and len(cdrom_info.group(1).strip()) > 0)
+
+		self.camera_present = len(HardwareInfo.list_dir('/sys/class/video4linux')) > 0 \
+			or any(usb_class.startswith('0e/') for usb_class in self.usb_classes) # USB video class
+
+		# TODO Check for false-positives
+		rfkill_bt = any(HardwareInfo.read(f'/sys/class/rfkill/{dev}/type') == 'bluetooth' for dev in HardwareInfo.list_dir('/sys/class/rfkill'))
+		self.bt_present = rfkill_bt or len(HardwareInfo.list_dir('/sys/class/bluetooth')) > 0 \
+			or 'e0/01/01' in self.usb_classes or any(dev['class'].startswith('0d11') for dev in self.pci)
+
+		self.wifi_present = any(dev['class'].startswith('0280') for dev in self.pci) # Network controller
+		self.backlight_present = len(HardwareInfo.list_dir('/sys/class/backlight')) > 0
+
+		# Try & identify the VM platform
+		if self.hypervisor:
+			self.vm_env = 'other'
+			if self.dmi.get('board_name') == 'VirtualBox':
+				self.vm_env = 'vbox'
+			elif self.dmi.get('chassis_vendor') == 'QEMU':
+				self.vm_env = 'qemu'
+			elif self.dmi.get('product_name', '').startswith('VMware'): # e.g. 'VMware7,1'
+				self.vm_env = 'vmware'
+
+	# Returns: CPU identifier e.g. 'intel_6-60-4'
+	def cpu_identifier(self):
+		return f'{self.cpu_vendor}_{self.cpu_family}-{self.cpu_model}-{self.cpu_cores}'
+
+	# Returns: Boolean representing whether a PCI device from 'vendor' (and optionally of 'device') is present e.g. '14e4', '43b1'
+	def has_pci(self, vendor, device=''):
+		return any(dev['vendor'] == vendor and device in ('', dev['device']) for dev in self.pci)
+
+	# Returns: descriptions of all display controllers similar to 'lspci -nn'
+	# e.g. [ '0000:01:00.0 NVIDIA Corporation GM204 [GeForce GTX 970] [10de:13c2]' ]
+	def gpus(self):
+		if self.gpu_list is not None: return self.gpu_list
+		names = self.names()
+		gpus = []
+		for dev in self.pci:
+			if not dev['class'].startswith('03'): continue # Display controller
+			vendor = names.get(dev['vendor'], pci_vendors.get(dev['vendor'], ''))
+			device = names.get((dev['vendor'], dev['device']), '')
+			gpus.append(' '.join(part for part in (dev['slot'], vendor, device, f"[{dev['vendor']}:{dev['device']}]") if len(part) > 0))
+		return gpus
+
+	# Look up the vendor & device names of the present PCI devices from pci.ids
+	# Returns: names e.g. { '10de': 'NVIDIA Corporation', ('10de', '13c2'): 'GM204 [GeForce GTX 970]' }
+	def names(self):
+		if self.pci_names is not None: return self.pci_names
+		ids = set((dev['vendor'], dev['device']) for dev in self.pci)
+		vendors = set(vendor for vendor, device in ids)
+		self.pci_names = {}
+		try:
+			with open(pci_ids_path, encoding='utf-8', errors='replace') as f:
+				vendor = ''
+				for line in f: # e.g. '10de  NVIDIA Corporation' & '\t13c2  GM204 [GeForce GTX 970]'
+					if line.startswith('#') or len(line.strip()) == 0: continue
+					if line.startswith('C '): break # Device classes follow the vendors
+					if line[0] != '\t':
+						vendor = line[:4]
+						if vendor in vendors: self.pci_names[vendor] = line[4:].strip()
+					elif line[1] != '\t' and (vendor, line[1:5]) in ids:
+						self.pci_names[(vendor, line[1:5])] = line[5:].strip()
+		except OSError:
+			log(f"[setup.py:HardwareInfo.names()] WARN: Couldn't read PCI device names from '{pci_ids_path}'")
+		return self.pci_names
+
+	# Returns: all details as a JSON compatible dict including the GPU descriptions
+	def to_dict(self):
+		details = { key: val for key, val in vars(self).items() if key != 'pci_names' }
+		details['usb_classes'] = sorted(self.usb_classes)
+		details['gpu_list'] = self.gpus()
+		return details
+
+	# Returns: contents of a /proc or /sys file without surrounding whitespace / None on error
+	@staticmethod
+	def read(f_path):
+		try:
+			with open(f_path, 'r', errors='replace') as f:
+				return f.read().strip()
+		except OSError:
+			return None
+
+	# Returns: sorted entries of a directory / [] when it doesn't exist
+	@staticmethod
+	def list_dir(path):
+		try: return sorted(os.listdir(path))
+		except OSError: return []
+
+# Install plan dry run ('--plan'): the install steps enabled by config.py run against the detected hardware
+# without side effects (commands, file writes & package operations are only collected), after which the
+# resolved package set is shown with it's sizes, what's already cached & an install time estimate e.g.
+#   >> [ INFO ] Repository packages: 812 (240 cached), download 512.4M of 1.2G, installed 4.8G
+# The repositories are set up & refreshed in a temporary copy of the pacman config & databases; see DryRun.isolate()
+# Throughput of earlier installs is recorded to plan_history_fn in the package cache; see DryRun.record()
+
+class DryRun:
+	# Run the install steps collecting their package operations
+	# A step exiting (e.g. exit(12)) would abort the install, so the remaining steps aren't evaluated
+	# Returns: collected packages e.g. { 'repo': ['base', 'grub', ...], 'aur': ['yay-bin'], 'remove': [], 'failed': ['vga'], 'aborted': None }
+	# ('aborted' is the step & exit code e.g. ('bootloader', 12) when a step exited)
+	@staticmethod
+	def run():
+		global dry_run
+		load_hw_info() # As done in chroot
+		pkgs = (base_pkgs + ' ' + base_extra_pkgs()).split()
+		steps = [('services', services_setup)] + [(name, func) for name, func, deps, locks in setup_phases() if name not in ('repos', 'configs_fetch')]
+		if bat_present: steps.append(('battery', battery_setup))
+		if run_custom_setup: steps.append(('custom', custom_setup))
+
+		dry_run = { 'repo': pkgs, 'aur': [], 'remove': [], 'failed': [], 'aborted': None }
+		thread_output.buffer = [] # The steps' status messages aren't shown
+		try:
+			for name, func in steps:
+				try:
+					func()
+				except SystemExit as e:
+					log(f"[setup.py:DryRun.run()] ERROR: Step '{name}' would abort the install with exit code {e.code}")
+					dry_run['aborted'] = (name, e.code)
+					break
+				except Exception as e: # e.g. parsing output of a command that wasn't run
+					log(f"[setup.py:DryRun.run()] WARN: Step '{name}' couldn't be fully evaluated: {e!r}")
+					dry_run['failed'].append(name)
+		finally:
+			thread_output.buffer = None
+			collected, dry_run = (dry_run, None)
+		return collected
+
+	# Use a temporary copy of the pacman config & sync databases (the package cache's snapshot when offline)
+	# for the repository setup & database refreshes of '--plan'; see Pkg.refresh_dbs()
+	# Returns: 0 = Success, 1 = No databases to start from
+	@staticmethod
+	def isolate():
+		global pacman_conf, pacman_db_path
+		sync_dir = f'{Pkg.cache_dir()}/sync' if offline else '/var/lib/pacman/sync'
+		shutil.rmtree(plan_dir, True)
+		os.makedirs(f'{plan_dir}/db/local')
+		os.makedirs(f'{plan_dir}/db/sync')
+		shutil.copy('/etc/pacman.conf', f'{plan_dir}/pacman.conf')
+		pacman_conf, pacman_db_path = (f'{plan_dir}/pacman.conf', f'{plan_dir}/db')
+		if offline: # Repositories enabled by repos_setup() are refreshed from the snapshot as well; see Pkg.offline_dbs()
+			IO.write(f'{plan_dir}/mirrorlist', f'Server = file://{sync_dir}\n')
+			IO.replace_ln(pacman_conf, 'Include = /etc/pacman.d/mirrorlist', f'Include = {plan_dir}/mirrorlist', False)
+		dbs = Pkg.sync_dbs(sync_dir, f'{pacman_db_path}/sync')
+		for src, dest in dbs: shutil.copy2(src, dest) # Unchanged databases aren't downloaded again
+		if offline and len(dbs) == 0:
+			log(f"[setup.py:DryRun.isolate()] ERROR: No cached package databases found in '{sync_dir}'")
+			return 1
+		return 0
+
+	# Register packages of an install step instead of installing / removing them
+	# kind: 'repo', 'aur' or 'remove'
+	# Returns: 0
+	@staticmethod
+	def add(kind, pkgs):
+		dry_run[kind].extend(pkg for pkg in pkgs.split() if not pkg.startswith('-') and '/' not in pkg) # e.g. no '--asdeps' or local files
+		return 0
+
+	# Resolve repository packages, groups & provided names along with all their dependencies
+	# Returns: dict of the packages & names which couldn't be found e.g. ({ 'grub': { 'repo': 'core', ... } }, ['foo'])
+	@staticmethod
+	def resolve(names):
+		db = PkgDb.get()
+		pkgs, missing, queue = ({}, [], list(dict.fromkeys(names)))
+		while len(queue) > 0:
+			name = queue.pop(0)
+			if name in pkgs or name in missing: continue
+			info = db.info(name)
+			if info is not None:
+				pkgs[name] = info
+				queue += [re.split(r'[<>=]', dep, 1)[0] for dep in info['depends']] # e.g. 'glibc>=2.27' => 'glibc'
+				continue
+			members, providers = (db.group(name), db.providers(name))
+			if len(members) > 0: queue += members
+			elif len(providers) > 0:
+				if not any(provider in pkgs for provider in providers): queue.append(providers[0])
+			else: missing.append(name)
+		return (pkgs, missing)
+
+	# Returns: names & versions of the package files in a cache directory e.g. { ('grub', '2:2.04-8'), ... }
+	@staticmethod
+	def cached(path):
+		return set(AurCache.parse(f_name) for f_name in HardwareInfo.list_dir(path))
+
+	# Returns: path of the install history in the package cache e.g. '/mnt/pkgcache/pkgcache/install-history.jsonl'
+	@staticmethod
+	def history_path():
+		return f'{Pkg.cache_dir()}/{plan_history_fn}'
+
+	# Record the installed size & wall time of the finished install for estimates of later ones
+	@staticmethod
+	def record():
+		if not pkgcache_enabled or not os.path.isdir(Pkg.cache_dir()): return
+		pkgs = PkgDb.get().local.rows('pkgs')
+		entry = { 'time': round(time.time(), 3), 'pkgs': len(pkgs), 'isize': sum(int(row[2]) for row in pkgs), 'wall': round(time.time() - install_started, 3) }
+		IO.write_ln(DryRun.history_path(), json.dumps(entry, separators=(',', ':')))
+
+	# Returns: installed bytes per second of the recent installs & the amount of them used e.g. (5200000, 3) / (0, 0) without history
+	@staticmethod
+	def throughput():
+		try:
+			with open(DryRun.history_path()) as f:
+				entries = [json.loads(ln) for ln in f if len(ln.strip()) > 0][-plan_history_len:]
+		except (OSError, ValueError):
+			return (0, 0)
+		wall = sum(entry['wall'] for entry in entries)
+		return (int(sum(entry['isize'] for entry in entries) / wall), len(entries)) if wall > 0 else (0, 0)
+
+	# Show the resolved package set of the install with it's sizes & estimated install time
+	# Returns: 0 / exit code of a step that would abort the install
+	@staticmethod
+	def report():
+		write_msg('Evaluating the install steps for the detected hardware, please wait...', 1)
+		collected = DryRun.run()
+		pkgs, missing = DryRun.resolve(collected['repo'])
+		for name in collected['remove']: pkgs.pop(name, None)
+		aur_pkgs = [pkg for pkg in dict.fromkeys(collected['aur']) if pkg not in pkgs]
+		if collected['aborted'] is not None:
+			write_status(1)
+			name, code = collected['aborted']
+			write_msg(f"The '{name}' step would abort the install with exit code {code}, see /tmp/setup.log; the steps after it weren't evaluated", 3)
+			return code if isinstance(code, int) and code != 0 else 1
+		write_status(0 if len(collected['failed']) == 0 else 1, 0, 4)
+
+		cached, aur_cached = (DryRun.cached(Pkg.cache_dir()), DryRun.cached(f'/mnt{aur_cache}'))
+		cache_found = os.path.isdir(Pkg.cache_dir())
+		in_cache = lambda info: (info['name'], info['version']) in cached
+		csize = sum(info['csize'] for info in pkgs.values())
+		download = sum(info['csize'] for info in pkgs.values() if not in_cache(info))
+		isize = sum(info['isize'] for info in pkgs.values())
+
+		lines = [f"{'*' if in_cache(info) else ' '} {info['repo'] + '/' + name:<40} {info['version']:<24} {size_str(info['csize']):>8} {size_str(info['isize']):>8}" for name, info in sorted(pkgs.items())]
+		lines += [f"{'*' if any(cached_name == pkg for cached_name, version in aur_cached) else ' '} {'aur/' + pkg:<40}" for pkg in aur_pkgs]
+		write_ln()
+		for ln in lines: write_ln(f'§7{ln}')
+		log('\n[setup.py:DryRun.report()] Resolved packages (* = cached):\n' + '\n'.join(lines))
+		write_ln()
+
+		cache_msg = f'{sum(1 for info in pkgs.values() if in_cache(info))} cached' if cache_found else f'{Pkg.cache_dir()} not mounted'
+		write_msg(f'Repository packages: {len(pkgs)} ({cache_msg}), download {size_str(download)} of {size_str(csize)}, installed {size_str(isize)}', 5)
+		if len(aur_pkgs) > 0:
+			write_msg(f'AUR packages: {len(aur_pkgs)} ({sum(1 for pkg in aur_pkgs if any(name == pkg for name, version in aur_cached))} cached); their dependencies & sizes are known only once built', 5)
+		if len(missing) > 0:
+			write_msg(f"Not found in the package databases: {' '.join(missing)}", 4)
+		if len(collected['failed']) > 0:
+			write_msg(f"Steps which couldn't be fully evaluated (see /tmp/setup.log): {', '.join(collected['failed'])}", 4)
+
+		rate, runs = DryRun.throughput()
+		if rate > 0:
+			write_msg(f'Estimated install time: ~{max(1, round(isize / rate / 60))}m (from {runs} earlier install(s) at {size_str(rate)}/s installed)', 5)
+		else:
+			write_msg(f'Estimated install time: unknown, no earlier installs recorded in {DryRun.history_path()}', 5)
+		return 0
+
+# Declarative disk layouts partitioned with a single sgdisk (GPT on UEFI) or sfdisk (MBR on BIOS/CSM) run e.g.
+#   '/dev/sda 512M:/efi 8G:swap 30%:/ *:/home:xfs'
+# Sizes are in K/M/G/T (binary units), percentages of the space left by the fixed sizes or '*' for the rest (last only).
+# Partitions start at 1 MiB boundaries & are formatted with FAT32 for /efi, swap for swap & ext4 by default.
+class DiskLayout:
+	# Returns: disk & partitions of a layout e.g. ('/dev/sda', [ { 'device': '/dev/sda1', 'size': '512M', 'mount': '/efi', 'format': 'fat32' }, ... ])
+	# Raises: ValueError when the layout is invalid
+	@staticmethod
+	def parse(spec):
+		fields = spec.split()
+		if len(fields) < 2 or not fields[0].startswith('/dev/'):
+			raise ValueError(f"'{spec}' should be a disk followed by partitions e.g. '/dev/sda 512M:/efi *:/'")
+		disk, pars = fields[0], []
+		fs_types = [ fs_type.lower() for fs_type in par_fs_types ]
+		for i, field in enumerate(fields[1:]):
+			size, mp, fs_type = (field.split(':') + [ '', '' ])[:3] if field.count(':') <= 2 else ('', '', '')
+			if not re.match(r'^(\d+[KMGT]|\d+(\.\d+)?%|\*)$', size.upper()) or (size == '*' and i != len(fields) - 2):
+				raise ValueError(f"'{field}' of {disk} should start with a size e.g. '512M', '30%' or '*' (last only)")
+			if mp != 'swap' and not mp.startswith('/'):
+				raise ValueError(f"'{field}' of {disk} should have a mount point e.g. '512M:/efi' or '8G:swap'")
+			fs_type = fs_type.lower() or ('fat32' if mp == '/efi' else 'swap' if mp == 'swap' else 'ext4')
+			if fs_type not in fs_types:
+				raise ValueError(f"'{fs_type}' of {disk} isn't a supported filesystem type: {', '.join(par_fs_types)}")
+			pars.append({ 'device': DiskLayout.par_dev(disk, i + 1), 'size': size.upper(), 'mount': mp, 'format': fs_type })
+		if boot_mode != 'UEFI' and len(pars) > 4:
+			raise ValueError(f'{disk} can have at most 4 partitions on an MBR partition table')
+		return disk, pars
+
+	# Returns: device of a partition e.g. '/dev/sda1' / '/dev/nvme0n1p1'
+	@staticmethod
+	def par_dev(disk, num):
+		return f"{disk}{'p' if disk[-1].isdigit() else ''}{num}"
+
+	# Returns: disk of a partition e.g. '/dev/sda' for '/dev/sda10' / '/dev/nvme0n1' for '/dev/nvme0n1p1'
+	@staticmethod
+	def par_disk(par):
+		if re.search(r'\dp\d+$', par): return re.sub(r'p\d+$', '', par) # e.g. NVMe & eMMC
+		return re.sub(r'\d+$', '', par)
+
+	# Returns: partition sizes in MiB with None for the rest of the disk
+	# Raises: ValueError when they don't fit
+	@staticmethod
+	def sizes(disk, pars, disk_mib):
+		usable = disk_mib - (2 if boot_mode == 'UEFI' else 1) # 1 MiB before the first partition (& for the backup GPT)
+		units = { 'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2 }
+		fixed = lambda size: max(1, int(int(size[:-1]) * units[size[-1]])) # Rounded down to whole MiBs
+		left = usable - sum(fixed(par['size']) for par in pars if par['size'][-1] in units)
+		sizes = []
+		for par in pars:
+			size = par['size']
+			if size == '*': sizes.append(None)
+			elif size.endswith('%'): sizes.append(int(max(0, left) * float(size[:-1]) / 100))
+			else: sizes.append(fixed(size))
+		needed = sum(size for size in sizes if size is not None) + (1 if None in sizes else 0)
+		if needed > usable:
+			raise ValueError(f'the layout of {disk} needs {needed} MiB but only {usable} MiB are usable')
+		return sizes
+
+	# Returns: command line applying a layout e.g. 'sgdisk -Z -a 2048 -n 1:0:+512M -t 1:ef00 -n 2:0:0 -t 2:8300 /dev/sda'
+	@staticmethod
+	def script(disk, pars, sizes):
+		if boot_mode == 'UEFI':
+			type_codes = { '/efi': 'ef00', 'swap': '8200', '/home': '8302' } # Linux filesystem (8300) otherwise
+			cmd = 'sgdisk -Z -a 2048' # 1 MiB alignment
+			for num, (par, size) in enumerate(zip(pars, sizes), 1):
+				cmd += f" -n {num}:0:{f'+{size}M' if size is not None else 0} -t {num}:{type_codes.get(par['mount'], '8300')}"
+			return f'{cmd} {disk}'
+		boot_mount = '/boot' if any(par['mount'] == '/boot' for par in pars) else '/'
+		lines = [ 'label: dos' ] # sfdisk aligns partitions to 1 MiB by default
+		for par, size in zip(pars, sizes):
+			line = f'size={size}MiB, ' if size is not None else ''
+			line += f"type={'S' if par['mount'] == 'swap' else 'L'}" + (', bootable' if par['mount'] == boot_mount else '')
+			lines.append(line)
+		return f"printf '%s\\n' {' '.join(shlex.quote(line) for line in lines)} | sfdisk -q --wipe always {disk}"
+
+	# Partition a disk as in a layout erasing everything on it
+	# Returns: 0 = Partitioned, 1 = Error
+	@staticmethod
+	def apply(spec):
+		try:
+			disk, pars = DiskLayout.parse(spec)
+			disk_size = Cmd.output(f'blockdev --getsize64 {disk}').strip() # e.g. '128035676160'
+			if not disk_size.isdigit(): raise ValueError(f"couldn't get the size of {disk}")
+			cmd = DiskLayout.script(disk, pars, DiskLayout.sizes(disk, pars, int(disk_size) // 1024 ** 2))
+		except ValueError as e:
+			log(f'[setup.py:DiskLayout.apply()] ERROR: {e}')
+			return 1
+		Cmd.suppress(f'umount -R {disk}?*') # Nothing of the disk may be in use
+		Cmd.suppress(f'swapoff {disk}?*')
+		Cmd.log(f'wipefs -a {disk}')
+		ret_val = Cmd.log(cmd)
+		Cmd.suppress('udevadm settle') # Wait for the device nodes of the new partitions
+		return 0 if ret_val == 0 else 1
+
+	# Format partitions all at the same time; see format_par()
+	# pars: list of { 'device': ..., 'format': ... } e.g. [ { 'device': '/dev/sda1', 'format': 'fat32' } ]
+	# Returns: amount of errors
+	@staticmethod
+	def format_all(pars):
+		pars = [ par for par in pars if par.get('format', '') != '' ]
+		if len(pars) == 0: return 0
+		write_msg(f"Formatting {', '.join(par['device'] for par in pars)}...", 1)
+		fmt = lambda par: format_par(par['device'], par['format'].lower().replace('fat32', 'fat'))
+		with concurrent.futures.ThreadPoolExecutor(len(pars)) as pool:
+			results = list(pool.map(fmt, pars))
+		for par, ret_val in zip(pars, results):
+			if ret_val != 0: log(f"[setup.py:DiskLayout.format_all()] ERROR: Formatting {par['device']} using {par['format']} failed")
+		errors = sum(1 for ret_val in results if ret_val != 0)
+		write_status(errors)
+		return errors
+
+# Unattended install profile replacing the partitioning, mounting & password prompts e.g.
+#   {
+#     "layout": [ "/dev/sda 512M:/efi 30%:/ *:/home:xfs" ],
+#     "partition_cmds": [ "sgdisk -n 3:0:+8G -t 3:8200 /dev/sdb" ],
+#     "partitions": [
+#       { "device": "/dev/sdb3", "mount": "swap", "format": "swap" },
+#       { "device": "/dev/sdb1", "mount": "/pkgcache", "options": "noatime" }
+#     ],
+#     "passwords": { "root": "$6$...", "user": "$6$..." }
+#   }
+# Disks in "layout" are erased & partitioned as described in DiskLayout, which adds their partitions to "partitions".
+# Partitions without "format" are only mounted & passwords are crypt(3) hashes e.g. from 'openssl passwd -6'.
+# The profile is validated before anything is changed & kept in the saved state for the chroot; see save_state()
+class Profile:
+	# Load & validate an install profile; exits when it's invalid
+	# Returns: the profile as a dict
+	@staticmethod
+	def load(path):
+		try:
+			with open(path) as f:
+				data = json.load(f)
+		except (OSError, ValueError) as e:
+			Profile.fail(f"Couldn't load the install profile '{path}': {e}")
+		problems = Profile.expand(data)
+		problems += Profile.validate(data)
+		if len(problems) > 0:
+			Profile.fail(f"Invalid install profile '{path}':\n" + '\n'.join(f'   - {problem}' for problem in problems))
+		log(f"[setup.py:Profile.load()] INFO: Installing unattended with the profile '{path}'")
+		return data
+
+	@staticmethod
+	def fail(msg):
+		log(f'[setup.py:Profile] ERROR: {msg}')
+		write_ln(f'§2ERROR: §0{msg}')
+		exit(13) # 13 = Invalid install profile
+
+	# Add the partitions of the disk layouts to the partitions of a profile
+	# Returns: problems found in the layouts e.g. ["'8G' of /dev/sda should have a mount point e.g. ..."]
+	@staticmethod
+	def expand(data):
+		if not isinstance(data, dict) or 'layout' not in data: return []
+		layouts = data['layout']
+		if not isinstance(layouts, list) or not all(isinstance(spec, str) for spec in layouts):
+			return [ "'layout' should be a list of disk layouts e.g. '/dev/sda 512M:/efi *:/'" ]
+		problems, pars = [], []
+		for spec in layouts:
+			try:
+				pars += DiskLayout.parse(spec)[1]
+			except ValueError as e:
+				problems.append(str(e))
+		explicit = data.get('partitions', [])
+		data['partitions'] = pars + (explicit if isinstance(explicit, list) else [])
+		return problems
+
+	# Returns: problems found in a profile e.g. ["no partition is mounted to '/'"]
+	@staticmethod
+	def validate(data):
+		if not isinstance(data, dict): return [ 'the profile should be a JSON object' ]
+		problems = []
+		cmds = data.get('partition_cmds', [])
+		if not isinstance(cmds, list) or not all(isinstance(cmd, str) for cmd in cmds):
+			problems.append("'partition_cmds' should be a list of command lines")
+
+		pars = data.get('partitions')
+		if not isinstance(pars, list) or len(pars) == 0:
+			pars = []
+			problems.append("'partitions' should be a list of partitions")
+		mount_points = []
+		fs_types = [ fs_type.lower() for fs_type in par_fs_types ]
+		for i, par in enumerate(pars):
+			if not isinstance(par, dict) or not isinstance(par.get('device'), str) or not isinstance(par.get('mount'), str):
+				problems.append(f"partition #{i + 1} should have a 'device' & a 'mount' point")
+				continue
+			dev, mp, fs_type = par['device'], par['mount'], str(par.get('format', '')).lower()
+			if not dev.startswith('/dev/'):
+				problems.append(f"'{dev}' isn't a device path e.g. '/dev/sda1'")
+			if mp != 'swap' and not mp.startswith('/'):
+				problems.append(f"'{mp}' of {dev} isn't a mount point e.g. '/home' or 'swap'")
+			elif mp != 'swap' and mp in mount_points:
+				problems.append(f"more than one partition is mounted to '{mp}'")
+			mount_points.append(mp)
+			if fs_type != '' and fs_type not in fs_types:
+				problems.append(f"'{fs_type}' of {dev} isn't a supported filesystem type: {', '.join(par_fs_types)}")
+			elif (fs_type == 'swap') != (mp == 'swap') and fs_type != '':
+				problems.append(f"{dev} should be both formatted & used as swap")
+			elif mp == '/' and fs_type != '' and fs_type not in [ fs_type.lower() for fs_type in root_fs_types ]:
+				problems.append(f"'/' can't be formatted with '{fs_type}': {', '.join(root_fs_types)}")
+			if not isinstance(par.get('options', ''), str) or ' ' in par.get('options', ''):
+				problems.append(f"'options' of {dev} should be comma separated mount options e.g. 'noatime,nofail'")
+		if len(pars) > 0 and '/' not in mount_points:
+			problems.append("no partition is mounted to '/'")
+		if boot_mode == 'UEFI' and len(pars) > 0 and '/efi' not in mount_points:
+			problems.append("no partition is mounted to '/efi' for the UEFI boot mode")
+		elif boot_mode != 'UEFI' and '/efi' in mount_points:
+			problems.append("'/efi' is only used in the UEFI boot mode")
+		if offline and '/pkgcache' not in mount_points:
+			problems.append("no partition is mounted to '/pkgcache' for the offline install")
+
+		passwords = data.get('passwords', {})
+		if not isinstance(passwords, dict):
+			return problems + [ "'passwords' should map user names to password hashes" ]
+		users_lst = users.split(',') if len(users) > 0 else []
+		for user, pw_hash in passwords.items():
+			if user != 'root' and user not in users_lst:
+				problems.append(f"'{user}' in 'passwords' isn't one of the users: {users}")
+			elif not isinstance(pw_hash, str) or not re.match(r'^\$[0-9a-z]+\$[^:\s]+$', pw_hash):
+				problems.append(f"the password of '{user}' should be a crypt(3) hash e.g. from 'openssl passwd -6'")
+		passwdless_lst = User.get_passwdless_users()
+		for user in [ 'root' ] + users_lst:
+			if user not in passwords and user not in passwdless_lst:
+				problems.append(f"'passwords' is missing a password hash for '{user}'")
+		return problems
+
+	# Partition the disk layouts & run the partitioning commands of the profile instead of the partitioning menu; exits on errors
+	@staticmethod
+	def partition():
+		global mbr_grub_dev
+		for spec in profile.get('layout', []):
+			write_msg(f'Partitioning: §7{spec}§0...', 1)
+			ret_val = DiskLayout.apply(spec)
+			write_status(ret_val)
+			if ret_val != 0:
+				write_ln('§2ERROR: §0Partitioning failed. Check /tmp/setup.log for the details.')
+				exit(14) # 14 = Unattended disk setup failure
+			disk, pars = DiskLayout.parse(spec)
+			if boot_mode == 'BIOS/CSM' and any(par['mount'] in [ '/', '/boot' ] for par in pars):
+				mbr_grub_dev = disk # e.g. '/dev/nvme0n1'
+		for cmd in profile.get('partition_cmds', []):
+			write_msg(f'Partitioning: §7{cmd}§0...', 1)
+			ret_val = Cmd.log(cmd)
+			write_status(ret_val)
+			if ret_val != 0:
+				write_ln('§2ERROR: §0Partitioning failed. Check /tmp/setup.log for the details.')
+				exit(14) # 14 = Unattended disk setup failure
+		Cmd.suppress('udevadm settle') # Wait for the device nodes of new partitions
+
+	# Format & mount the partitions of the profile instead of the mounting menu; exits on errors
+	@staticmethod
+	def mount():
+		# Parent mount points first e.g. '/' before '/home' before '/home/shared' & swap last
+		order = lambda par: (par['mount'] == 'swap', par['mount'].rstrip('/').count('/'), par['mount'])
+		options = { mp: opt for opt, mp in par_mount_points.items() } # e.g. { '/boot': 'B' }
+		errors = DiskLayout.format_all(profile['partitions'])
+		for par in sorted(profile['partitions'], key=order):
+			if errors > 0: break
+			errors += use_par(options.get(par['mount'], 'O'), par['device'], par['mount'], par.get('options', ''))
+		load_mounts()
+		if errors > 0:
+			write_ln('§2ERROR: §0Formatting & mounting the partitions failed. Check /tmp/setup.log for the details.')
+			exit(14) # 14 = Unattended disk setup failure
+		if offline and not (pkgcache_enabled and '/pkgcache:' in mounts): # Same check as after the mounting menu
+			write_ln('§2ERROR: §0The offline install needs a mounted package cache partition with cached package databases.')
+			exit(14) # 14 = Unattended disk setup failure
+
+	# Set the password hashes of the profile instead of asking for the passwords
+	# Returns: 0 = Success, 1 = Error
+	@staticmethod
+	def set_passwords():
+		passwords = profile.get('passwords', {})
+		if len(passwords) == 0: return 0
+		log(f"\n# chpasswd -e # {', '.join(passwords)}") # The hashes are kept out of the log
+		entries = ''.join(f'{user}:{pw_hash}\n' for user, pw_hash in passwords.items())
+		res = subprocess.run(['chpasswd', '-e'], input=entries.encode(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		if res.returncode != 0:
+			log(f"[setup.py:Profile.set_passwords()] ERROR: {res.stderr.decode(errors='replace').strip()}")
+		return 0 if res.returncode == 0 else 1
+
 
 
 ###############################
@@ -575,7 +3140,8 @@ class User:
 # Check if running in Arch Linux installer env & quit if not
 # Additionally update details about the device
 def check_env():
-	global de, users, boot_mode, in_chroot, kernel_type, kernel, use_dkms_pkgs, cpu_family, cpu_model, cpu_identifier, aur_cache, use_qt_apps, unres_users
+	global de, users, boot_mode, in_chroot, kernel_type, kernel, use_dkms_pkgs, cpu_family, cpu_model, cpu_identifier, aur_cache, use_qt_apps, unres_users, hw
+	global mbr_grub_dev, mounts, pkgcache_enabled, install_started, profile
 	os_compat_msg = 'Please only run this script on the Arch Linux installer environment.\n\nhttps://www.archlinux.org/download/'
 	file_msg = "It seems that you are missing a '§f' module.\n"
 	if os.name == 'posix':
@@ -618,12 +3184,21 @@ def check_env():
 			print()
 			exit(4) # 4 = config.py not loaded
 
+		# Reuse everything detected on the live environment when chrooted; see save_state()
+		state = load_state() if in_chroot else None
+		if state is not None:
+			boot_mode = state['boot_mode']
+			mbr_grub_dev = state['mbr_grub_dev']
+			mounts = state['mounts']
+			pkgcache_enabled = state['pkgcache_enabled']
+			install_started = state.get('install_started', install_started)
+			profile = state.get('profile')
+
 		# CPU type needed for ucode
-		cpu_type = 'intel' if Cmd.suppress('cat /proc/cpuinfo | grep -i intel') == 0 else 'amd'
-		cpu_family = Cmd.output("cat /proc/cpuinfo | grep -i family | uniq").split(':', 1)[1].strip() # e.g. '6'
-		cpu_model = Cmd.output("cat /proc/cpuinfo | grep -i model | grep -vi '^model name' | uniq").split(':', 1)[1].strip() # e.g. '60'
-		cpu_cores = Cmd.output("cat /proc/cpuinfo | grep -i processor | wc -l").strip() # e.g. '4'
-		cpu_identifier = f'{cpu_type}_{cpu_family}-{cpu_model}-{cpu_cores}' # e.g. 'intel_6-60-4'
+		hw = HardwareInfo(state['hw'] if state is not None else None)
+		cpu_family = hw.cpu_family # e.g. '6'
+		cpu_model = hw.cpu_model   # e.g. '60'
+		cpu_identifier = hw.cpu_identifier() # e.g. 'intel_6-60-4'
 		aur_cache = f'/pkgcache/pkgcache/aur' + (f'/{cpu_identifier}' if optimize_compilation and optimize_cached_pkgs else '')
 
 		de = de.lower().replace('deepin', 'dde').replace('none', '')
@@ -633,8 +3208,7 @@ def check_env():
 		unres_users = User.get_unrestricted_users()
 
 		# Update bootmode to EFI if required
-		ret_val = Cmd.suppress('ls /sys/firmware/efi/efivars')
-		if ret_val == 0: boot_mode = 'UEFI' # efivars dir exits => booted in UEFI
+		if state is None and os.path.isdir('/sys/firmware/efi/efivars'): boot_mode = 'UEFI' # efivars dir exits => booted in UEFI
 	else:
 		print(os_compat_msg)
 		input()
@@ -688,7 +3262,9 @@ def check_connectivity():
 	elif enable_aur: # Test connection to AUR
 		ret_val += Cmd.log('ping -c 1 aur.archlinux.org')
 		write_status(ret_val, 0, 4)
-		if ret_val != 0:
+		if ret_val != 0 and profile is not None: # Unattended => carry on
+			write_ln("\n§4WARN: §0Possibly unreliable network connection detected: AUR support could fail to be enabled.", 2)
+		elif ret_val != 0:
 			write_ln("\n§4WARN: §0Possibly unreliable network connection detected: AUR support could fail to be enabled.")
 			write_msg(f'Would you like to continue §2without §0making any changes? (§3y§0/§2N§0)? §7>> ')
 			ans = input().upper().replace('YES', 'Y')
@@ -744,20 +3320,55 @@ def partition(tool_to_use=''):
 		if tool_defined: Cmd.exec(f'{tool_to_use} /dev/{in_cmd}')
 		else: Cmd.exec(in_cmd)
 
+# Partition a disk & format it's partitions as described in a layout; see DiskLayout
+def partition_layout():
+	global mbr_grub_dev
+	Cmd.exec(f"echo && {lsblk_cmd} && echo", '', False)
+	write_msg('Disk layout (e.g. §7/dev/sda 512M:/efi 8G:swap 30%:/ *:/home:xfs§0) §7>> ')
+	spec = input().strip()
+	if len(spec) == 0: return
+	try:
+		disk, pars = DiskLayout.parse(spec)
+	except ValueError as e:
+		write_ln(f'\n§2ERROR: §0{e}')
+		write('\nPress ENTER to continue...')
+		input()
+		return
+
+	write_ln()
+	for par in pars: # e.g. '   /dev/sda1   512M  /efi  (fat32)'
+		write_ln(f"   §7{par['device']}   §0{par['size']:>5}  §3{par['mount']}  §0({par['format']})")
+	write_ln()
+	write_msg(f'This will §2erase everything §0on §7{disk}§0. Continue (§2y§0/§3N§0)? §7>> ')
+	ans = input().upper().replace('YES', 'Y')
+	if ans != 'Y': return
+
+	write_ln()
+	write_msg(f'Partitioning {disk}...', 1)
+	ret_val = DiskLayout.apply(spec)
+	write_status(ret_val)
+	if ret_val == 0 and boot_mode == 'BIOS/CSM' and any(par['mount'] in [ '/', '/boot' ] for par in pars):
+		mbr_grub_dev = disk # e.g. '/dev/nvme0n1'
+	if ret_val == 0: ret_val = DiskLayout.format_all(pars)
+	if ret_val != 0:
+		write('\nPress ENTER to continue...')
+		input()
+
 def sel_par_tool(hide_guide=False):
 	if not hide_guide:
 		write_ln("   Enter '§3F§0' to partition using §3cfdisk §0(UEFI & BIOS/CSM)")
 		write_ln("   Enter '§4G§0' to partition using §4cgdisk §0(UEFI only)")
-		write_ln("   Enter '§7O§0' to partition using §7something else", 2)
+		write_ln("   Enter '§7O§0' to partition using §7something else")
+		write_ln("   Enter '§2A§0' to partition & format using a §2layout §0e.g. §7/dev/sda 512M:/efi 8G:swap *:/", 2)
 
 		write_ln("   Enter '§3L§0' to view partitions using §3lsblk")
 		write_ln("   Enter '§2I§0' to view partitions using §2blkid", 2)
 
 		# TODO: Add note to "cfdisk" about choosing UEFI/GPT vs BIOS/DOS!
 
-	# '>> Selection (F/G/O/L/I) >> '
+	# '>> Selection (F/G/O/A/L/I) >> '
 	write_msg('Selection (')
-	write('§3F§0/§4G/§7O§0/§3L§0/§2I§0) §7>> ')
+	write('§3F§0/§4G/§7O§0/§2A§0/§3L§0/§2I§0) §7>> ')
 
 	sel = ''
 	sel = input().strip().upper()
@@ -768,6 +3379,8 @@ def sel_par_tool(hide_guide=False):
 			partition('cgdisk')
 		elif sel == 'O':
 			partition()
+		elif sel == 'A':
+			partition_layout()
 		elif sel == 'L' or sel == 'I':
 			cmd = lsblk_cmd if sel == 'L' else blkid_cmd
 			write_ln()
@@ -798,9 +3411,27 @@ def mount_par(blk_dev, mount_point='/', opts=''):
 	opts = ' -o ' + opts if len(opts) > 0 else ''
 	return Cmd.log(f'mount{opts} {blk_dev} {mount_point}')
 
-def par_opt_handler(opt):
-	global mbr_grub_dev, pkgcache_enabled
+# Format a partition e.g. 'format_par('/dev/sda1', 'ext4')'
+# fs_type: lowercase type from par_fs_types with 'fat' for FAT32 e.g. 'ext4', 'fat', 'swap'
+# Returns: 0 = Formatted, other = Error
+def format_par(par, fs_type):
+	# TODO Add other as fs type & custom format commands etc
+	format_args = {
+			'f2fs':      '-f', # -l label
+			'reiserfs': '-f', # -u -l label
+			'xfs':      '-f', # -L label
+			'fat':      '-F32 -s2', # -n label
+			'ntfs':     '-F -Q', # -U -L label
+			#'exfat':    '', # -n label
+			#'btrfs':    '-f',
+	}
+	format_cmd = (f'mkfs.{fs_type}') if fs_type != 'swap' else 'mkswap' # e.g. 'mkfs.ext4', 'mkswap'
+	if fs_type in format_args:
+		format_cmd += ' ' + format_args.get(fs_type)
+	#format_cmd += ' -n ESP' if opt == 'E' else ''
+	return Cmd.log(f'{format_cmd} {par}') # e.g. 'mkfs.ext4 /dev/sda1'
 
+def par_opt_handler(opt):
 	# Option validity checks
 	# TODO Fully disallow mounted selections to be chosen in mounting menu! (e.g. /,/efi,swap etc)
 	if len(opt) != 1:
@@ -849,16 +3480,6 @@ def par_opt_handler(opt):
 
 	# Format...
 	if ans == 'Y':
-		# TODO Add other as fs type & custom format commands etc
-		format_args = {
-				'f2fs':      '-f', # -l label
-				'reiserfs': '-f', # -u -l label
-				'xfs':      '-f', # -L label
-				'fat':      '-F32 -s2', # -n label
-				'ntfs':     '-F -Q', # -U -L label
-				#'exfat':    '', # -n label
-				#'btrfs':    '-f',
-		}
 		if opt == 'E': # efi
 			fs_type = 'fat'
 		elif opt == 'S': # swap
@@ -866,9 +3487,7 @@ def par_opt_handler(opt):
 		else: # other
 			write_ln('\n§7>> §0All available supported §3filesystem types§0:', 2)
 			# TODO Add other as fs types (Btrfs) & custom format commands etc
-			supported_fs_types = [ 'ext4', 'XFS', 'F2FS', 'ReiserFS' ]
-			if opt != 'R':
-				supported_fs_types.extend([ 'FAT32', 'exFAT', 'NTFS', 'swap' ])
+			supported_fs_types = root_fs_types if opt == 'R' else par_fs_types
 			for fs_type in supported_fs_types:
 				write_ln(f'   §3{fs_type}')
 			write_ln()
@@ -880,16 +3499,11 @@ def par_opt_handler(opt):
 
 			fs_type = fs_type.replace('fat32', 'fat')
 
-		format_cmd = (f'mkfs.{fs_type}') if fs_type != 'swap' else 'mkswap' # e.g. 'mkfs.ext4', 'mkswap'
-		if fs_type in format_args:
-			format_cmd += ' ' + format_args.get(fs_type)
-
 		write_ln()
 		# TODO umount -R before formatting?
 		# TODO Use proper stylized version of 'fs_type' e.g. get index & use from supported_fs_types[]
 		write_msg(f'Formatting {par} using {fs_type.replace("fat", "fat32")}...', 1)
-		#format_cmd += ' -n ESP' if opt == 'E' else ''
-		ret_val = Cmd.log(f'{format_cmd} {par}') # e.g. 'mkfs.ext4 /dev/sda1'
+		ret_val = format_par(par, fs_type) # e.g. 'mkfs.ext4 /dev/sda1'
 		write_status(ret_val)
 		if ret_val != 0:
 			pause = True
@@ -907,11 +3521,7 @@ def par_opt_handler(opt):
 				mp = ''
 				mp = input().strip().lower() # e.g. '/var'
 				write_ln()
-			elif opt == 'R': mp = '/'
-			elif opt == 'B': mp = '/boot'
-			elif opt == 'H': mp = '/home'
-			elif opt == 'C': mp = '/pkgcache'
-			elif opt == 'E': mp = '/efi'
+			else: mp = par_mount_points[opt] # e.g. '/boot'
 
 			# TODO Prevent mounting to / when using NTFS etc.
 			if len(mp) > 0 and mp.startswith('/'): # Assume proper path
@@ -922,44 +3532,14 @@ def par_opt_handler(opt):
 				opts = input().strip().replace(' ', '') # e.g. 'noatime,nofail'
 				#opts = 'defaults' if len(opts) == 0 else f'defaults,{opts}'
 				write_ln()
-				write_msg(f'Mounting {par} to {mp}...', 1)
-				ret_val = mount_par(par, mp, opts) # e.g. 'mount /dev/sda1 /mnt/'
-				write_status(ret_val)
-				if ret_val != 0: pause = True
-				elif boot_mode == 'BIOS/CSM' and ((opt == 'R' and mbr_grub_dev == '') or opt == 'B'): # Update MBR GRUB device
-					# TODO: Fix NVMe / EMMC MBR installs (don't assume :-1 in par; nvme,emmc,...)
-					if par[-1:].isdigit(): par = par[:-1] # e.g. '/dev/sda1' => '/dev/sda'
-					mbr_grub_dev = par # e.g. '/dev/sda'
-				elif mp == '/pkgcache':
-					# TODO Update to support Btrfs
-					#write_ln()
-					write_msg('Checking partition filesystem compatibility for caching...', 1)
-					errors = Cmd.log(f'mkdir -p /mnt/pkgcache/pkgcache/aur/' + (cpu_identifier if optimize_cached_pkgs else ''))
-					errors += Cmd.log('touch /mnt/pkgcache/pkgcache/test-1:1.2.3.4-x86-64.pkg.tar.xz.part')
-					write_status(errors)
-					pkgcache_enabled = (errors == 0)
-					if pkgcache_enabled:
-						Cmd.log('rm -f /mnt/pkgcache/pkgcache/test-1:1.2.3.4-x86-64.pkg.tar.xz.part')
-						Cmd.log('cp /etc/pacman.conf /etc/pacman.conf.bak')
-						IO.replace_ln('/etc/pacman.conf', '#CacheDir', 'CacheDir = /mnt/pkgcache/pkgcache') # pkgcache on live env
-						write_msg('Enabling package cache on the partition...', 2)
-					else:
-						pause = True
-						Cmd.log('mv /etc/pacman.conf.bak /etc/pacman.conf')
-						IO.replace_ln('/etc/pacman.conf', 'CacheDir', '#CacheDir')
-						Cmd.log('cd && umount /mnt/pkgcache && rm -rf /mnt/pkgcache')
+				pause = use_par(opt, par, mp, opts) != 0
 			else:
 				write_ln()
 				write_msg('Mounting cancelled due to an invalid mountpoint.', 4)
 				pause = True
 		else:
 			write_ln()
-			write_msg(f'Enabling swap on {par}...', 1)
-			Cmd.suppress('swapoff ' + par) # try disabling existing swap
-			ret_val = Cmd.log('swapon ' + par) # e.g. 'swapon /dev/sda1'
-			write_status(ret_val)
-			if ret_val != 0:
-				pause = True
+			pause = use_par('S', par) != 0
 
 	if pause:
 		write('\nPress ENTER to continue...')
@@ -967,6 +3547,50 @@ def par_opt_handler(opt):
 	else:
 		time.sleep(0.15)
 
+# Mount a partition for a mounting menu option or enable it as swap ('S'); see par_mount_points
+# mp: mount point for other purposes ('O') e.g. '/var'
+# Returns: 0 = Success, 1 = Error
+def use_par(opt, par, mp='', opts=''):
+	global mbr_grub_dev, pkgcache_enabled
+
+	if opt == 'S':
+		write_msg(f'Enabling swap on {par}...', 1)
+		Cmd.suppress('swapoff ' + par) # try disabling existing swap
+		ret_val = Cmd.log('swapon ' + par) # e.g. 'swapon /dev/sda1'
+		write_status(ret_val)
+		return 0 if ret_val == 0 else 1
+
+	mp = par_mount_points.get(opt, mp) # e.g. '/boot'
+	write_msg(f'Mounting {par} to {mp}...', 1)
+	ret_val = mount_par(par, mp, opts) # e.g. 'mount /dev/sda1 /mnt/'
+	write_status(ret_val)
+	if ret_val != 0: return 1
+	elif boot_mode == 'BIOS/CSM' and ((opt == 'R' and mbr_grub_dev == '') or opt == 'B'): # Update MBR GRUB device
+		mbr_grub_dev = DiskLayout.par_disk(par) # e.g. '/dev/sda'
+	elif mp == '/pkgcache':
+		# TODO Update to support Btrfs
+		write_msg('Checking partition filesystem compatibility for caching...', 1)
+		errors = Cmd.log(f'mkdir -p /mnt/pkgcache/pkgcache/aur/' + (cpu_identifier if optimize_cached_pkgs else ''))
+		errors += Cmd.log('touch /mnt/pkgcache/pkgcache/test-1:1.2.3.4-x86-64.pkg.tar.xz.part')
+		write_status(errors)
+		pkgcache_enabled = (errors == 0)
+		if not pkgcache_enabled:
+			Cmd.log('mv /etc/pacman.conf.bak /etc/pacman.conf')
+			IO.replace_ln('/etc/pacman.conf', 'CacheDir', '#CacheDir')
+			Cmd.log('cd && umount /mnt/pkgcache && rm -rf /mnt/pkgcache')
+			return 1
+		Cmd.log('rm -f /mnt/pkgcache/pkgcache/test-1:1.2.3.4-x86-64.pkg.tar.xz.part')
+		Cmd.log('cp /etc/pacman.conf /etc/pacman.conf.bak')
+		IO.replace_ln('/etc/pacman.conf', '#CacheDir', 'CacheDir = /mnt/pkgcache/pkgcache') # pkgcache on live env
+		write_msg('Enabling package cache on the partition...', 2)
+		if offline:
+			write_msg('Loading cached package databases for the offline install...', 1)
+			ret_val = Pkg.offline_dbs()
+			write_status(ret_val)
+			pkgcache_enabled = (ret_val == 0)
+			if not pkgcache_enabled: return 1
+	return 0
+
 def write_par_mount(key='E', mount='/efi', device='/dev/sda1', condition=False, max_len=9, start_space_count=6):
 	if key == '':
 		key = '    '
@@ -995,8 +3619,10 @@ def write_par_mount(key='E', mount='/efi', device='/dev/sda1', condition=False,
 		write(f' §3({action} §7{device}§3)')
 	write_ln()
 
-def list_used_pars(hide_guide=False):
-	global mounts, menu_visit_counter
+# Update the current mounts of the new system from lsblk; see mounts
+# Returns: mounts to other mount points e.g. '/var:/dev/sda4,'
+def load_mounts():
+	global mounts
 	mounts = ''
 	other_mounts = ''
 
@@ -1017,6 +3643,11 @@ def list_used_pars(hide_guide=False):
 					mounts += entry
 				else:
 					other_mounts += entry
+	return other_mounts
+
+def list_used_pars(hide_guide=False):
+	global menu_visit_counter
+	other_mounts = load_mounts()
 
 	if 'root:' not in mounts:
 		menu_visit_counter = 0
@@ -1031,12 +3662,15 @@ def list_used_pars(hide_guide=False):
 			if boot_mode == 'UEFI':
 				write_ln()
 				write_par_mount('E', '/efi', '', ('/efi:' in mounts))
+			if offline: # Everything is installed from the package cache
+				write_ln()
+				write_par_mount('C', '/pkgcache', '', ('/pkgcache:' in mounts))
 
 		if 'root:' in mounts:
 			write_ln('\n   §4Optional §0partitions include:', 2)
 			write_par_mount('B', '/boot', '', ('/boot:' in mounts))
 			write_par_mount('H', '/home', '', ('/home:' in mounts))
-			write_par_mount('C', '/pkgcache', '', ('/pkgcache:' in mounts))
+			if not offline: write_par_mount('C', '/pkgcache', '', ('/pkgcache:' in mounts))
 			write_par_mount('S', 'swap', '', ('swap:' in mounts))
 			write_ln('      O   other')
 			# TODO Improve output formatting
@@ -1103,6 +3737,12 @@ def list_used_pars(hide_guide=False):
 		# TODO Message?
 		mounting_menu()
 
+	if offline and not (pkgcache_enabled and '/pkgcache:' in mounts):
+		write_ln('\n§2ERROR: §0Please mount a package cache partition with cached package databases for the offline install!')
+		write('\nPress ENTER to continue...')
+		input()
+		mounting_menu()
+
 	if boot_mode == 'UEFI' and '/efi:' not in mounts:
 		write_ln()
 		write_msg('Would you like to continue without mounting a §3/efi §7partition §0(§2y§0/§3N§0)? §7>> ')
@@ -1126,34 +3766,37 @@ def mounting_menu():
 # Mirrorlist sorting
 
 def sort_mirrors():
-	write_msg('Fetching reflector for mirrorlist sorting...', 1)
-	ret_val = Pkg.install('reflector')
+	write_msg('Creating a backup of the local mirrorlist file...', 1)
+	ret_val = Cmd.log('cp /etc/pacman.d/mirrorlist /etc/pacman.d/mirrorlist.bak')
 	write_status(ret_val)
 
-	if ret_val == 0:
-		write_msg('Creating a backup of the local mirrorlist file...', 1)
-		ret_val = Cmd.log('cp /etc/pacman.d/mirrorlist /etc/pacman.d/mirrorlist.bak')
-		write_status(ret_val)
-
-		write_msg('Sorting mirrors using reflector, please wait...', 1)
-		ret_val = Cmd.log('reflector --verbose --sort rate --number 25 --fastest 10 --age 24 --protocol https --save /etc/pacman.d/mirrorlist')
-		write_status(ret_val)
+	ranking = Mirrors.load()
+	if ranking is not None:
+		write_msg(f'Reusing the mirror ranking from {Mirrors.age_str(ranking)} ago...', 2)
+		mirrors = ranking['mirrors']
+	else:
+		write_msg('Ranking mirrors by download speed, please wait...', 1)
+		mirrors = Mirrors.rank(Mirrors.candidates())
+		write_status(0 if len(mirrors) > 0 else 1)
+		if len(mirrors) > 0: Mirrors.save(mirrors)
 
+	if len(mirrors) > 0:
+		Mirrors.write(mirrors)
 		write_msg('Refreshing pacman package databases...', 1)
 		ret_val = Pkg.refresh_dbs()
 		write_status(ret_val)
 
 # Base system install
 
-# TODO Use global sys_root variable in the future
-# TODO Fix systemd messages appearing on screen about microcode on real hardware
-def base_install(sys_root='/mnt/'):
-	ps_args, extra_pkgs = ('', '')
+# Returns: packages installed with base_pkgs e.g. 'sudo terminus-font e2fsprogs'
+def base_extra_pkgs():
+	extra_pkgs = ''
 	blkid = Cmd.output('blkid').lower()
 
 	if len(users) > 0: extra_pkgs += 'sudo '
 	if font.startswith('ter-'): extra_pkgs += 'terminus-font '
 	if enable_aur: extra_pkgs += 'pigz '
+	# Userspace utilities for filesystems
 	if 'ext' in blkid: extra_pkgs += 'e2fsprogs '
 	if 'jfs' in blkid: extra_pkgs += 'jfsutils '
 	if 'reiser' in blkid: extra_pkgs += 'reiserfsprogs '
@@ -1161,14 +3804,24 @@ def base_install(sys_root='/mnt/'):
 	if 'f2fs' in blkid: extra_pkgs += 'f2fs-tools '
 	# TODO: 'cryptsetup lvm2' if use_lvm (/ encryption)
 	# TODO: Detect SW raid & get 'mdadm'
+	return extra_pkgs.rstrip()
 
-	# Userspace utilities for filesystems
-	extra_pkgs = f' {extra_pkgs.rstrip()}' if len(extra_pkgs) > 0 else ''
+# TODO Use global sys_root variable in the future
+# TODO Fix systemd messages appearing on screen about microcode on real hardware
+def base_install(sys_root='/mnt/'):
+	ps_args = ''
+	extra_pkgs = base_extra_pkgs()
+	extra_pkgs = f' {extra_pkgs}' if len(extra_pkgs) > 0 else ''
 
 	cache_arg = '-c ' if os.path.exists(sys_root + 'pkgcache') else ''
 
 	# TODO Force installation to not trigger (Updating linux initcpios) to run it seperately at the end (install the kernel & bootloader at the very end instead perhaps?)
-	ps_args = f'{cache_arg}{sys_root} openresolv base linux-firmware device-mapper logrotate which less usbutils inetutils diffutils man-db man-pages python{extra_pkgs}'
+	ps_args = f'{cache_arg}{sys_root} {base_pkgs}{extra_pkgs}'
+
+	Prefetch.finish() # Packages downloaded in the background end up in the cache pacstrap uses
+
+	# Start from the live environment's up-to-date databases so pacstrap doesn't download them again
+	Cmd.log(f'mkdir -p {sys_root}var/lib/pacman/sync && cp -p /var/lib/pacman/sync/*.db {sys_root}var/lib/pacman/sync/')
 
 	write_msg('Installing base system using pacstrap, please wait...', 1)
 	ret_val = Cmd.log('pacstrap ' + ps_args)
@@ -1196,7 +3849,12 @@ def base_install(sys_root='/mnt/'):
 
 # TODO Use global sys_root variable in the future
 def start_chroot(sys_root='/mnt/'):
-	Cmd.suppress(f'cp /proc/cpuinfo {sys_root}proc/') # For CPU detection in chroot
+	# The chroot can't detect e.g. the mounts, the MBR GRUB device or the install profile again
+	ret_val = save_state(sys_root)
+	if ret_val != 0:
+		log(f"[setup.py:start_chroot()] ERROR: Couldn't save the install state to '{sys_root}root/{state_fn}' for the chroot")
+		write_ln(f"§2ERROR: §0Couldn't save the install state to '{sys_root}root/{state_fn}'. Check /tmp/setup.log for details")
+		exit(15) # 15 = Couldn't hand the install state over to the chroot
 
 	#if multibooting:
 		#Cmd.log(f'mkdir {sys_root}hostrun')
@@ -1212,67 +3870,64 @@ def start_chroot(sys_root='/mnt/'):
 
 	Cmd.suppress(f'touch {sys_root}chroot') # Add indicator file for chroot
 
-	# TODO Check if log is copied again?
+	if Stats.share(sys_root) != 0:
+		log(f"[setup.py:start_chroot()] WARN: Couldn't copy the live environment's command stats to '{sys_root}setup-stats.jsonl'")
+
+	# Share the log files with the chroot so e.g. 'tail -f /tmp/setup.log' keeps working
 	log('\n#\n# Start of chroot log\n#')
-	Cmd.suppress(f'cp /tmp/setup.log {sys_root}') # Copy log over to chroot
-	Cmd.suppress(f'ln -sf {sys_root}setup.log /tmp/setup.log')
+	Log.flush()
+	for f_name in ('setup.log', 'setup.log.jsonl'):
+		Cmd.suppress(f'touch {sys_root}{f_name}')
+		ret_val = Cmd.log(f'mount --bind /tmp/{f_name} {sys_root}{f_name}')
+		if ret_val != 0:
+			log(f"[setup.py:start_chroot()] WARN: Couldn't share '/tmp/{f_name}' with the chroot, it's log will be in '{sys_root}{f_name}' instead")
 
 	write_msg('Chrooting into the new install...', 1)
-	ch_args = f' {mbr_grub_dev}' if len(mbr_grub_dev) > 0 else ''  # Pass grub device to script
 	# TODO Use https://wiki.archlinux.org/index.php/systemd-nspawn instead to fix some problems?
-	Cmd.exec(f'arch-chroot {sys_root} /root/{script_fn}{ch_args}') # e.g. 'arch-chroot /mnt/ /root/setup.py /dev/sda'
+	Log.flush()
+	chroot_args = (' --prebuild-aur' if prebuild else '') + (' -N' if offline else '')
+	if offline: # Let the chroot restore the original mirrors afterwards
+		Cmd.log(f'cp /etc/pacman.d/mirrorlist.online {sys_root}etc/pacman.d/')
+	Cmd.exec(f'arch-chroot {sys_root} /root/{script_fn}{chroot_args}') # e.g. 'arch-chroot /mnt/ /root/setup.py'
+
+	Cmd.suppress(f'umount {sys_root}setup.log {sys_root}setup.log.jsonl')
+	Cmd.suppress(f'rm -f {sys_root}setup.log {sys_root}setup.log.jsonl')
+
+# Save the details detected on the live environment for the chrooted script to skip detecting them again
+# Returns: 0 = Success, 1 = Error
+def save_state(sys_root='/mnt/'):
+	state = {
+		'boot_mode': boot_mode,
+		'mbr_grub_dev': mbr_grub_dev,
+		'mounts': mounts,
+		'pkgcache_enabled': pkgcache_enabled,
+		'install_started': install_started,
+		'profile': profile,
+		'hw': hw.to_dict()
+	}
+	return IO.write(f'{sys_root}root/{state_fn}', json.dumps(state, separators=(',', ':')))
+
+# Returns: details saved by save_state() / None when they couldn't be loaded
+def load_state():
+	try:
+		with open(f'/root/{state_fn}', 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
 
 # Chroot specific install steps
 
 def load_hw_info():
-	global mbr_grub_dev, bat_present, disc_tray_present, camera_present, bt_present, vm_env
-
-	if len(sys.argv) == 2: mbr_grub_dev = sys.argv[1] # Assume MBR grub dev e.g. '/dev/sda'
-
-	# Update battery presence
-	ret_val = Cmd.suppress('ls -1 /sys/class/power_supply | grep -i bat')
-	bat_present = (ret_val == 0)
-
-	# Update disc tray presence
-	blkid = Cmd.output("blkid")
-	disc_tray_present = ('/dev/sr' in blkid or '/dev/sg' in blkid)
-	if not disc_tray_present: # Try other alternative methods
-		ret_val = Cmd.suppress("dmesg | egrep -i 'cdrom|dvd|cd/rw|writer'")
-		disc_tray_present = (ret_val == 0)
-
-	# Update camera presence
-	ret_val = Cmd.suppress("dmesg | egrep -i 'camera|webcam'")
-	camera_present = (ret_val == 0)
-
-	Cmd.log('update-pciids -q')
-
-	# Update Bluetooth device presence
-	# TODO Check for false-positives
-	bt_present = Cmd.suppress('rfkill list | grep -i blue') == 0
-	if not bt_present:
-		bt_f1 = Cmd.suppress('dmesg | grep -i blue') == 0
-		bt_f2 = Cmd.suppress('lsusb | grep -i blue') == 0 # TODO Improve USB BT adapter detection
-		bt_f3 = Cmd.suppress('lspci | grep -i blue') == 0
-		bt_present = bt_f1 or bt_f2 or bt_f3
-
-	# Update virtualized state
-	ret_val = Cmd.suppress('cat /proc/cpuinfo | grep hypervisor')
-	if ret_val == 0:
-		vm_env = 'other'
-		# Try & identify the VM platform
-		try:
-			board_name = IO.read_ln('/sys/devices/virtual/dmi/id/board_name').rstrip() # e.g. 'VirtualBox'
-			if board_name == 'VirtualBox':
-				vm_env = 'vbox'
-			# QEMU
-			elif IO.read_ln('/sys/devices/virtual/dmi/id/chassis_vendor').rstrip() == 'QEMU':
-				vm_env = 'qemu'
-			else:
-				prod_name = IO.read_ln('/sys/devices/virtual/dmi/id/product_name').rstrip() # e.g. 'VMware7,1'
-				if prod_name.startswith('VMware'):
-					vm_env = 'vmware'
-		except:
-			pass
+	global bat_present, disc_tray_present, camera_present, bt_present, vm_env
+
+	bat_present = hw.bat_present
+	disc_tray_present = hw.disc_tray_present
+	camera_present = hw.camera_present
+	bt_present = hw.bt_present # NOTE Auto-detect is imperfect
+	vm_env = hw.vm_env
+
+	if hw.gpu_list is None: # Not restored from the live environment
+		Cmd.log('update-pciids -q') # Latest GPU names for vga_setup()
 
 def timezone_setup():
 	write_msg('Settings datetime & timezone settings...', 1)
@@ -1287,6 +3942,7 @@ def timezone_setup():
 
 def locale_setup():
 	Cmd.log('cp /etc/locale.gen /etc/locale.gen.bak')
+	locale_gen = ConfigFile('/etc/locale.gen')
 
 	# /etc/locale.conf
 	for locale in locales.split(','): # e.g. ' en_US ','fi_FI'
@@ -1297,7 +3953,7 @@ def locale_setup():
 			write_msg(f"Finding matching UTF-8 locale for '{locale}' in /etc/locale.gen...", 1)
 			list = [ f'{locale}.UTF-8', f'{locale} UTF-8' ]
 			for lng in list:
-				ret_val = IO.uncomment_ln('/etc/locale.gen', lng)
+				ret_val = locale_gen.uncomment_ln(lng)
 				if ret_val == 0:
 					found = True
 					break
@@ -1307,13 +3963,14 @@ def locale_setup():
 		if not found:
 			write_msg(f"Finding any matching locale for '{locale}' in /etc/locale.gen...", 1)
 			# TODO Return uncommented line & use for future purposes
-			ret_val = IO.uncomment_ln('/etc/locale.gen', locale)
+			ret_val = locale_gen.uncomment_ln(locale)
 			write_status(ret_val)
 			if ret_val != 0:
 				log(f"[setup.py:locale_setup()] WARN: Couldn't find locale '{locale}' in /etc/locale.gen")
 
 	write_msg('Generating chosen locales, please wait...', 1)
-	ret_val = Cmd.log('locale-gen')
+	ret_val = locale_gen.commit()
+	if ret_val == 0: ret_val = Cmd.log('locale-gen')
 	write_status(ret_val)
 
 	write_msg('Creating /etc/locale.conf...', 1)
@@ -1377,13 +4034,12 @@ def networking_setup():
 	# Generate hostname based on board model / virtualization platform
 	if hostname == '':
 		if vm_env != 'vmware':
-			try:
-				hostname = IO.read_ln('/sys/devices/virtual/dmi/id/board_name').rstrip().replace(' ', '-') # e.g. 'Z270N-WIFI'
-			except:
-				if vm_env != '':
-					hostname = IO.read_ln('/sys/devices/virtual/dmi/id/chassis_vendor').rstrip() # e.g. 'QEMU'
-				else:
-					hostname = 'Arch-' + str(random.randint(1000, 9999)) # e.g. 'Arch-3980'
+			if 'board_name' in hw.dmi:
+				hostname = hw.dmi['board_name'].replace(' ', '-') # e.g. 'Z270N-WIFI'
+			elif vm_env != '' and 'chassis_vendor' in hw.dmi:
+				hostname = hw.dmi['chassis_vendor'] # e.g. 'QEMU'
+			else:
+				hostname = 'Arch-' + str(random.randint(1000, 9999)) # e.g. 'Arch-3980'
 		else:
 			hostname = 'VMware'
 
@@ -1463,31 +4119,53 @@ def aur_setup():
 		write_status(errors)
 
 		# Build & compress on all CPU cores
-		file = '/etc/makepkg.conf'
+		conf = ConfigFile('/etc/makepkg.conf')
 		if optimize_compilation and (not pkgcache_enabled or optimize_cached_pkgs):
-			IO.replace_ln(file, 'CFLAGS="', f'CFLAGS="{cflags}"') # 40
-		IO.replace_ln(file, 'CXXFLAGS="', 'CXXFLAGS="${CFLAGS}"') # 41
-		IO.replace_ln(file,   '#MAKEFLAGS="', 'MAKEFLAGS="-j$(nproc)"') # 44
-		IO.replace_ln(file,   'BUILDENV=', f'BUILDENV=(!distcc color {"" if use_ccache else "!"}ccache !check !sign)') # 62
-		IO.uncomment_ln(file, 'BUILDDIR=') # 69
-		IO.replace_ln(file,   'COMPRESSGZ=(', 'COMPRESSGZ=(pigz -c -f -n)') # 130
-		IO.replace_ln(file,   'COMPRESSXZ=(', 'COMPRESSXZ=(xz -c -z - --threads=0)') # 132
-
-		write_msg('Fetching & installing yay from the AUR, please wait...', 1)
+			conf.replace_ln('CFLAGS="', f'CFLAGS="{cflags}"') # 40
+		conf.replace_ln('CXXFLAGS="', 'CXXFLAGS="${CFLAGS}"') # 41
+		conf.replace_ln('#MAKEFLAGS="', 'MAKEFLAGS="${MAKEFLAGS:--j$(nproc)}"') # 44, may be lowered for concurrent builds; see AurBuild.build()
+		conf.replace_ln('BUILDENV=', f'BUILDENV=(!distcc color {"" if use_ccache else "!"}ccache !check !sign)') # 62
+		conf.uncomment_ln('BUILDDIR=') # 69
+		PkgCompression.configure(conf) # 130-140
+		conf.commit()
+
 		# TODO Cache the package to /pkgcache?
 		# TODO Fix "host not resolved" issues on desktop & laptop!!!
-		ret_val = Cmd.log('$ cd /tmp; git clone --depth 1 https://aur.archlinux.org/yay-bin.git && cd yay-bin && makepkg -si --skippgpcheck --noconfirm --noprogressbar --needed', 'aurhelper')
-		write_status(ret_val)
-		Cmd.log('cd && rm -rf /tmp/yay-bin')
+		ret_val = 0
+		if not offline: # Only cached AUR packages are installed when offline
+			write_msg('Fetching & installing yay from the AUR, please wait...', 1)
+			ret_val = Cmd.log('$ cd /tmp; git clone --depth 1 https://aur.archlinux.org/yay-bin.git && cd yay-bin && makepkg -si --skippgpcheck --noconfirm --noprogressbar --needed', 'aurhelper')
+			write_status(ret_val)
+			Cmd.log('cd && rm -rf /tmp/yay-bin')
 		if ret_val != 0: # Yay install failed
 			global enable_aur
 			enable_aur = False
+			Shell.stop_all('aurhelper')
 			Cmd.log('userdel -f -r aurhelper')
 			Cmd.log('cp /etc/sudoers.bak /etc/sudoers')
 
 		Cmd.log('chmod 440 /etc/sudoers')
 
-		# TODO Setup ccache w/ 8GB
+		if enable_aur and use_ccache:
+			write_msg(f"Setting up the compiler cache in '{Ccache.path()}'...", 1)
+			ret_val = Ccache.setup()
+			write_status(ret_val)
+
+# Build the AUR packages the install steps enabled by config.py would use (found by a dry run of them; see DryRun)
+# into the cache for this CPU without installing them or running the rest of the install
+# e.g. on a reference machine ahead of a fleet rollout, so other installs only fetch them from the cache repository
+def prebuild_aur():
+	if not pkgcache_enabled:
+		log('[setup.py:prebuild_aur()] WARN: Ignoring pre-building AUR packages since the package cache is not present.')
+		return
+	if not enable_aur: return
+	write_msg('Evaluating the install steps for their AUR packages, please wait...', 1)
+	collected = DryRun.run()
+	write_status(0 if len(collected['failed']) == 0 and collected['aborted'] is None else 1, 0, 4)
+	pkgs = list(dict.fromkeys(collected['aur']))
+	write_msg(f'Pre-building {len(pkgs)} AUR packages of the install, please wait...', 1)
+	errors = AurBuild.install(' '.join(pkgs), True, False) if len(pkgs) > 0 else 0
+	write_status(1 if errors is None else errors)
 
 def user_setup():
 	errors = 0
@@ -1533,34 +4211,40 @@ def user_setup():
 	Cmd.log("chmod 440 /etc/sudoers")
 	Cmd.log('cp /etc/sudoers /etc/sudoers.bak')
 
-# Enables a repo in /etc/pacman.conf & refreshes the package cache
-# TODO Allow adding new repos (url='', sigLevel='' etc)
-def enable_repo(repo, updateDb=True):
+# Enables a repo in /etc/pacman.conf; the package databases are refreshed once the changes are committed
+def enable_repo(repos, repo):
 	write_msg(f'Enabling {repo} repo in /etc/pacman.conf...', 1)
-	ln = IO.get_ln_number('/etc/pacman.conf', f'#[{repo}]') # e.g. 93
-	if ln != -1:
-		Cmd.log('cp /etc/pacman.conf /etc/pacman.conf.bak')
-		errors = Cmd.log(f'sed "{ln} s/^#//" -i /etc/pacman.conf') # e.g. "[multilib]"
-		errors += Cmd.log(f'sed "{ln+1} s/^#//" -i /etc/pacman.conf') #   "Include = ..."
-		write_status(errors)
-		if errors == 0:
-			write_msg('Refreshing pacman package databases...', 1)
-			ret_val = Pkg.refresh_dbs()
-			write_status(ret_val)
-			# TODO Copy package database to '/pkgcache/pkgcache/pkgs.db' etc for possible offline install
-		else:
-			Cmd.log('cp /etc/pacman.conf.bak /etc/pacman.conf') # Restore backup
-	else:
-		write_status(1)
+	ret_val = repos.enable(repo)
+	write_status(1 if ret_val != 0 else 0)
 
-def multilib_setup():
-	enable_repo('multilib', not enable_testing)
+def multilib_setup(repos):
+	enable_repo(repos, 'multilib')
 
-def testing_setup():
-	enable_repo('testing', False)
-	enable_repo('community-testing', not enable_multilib)
+def testing_setup(repos):
+	enable_repo(repos, 'testing')
+	enable_repo(repos, 'community-testing')
 	if enable_multilib:
-		enable_repo('multilib-testing')
+		enable_repo(repos, 'multilib-testing')
+
+# Enable the optional repositories & colored pacman output with a single package database refresh
+def repos_setup():
+	repos = Repos()
+	if enable_multilib: multilib_setup(repos)
+	if enable_testing: testing_setup(repos)
+
+	# Enable pacman easter egg & colored output by default
+	repos.conf.uncomment_ln('Color')
+	if repos.conf.find('ILoveCandy') == -1: repos.conf.insert_ln('Color', 'ILoveCandy')
+
+	if enable_aur and pkgcache_enabled: AurCache.register(repos)
+
+	if repos.changed:
+		write_msg('Refreshing pacman package databases...', 1)
+		ret_val = repos.commit()
+		write_status(ret_val)
+	else:
+		repos.commit()
+		if not offline: Pkg.save_dbs() # Keep the databases pacstrap downloaded for later installs
 
 def ssh_setup():
 	write_msg('Setting up OpenSSH ' + ('server' if enable_sshd else 'utils') + '...', 1)
@@ -1576,7 +4260,7 @@ def ssh_setup():
 def kernel_setup():
 	global use_dkms_pkgs
 	write_msg(f'Setting up the {kernel} kernel, please wait...', 1)
-	errors = Pkg.install(f'{kernel} {kernel}-headers dkms')
+	errors = Pkg.install(f'{kernel} {kernel}-headers dkms', True, True)
 
 	# On errors, fallback to stable kernel...
 	if errors != 0:
@@ -1585,17 +4269,24 @@ def kernel_setup():
 
 	write_status(errors)
 
+# Write the GRUB config changes & generate the GRUB config once everything has been installed; see GrubConfig
+# Returns: amount of errors
 def update_grub():
-	return Cmd.log('grub-mkconfig -o /boot/grub/grub.cfg')
+	errors = 1 if GrubConfig.load().commit() != 0 else 0
+	return errors + Cmd.log('grub-mkconfig -o /boot/grub/grub.cfg')
 
 def bootloader_fail_prompt():
 	#write_status()
+	if profile is not None: # Unattended => don't leave an unbootable system behind silently
+		write_ln("§2ERROR: §0The bootloader install has failed! Check /setup.log for the details.")
+		exit(12) # 12 = Bootloader install failure
 	write("§7>> §0The bootloader install has §2failed§0! Your system likely won't boot after restarting. Would you like to continue anyway (y/N)?")
 	ans = input().upper().replace('YES', 'Y')
 	if ans != 'Y':
 		exit(12) # 12 = Bootloader install failure
 
 def bootloader_setup():
+	global bootloader_failed
 	# TODO systemd-boot,syslinux etc alternatives to GRUB?
 	write_msg('Fetching dependencies for the GRUB bootloader...', 1)
 	pkgs = 'grub' # dosfstools
@@ -1611,39 +4302,33 @@ def bootloader_setup():
 	else: # BIOS/CSM
 		errors = Cmd.log(f'grub-install --recheck {mbr_grub_dev}')
 	write_status(errors)
-	if errors != 0: bootloader_fail_prompt()
-
-	write_msg('Creating initial GRUB config, please wait...', 1)
-	errors = update_grub()
+	if errors != 0: bootloader_failed = True # Prompted once the setup phases are done, not from a phase thread; see chroot_setup()
 
-	# Do some GRUB config modifications
+	# Do some GRUB config modifications; the config is generated once at the end of the install, see update_grub()
 	# TODO Uncomment '#GRUB_ENABLE_CRYPTODISK=y' if LUKS encrypted
 	# TODO Set GRUB_GFXMODE to monitor res e.g. '1920x1080'
 
-	IO.uncomment_ln(grub_conf, 'GRUB_COLOR_NORMAL=')
-	IO.uncomment_ln(grub_conf, 'GRUB_COLOR_HIGHLIGHT=')
-	IO.replace_ln(grub_conf, 'GRUB_DEFAULT=', 'GRUB_DEFAULT=saved')
-	IO.replace_ln(grub_conf, '#GRUB_SAVEDEFAULT=', 'GRUB_SAVEDEFAULT=true')
-	#IO.uncomment_ln(grub_conf, 'GRUB_SAVEDEFAULT=')
+	grub = GrubConfig.load()
+	grub.uncomment_ln('GRUB_COLOR_NORMAL=')
+	grub.uncomment_ln('GRUB_COLOR_HIGHLIGHT=')
+	grub.set('GRUB_DEFAULT', 'saved')
+	grub.set('GRUB_SAVEDEFAULT', 'true')
 
 	if not multibooting:
-		Cmd.log(f'sed "18s/.*/GRUB_FORCE_HIDDEN_MENU=true\\n/" -i {grub_conf}')
+		grub.set('GRUB_FORCE_HIDDEN_MENU', 'true')
 		# TODO Add "GRUB_DISABLE_SUBMENU=y" at the end
-		IO.replace_ln(grub_conf, 'GRUB_TIMEOUT=', 'GRUB_TIMEOUT=0')
-		#IO.replace_ln(grub_conf, '#GRUB_HIDDEN_TIMEOUT=', 'GRUB_HIDDEN_TIMEOUT=0')
-		IO.uncomment_ln(grub_conf, 'GRUB_HIDDEN_TIMEOUT_QUIET=true')
+		grub.set('GRUB_TIMEOUT', '0')
+		#grub.set('GRUB_HIDDEN_TIMEOUT', '0')
+		grub.uncomment_ln('GRUB_HIDDEN_TIMEOUT_QUIET=true')
 
 		# TODO Allow to show GRUB menu when holding SHIFT on most systems
 		#Cmd.log('cd /etc/grub.d/ && curl https://git.io/vMIFi -Lso 31_hold_shift && chmod a+x ./31_hold_shift; cd') # 21_...
 
 		# TODO Update the comment above the line? "Only load GPT module on single-boot machine" etc
 		grub_part = 'gpt' if boot_mode == 'UEFI' else 'msdos'
-		IO.replace_ln(grub_conf, 'GRUB_PRELOAD_MODULES=', f'GRUB_PRELOAD_MODULES="part_{grub_part}"')
+		grub.set('GRUB_PRELOAD_MODULES', f'part_{grub_part}', True)
 	else:
-		IO.replace_ln(grub_conf, 'GRUB_TIMEOUT=', 'GRUB_TIMEOUT=3') # TODO Keep as default 5?
-
-	write_status(errors)
-	if errors != 0: bootloader_fail_prompt()
+		grub.set('GRUB_TIMEOUT', '3') # TODO Keep as default 5?
 
 def x_setup():
 	mid = 'minimal' if xorg_install_type == 1 else 'the'
@@ -1771,7 +4456,7 @@ def bt_setup():
 def vga_setup():
 	global video_drv
 	write_msg('Setting up graphics card drivers, please wait...', 1)
-	vga_out = Cmd.output("lspci -nn | grep '\\[03'")
+	vga_out = '\n'.join(hw.gpus())
 	log(f'\n[setup.py:vga_setup()] Found GPUs:\n{vga_out}')
 	vga_out = vga_out.lower()
 	mesa_install_type = 0 # Install mesa DRI for 3D acceleration
@@ -2005,16 +4690,17 @@ def lightdm_setup():
 			if enable_aur:
 				if de != 'pantheon':
 					# TODO Configure slick greeter to actually look slick
-					errors += Pkg.aur_install('lightdm-slick-greeter lightdm-settings')
-					if errors == 0: ldm_greeter = 'slick'
+					ret_val = Pkg.aur_install('lightdm-slick-greeter lightdm-settings')
+					if ret_val == 0: ldm_greeter = 'slick'
 				else:
-					errors += Pkg.aur_install('lightdm-pantheon-greeter')
-					if errors == 0: ldm_greeter = 'pantheon'
+					ret_val = Pkg.aur_install('lightdm-pantheon-greeter')
+					if ret_val == 0: ldm_greeter = 'pantheon'
+				errors += ret_val
 		else:
 			ldm_greeter = 'deepin'
 
 	# TODO Install other greeters here too
-	if ldm_greeter == 'gtk' or errors != 0:
+	if ldm_greeter == 'gtk':
 		# TODO Setup proper config
 		errors += Pkg.install('lightdm-gtk-greeter lightdm-gtk-greeter-settings')
 
@@ -2025,6 +4711,7 @@ def lightdm_setup():
 
 # TODO Extent to support pre-chroot as well
 def found_in_log(to_find=''):
+	Log.flush()
 	if os.path.isfile('/setup.log'):
 		ret_val = Cmd.suppress(f'cat /setup.log | grep "{to_find}"') # '| grep -v "^[installed]"'?
 		return (ret_val == 0)
@@ -2034,23 +4721,28 @@ def hide_app(app_name=''):
 	# TODO Add supports for multiple .desktop files (separated by spaces)
 	Cmd.exec(f"echo 'NoDisplay=true' >>{apps_path}/{app_name}.desktop")
 
-# Add new kernel parameters to GRUB's 'GRUB_CMDLINE_LINUX(_DEFAULT)' config line
+# Add new kernel parameters to GRUB's 'GRUB_CMDLINE_LINUX(_DEFAULT)' config line; written by update_grub()
 # TODO Add compat with systemd-boot on more minimal UEFI systems
+# Returns: 0 = Added, 2 = Error
 def add_kernel_par(parameters='', only_default=True):
-	parameters = parameters.strip()
-
-	# TODO Support ' and " quote styles separately
-	# TODO Turn into a function
-	def_ln = IO.get_ln_number('/etc/default/grub', 'GRUB_CMDLINE_LINUX_DEFAULT="') # 6
-	def_pars = str(Cmd.output(f'sed -n {def_ln}p /etc/default/grub')).strip() # GRUB_CMDLINE_LINUX_DEFAULT="quiet"
-	def_pars = def_pars[:-1] + ' ' + parameters + '"' # GRUB_CMDLINE_LINUX_DEFAULT="... {x}"
-	Cmd.log(f'sed \'{def_ln}s/.*/{def_pars}/\' -i /etc/default/grub')
-
-	if not only_default:
-		all_ln = IO.get_ln_number('/etc/default/grub', 'GRUB_CMDLINE_LINUX="') # 7
-		all_pars = str(Cmd.output(f'sed -n {def_ln}p /etc/default/grub')).strip() # GRUB_CMDLINE_LINUX=""
-		all_pars = all_pars[:-1] + ' ' + parameters + '"' # GRUB_CMDLINE_LINUX="... {x}"
-		Cmd.log(f'sed \'{all_ln}s/.*/{all_pars}/\' -i /etc/default/grub')
+	return GrubConfig.load().add_params(parameters, only_default)
+
+# Download the config archive of a project repository unless it has already been fetched
+# Returns: 0 = Success, curl exit code on error
+def fetch_configs_archive(repo):
+	archive = f'/configs-{repo}.zip' # e.g. '/configs-base.zip'
+	if os.path.isfile(archive) or dry_run is not None: return 0
+	ret_val = Cmd.log(f'curl https://github.com/arch-installer/{repo}/archive/master.zip -Lso {archive}.part')
+	if ret_val == 0: os.replace(f'{archive}.part', archive)
+	else: Cmd.log(f'rm -f {archive}.part')
+	return ret_val
+
+# Download all config archives needed later on ahead of time
+def prefetch_configs():
+	repos = [ 'base', 'laptop' if bat_present else 'desktop' ]
+	if de != '': repos += [ 'common', de ]
+	for repo in repos:
+		fetch_configs_archive(repo)
 
 def get_configs(repo):
 	if not fetch_configs:
@@ -2059,10 +4751,10 @@ def get_configs(repo):
 
 	# TODO Put working stuff in /tmp?
 	# Fetch config archive
-	errors = Cmd.log(f'curl https://github.com/arch-installer/{repo}/archive/master.zip -Lso /configs-master.zip')
+	errors = fetch_configs_archive(repo)
 	if errors == 0:
 		# Get files ready
-		Cmd.log('unzip /configs-master.zip -d /')
+		Cmd.log(f'unzip /configs-{repo}.zip -d /')
 		Cmd.log('find /*-master/ -path "*/.keep" -delete')
 		Cmd.suppress('shopt -s dotglob && cp -rpT /*-master/ /')
 
@@ -2074,9 +4766,18 @@ def get_configs(repo):
 			Cmd.log(cmd + '; rm -rf ./USER/; cd')
 
 		# Clean up
-		Cmd.log('rm -rf /*-master*') # {...,README.md}
+		Cmd.log(f'rm -rf /*-master* /configs-{repo}.zip') # {...,README.md}
 	return errors
 
+def base_configs_setup():
+	write_msg("Setting up base system configs...", 1)
+	Pkg.install('unzip')
+	errors = get_configs('base')
+	errors = get_configs('laptop' if bat_present else 'desktop')
+	if not use_networkmanager or nm_rand_mac_addr: errors += Cmd.log('rm /etc/NetworkManager/conf.d/00-no-rand-wifi-scan-mac-addr.conf')
+	if not use_ccache: errors += Cmd.log('rm /etc/ccache.conf')
+	write_status(errors)
+
 def de_setup():
 	if fetch_configs:
 		# DE configs (common DE)
@@ -2112,9 +4813,6 @@ def de_setup():
 	if enable_multilib:
 		Pkg.install('lib32-gtk3')
 
-	# TODO Force installation to not trigger (Updating linux initcpios) to run it seperately at the end
-	# => Remove pacman hook for mkinitcpio
-
 	if de == 'gnome':
 		# TODO: Use new group install stuff etc.
 
@@ -2363,8 +5061,7 @@ def de_setup():
 		# TODO Language manager package?
 		# TODO lxmusic => 'LXMusic'
 
-		ret_val = Cmd.suppress('find /sys/class/backlight/*')
-		if ret_val == 0:
+		if hw.backlight_present:
 			errors += Pkg.install('xorg-xbacklight')
 
 		if bt_present:
@@ -2644,11 +5341,13 @@ def de_setup():
 				errors += Pkg.install('pacman-contrib')
 				errors += Pkg.aur_install('pamac-aur')
 				Cmd.log('cp /etc/pamac.conf /etc/pamac.conf.bak')
-				IO.uncomment_ln('/etc/pamac.conf', 'EnableDowngrade')
-				errors += IO.uncomment_ln('/etc/pamac.conf', 'EnableAUR')
-				errors += IO.uncomment_ln('/etc/pamac.conf', 'CheckAURUpdates')
-				IO.replace_ln('/etc/pamac.conf', 'KeepNumPackages', 'KeepNumPackages = 2')
-				IO.uncomment_ln('/etc/pamac.conf', 'OnlyRmUninstalled')
+				conf = ConfigFile('/etc/pamac.conf')
+				conf.uncomment_ln('EnableDowngrade')
+				errors += conf.uncomment_ln('EnableAUR')
+				errors += conf.uncomment_ln('CheckAURUpdates')
+				conf.replace_ln('KeepNumPackages', 'KeepNumPackages = 2')
+				conf.uncomment_ln('OnlyRmUninstalled')
+				errors += conf.commit()
 				categories = 'Categories=GNOME;GTK;System;X-XFCE-SettingsDialog;X-XFCE-SystemSettings;'
 				IO.replace_ln(f'{apps_path}/pamac-manager.desktop', 'Categories=', categories)
 				IO.replace_ln(f'{apps_path}/pamac-updater.desktop', 'Categories=', categories)
@@ -2714,13 +5413,15 @@ def bootloader_extra_setup():
 	ret_val = Pkg.install('ntfs-3g os-prober')
 	write_status(ret_val)
 
-	write_msg('Finding other bootloaders to add to GRUB menu...', 1)
-	ret_val = update_grub()
-	write_status(ret_val)
-
 	#Cmd.log('umount /run/lvm')
 
 def passwd_setup():
+	if profile is not None:
+		write_msg('Setting user passwords from the install profile...', 1)
+		ret_val = Profile.set_passwords()
+		write_status(ret_val)
+		return
+
 	write_ln()
 	write_msg('Create a password for the §2root §0user:\n\n')
 	for _ in range(3):
@@ -2758,8 +5459,113 @@ def passwd_setup():
 					write_msg('Please try that again:\n\n')
 	write_ln() # TODO Indent by 1?
 
+# Run the setup phases of chroot_setup() on a thread pool, each one as soon as its dependencies are done
+# phases: list of (name, function, dependencies, locks) e.g. ('aur', aur_setup, ['users'], ['/etc/sudoers'])
+# Dependencies on phases missing from the list are ignored & phases sharing a lock never run at the same time.
+# The output of each phase is printed at once after it's done to keep the status messages readable.
+def run_phases(phases):
+	if not parallel_setup or parallel_jobs < 2:
+		for name, func, deps, locks in phases:
+			func()
+		return
+
+	names = [ phase[0] for phase in phases ]
+	pending = { name: [ dep for dep in deps if dep in names ] for name, func, deps, locks in phases }
+	done, running, failure = (set(), {}, None)
+	with concurrent.futures.ThreadPoolExecutor(parallel_jobs) as pool:
+		while True:
+			if failure is None: # Start every phase that is ready
+				for name, func, deps, locks in phases:
+					if name in pending and all(dep in done for dep in pending[name]):
+						del pending[name]
+						running[pool.submit(run_phase, name, func, locks)] = name
+			if len(running) == 0: break
+			finished = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+			for future in finished:
+				done.add(running.pop(future))
+				if failure is None: failure = future.exception() # e.g. SystemExit from exit(12)
+
+	if failure is not None: raise failure # Only after the phases still running have finished
+	if len(pending) > 0:
+		log(f"[setup.py:run_phases()] ERROR: Phases with unmet dependencies weren't run: {', '.join(pending)}")
+
+# Run a single phase for run_phases() holding it's locks & buffering it's output
+def run_phase(name, func, locks):
+	held = [ named_lock(lock) for lock in sorted(locks) ] # Always acquire in the same order
+	thread_output.buffer = []
+	started = time.time()
+	try:
+		for lock in held: lock.acquire()
+		try:
+			func()
+		finally:
+			for lock in reversed(held): lock.release()
+	finally:
+		flush_output()
+		thread_output.buffer = None
+		log(f"\n[setup.py:run_phase('{name}')] INFO: Done in {time.time() - started:.1f}s")
+
+# Enable periodic jobs & trimming of SSDs not mounted with 'discard'
+def services_setup():
+	if de != '':
+		Pkg.install('cronie')
+		Cmd.log('systemctl enable cronie')
+	ret_val = Cmd.suppress('mount | grep discard')
+	if ret_val != 0: Cmd.log('systemctl enable fstrim.timer')
+	#IO.write('/etc/sysctl.d/10-vm.conf', 'vm.swappiness=1\nvm.vfs_cache_pressure=50\nzswap.enabled=1')
+
+# Returns: setup phases of chroot_setup() enabled in config.py as (name, function, dependencies, locks of shared resources); see run_phases()
+def setup_phases():
+	# NOTE: Listed in the order they're run in when parallel_setup is disabled
+	installs = [ 'networking', 'users', 'aur', 'ssh', 'kernel', 'bootloader', 'x', 'vm', 'vga', 'audio', 'bt', 'printing' ]
+	phases = [
+		('timezone',      timezone_setup,     [], []),
+		('locale',        locale_setup,       [], [ '/etc/locale.gen' ]),
+		('repos',         repos_setup,        [], [ '/etc/pacman.conf' ]), # Every package install depends on it
+		('networking',    networking_setup,   [ 'repos' ], []),
+		('users',         user_setup,         [], [ '/etc/sudoers', '/etc/passwd' ]),
+		('aur',           aur_setup,          [ 'users', 'repos' ], [ '/etc/sudoers', '/etc/passwd', '/etc/makepkg.conf' ]),
+		('ssh',           ssh_setup,          [ 'repos' ], []),
+		('kernel',        kernel_setup,       [ 'repos' ], []),
+		('bootloader',    bootloader_setup,   [ 'kernel' ], []),
+		('x',             x_setup,            [ 'repos' ], []),
+		('vm',            vm_setup,           [ 'users', 'x', 'kernel' ], [ '/etc/passwd' ]),
+		('vga',           vga_setup,          [ 'kernel', 'x', 'users', 'aur' ], [ '/etc/passwd' ]),
+		('audio',         audio_setup,        [ 'users', 'repos' ], [ '/etc/passwd' ]),
+		('bt',            bt_setup,           [ 'audio', 'repos' ], []),
+		('printing',      printing_setup,     [ 'users', 'repos' ], [ '/etc/passwd' ]),
+		('configs_fetch', prefetch_configs,   [], []),
+		('configs',       base_configs_setup, installs + [ 'configs_fetch' ], []), # Overwrites files of installed packages
+		('de',            de_setup,           installs + [ 'configs' ], [])
+	]
+	enabled = {
+		'users': len(users) > 0,
+		'aur': enable_aur,
+		'x': xorg_install_type > 0,
+		'vm': vm_env != '',
+		'vga': auto_detect_gpu, # else: xf86-video-fbdev xf86-video-vesa
+		'audio': use_pulseaudio,
+		'bt': bt_present,
+		'printing': enable_printing,
+		'configs_fetch': fetch_configs,
+		'configs': fetch_configs,
+		'de': de != ''
+	}
+	return [ phase for phase in phases if enabled.get(phase[0], True) ]
+
+def battery_setup():
+	write_msg('Configuring some packages for battery power savings...', 1)
+	errors = Pkg.install('ethtool smartmontools x86_energy_perf_policy tlp tlp-rdw')
+	errors += Cmd.log('systemctl enable tlp NetworkManager-dispatcher')
+	errors += Cmd.log('systemctl mask systemd-rfkill.service systemd-rfkill.socket')
+	# TODO Detect ThinkPad
+	# TODO Btrfs: 'SATA_LINKPWR_ON_BAT=max_performance' for these systems
+	# TODO Bumblebee: 'RUNTIME_PM_BLACKLIST="XX:XX.x"' & use GPU addr from 'lspci'
+	# TODO Setup tharmald as well?
+	write_status(errors)
+
 def chroot_setup():
-	global hostname
+	global hostname, record_stats
 
 	#if multibooting:
 		# LVM 10 sec slow scan temp fix when installing os-prober
@@ -2784,65 +5590,41 @@ def chroot_setup():
 
 	write_status(0) # Change 'Chrooting...' status msg to DONE
 
-	if de != '':
-		Pkg.install('cronie')
-		Cmd.log('systemctl enable cronie')
-	ret_val = Cmd.suppress('mount | grep discard')
-	if ret_val != 0: Cmd.log('systemctl enable fstrim.timer')
-	#IO.write('/etc/sysctl.d/10-vm.conf', 'vm.swappiness=1\nvm.vfs_cache_pressure=50\nzswap.enabled=1')
-	timezone_setup()
-	locale_setup()
-	networking_setup()
+	if offline:
+		write_msg('Loading cached package databases for the offline install...', 1)
+		ret_val = Pkg.offline_dbs()
+		write_status(ret_val)
 
-	if len(users) > 0: user_setup()
-	if enable_aur: aur_setup()
-	if enable_multilib: multilib_setup()
-	if enable_testing: testing_setup()
+	# Only set up what AUR builds need & build the packages of the install; see prebuild_aur()
+	if prebuild:
+		run_phases([ phase for phase in setup_phases() if phase[0] in ('repos', 'aur') ])
+		prebuild_aur()
+		log("\n#\n# End of chroot log\n#")
+		record_stats = False
+		Stats.close()
+		Cmd.log('mv /setup-stats.jsonl /var/log/')
+		return
 
-	# Enable pacman easter egg & colored output by default
-	IO.uncomment_ln('/etc/pacman.conf', 'Color')
-	Cmd.log('sed "38s/.*/ILoveCandy\\n/" -i /etc/pacman.conf')
+	# Run expensive pacman hooks once at the end instead of after every transaction
+	if defer_pacman_hooks: PacmanHooks.defer()
 
-	# TODO /usr on seperate partition => (... usr shutdown) hooks in mkinitcpio.
+	# Collapse package installs into as few pacman transactions as possible
+	if plan_pkg_installs: Pkg.begin_plan()
+
+	services_setup()
+	run_phases(setup_phases())
+	if bootloader_failed: bootloader_fail_prompt()
 
-	ssh_setup()
-	kernel_setup()
-	bootloader_setup()
+	# TODO /usr on seperate partition => (... usr shutdown) hooks in mkinitcpio.
 	#if web_server_type > 0: ...
-	if xorg_install_type > 0: x_setup()
-	if vm_env != '': vm_setup()
-	if auto_detect_gpu: vga_setup() # else: xf86-video-fbdev xf86-video-vesa
-	if use_pulseaudio: audio_setup()
-	if bt_present: bt_setup()
-	if enable_printing: printing_setup()
-
-	# Configs
-	if fetch_configs:
-		write_msg("Setting up base system configs...", 1)
-		Pkg.install('unzip')
-		errors = get_configs('base')
-		errors = get_configs('laptop' if bat_present else 'desktop')
-		if not use_networkmanager or nm_rand_mac_addr: errors += Cmd.log('rm /etc/NetworkManager/conf.d/00-no-rand-wifi-scan-mac-addr.conf')
-		if not use_ccache: errors += Cmd.log('rm /etc/ccache.conf')
-		write_status(errors)
 
-	if de != '': de_setup()
 	# else: remove "~/.hidden" etc files unused?
 
 	# TODO Use proper keymap globally in ALL DEs
 	# TODO Check for other HW too e.g. fingerprint scanner (check lspci etc) & install proper packages
 	# TODO Wine setup?
 
-	if bat_present:
-		write_msg('Configuring some packages for battery power savings...', 1)
-		errors = Pkg.install('ethtool smartmontools x86_energy_perf_policy tlp tlp-rdw')
-		errors += Cmd.log('systemctl enable tlp NetworkManager-dispatcher')
-		errors += Cmd.log('systemctl mask systemd-rfkill.service systemd-rfkill.socket')
-		# TODO Detect ThinkPad
-		# TODO Btrfs: 'SATA_LINKPWR_ON_BAT=max_performance' for these systems
-		# TODO Bumblebee: 'RUNTIME_PM_BLACKLIST="XX:XX.x"' & use GPU addr from 'lspci'
-		# TODO Setup tharmald as well?
-		write_status(errors)
+	if bat_present: battery_setup()
 
 	# TODO On KDE make theming direcoties automatically e.g. '~/.local/share/plasma/look-and-feel/' etc
 
@@ -2851,6 +5633,19 @@ def chroot_setup():
 	if run_custom_setup:
 		custom_setup()
 
+	if Pkg.planning():
+		write_msg('Installing remaining planned packages, please wait...', 1)
+		ret_val = Pkg.end_plan()
+		write_status(ret_val)
+
+	# Every AUR package has been built by now
+	if enable_aur and use_ccache: Ccache.report()
+
+	if PacmanHooks.deferring():
+		write_msg('Running deferred pacman hooks (e.g. initramfs generation), please wait...', 1)
+		ret_val = PacmanHooks.run()
+		write_status(ret_val)
+
 	# Make AUR package build optimizations (after all caching)
 	if optimize_compilation and not (not pkgcache_enabled or optimize_cached_pkgs):
 		IO.replace_ln('/etc/makepkg.conf', 'CFLAGS="', f'CFLAGS="{cflags}"') # 40
@@ -2864,14 +5659,15 @@ def chroot_setup():
 	#IO.write('/etc/udev/rules.d/60-ioschedulers.rules', '# Scheduler for non-rotating disks\nACTION=="add|change", KERNEL=="sd[a-z]|mmcblk[0-9]*|nvme[0-9]*", ATTR{queue/rotational}=="0", ATTR{queue/scheduler}="mq-deadline"\n# Scheduler for rotating disks\nACTION=="add|change", KERNEL=="sd[a-z]", ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="bfq"')
 
 	# Lower default service timeout values (from 90s)
-	IO.replace_ln("/etc/systemd/system.conf", "#DefaultTimeoutStartSec=", "DefaultTimeoutStartSec=15s")
-	IO.replace_ln("/etc/systemd/system.conf", "#DefaultTimeoutStopSec=", "DefaultTimeoutStopSec=15s")
+	conf = ConfigFile('/etc/systemd/system.conf')
+	conf.replace_ln('#DefaultTimeoutStartSec=', 'DefaultTimeoutStartSec=15s')
+	conf.replace_ln('#DefaultTimeoutStopSec=', 'DefaultTimeoutStopSec=15s')
+	conf.commit()
 
 	if multibooting: bootloader_extra_setup()
-	else:
-		write_msg('Updating new kernel parameter for GRUB...', 1)
-		ret_val = update_grub()
-		write_status(ret_val)
+	write_msg('Finding other bootloaders & generating the GRUB config...' if multibooting else 'Generating the GRUB config...', 1)
+	ret_val = update_grub()
+	write_status(ret_val)
 
 	write_msg('Performing cleanup tasks...', 1)
 	errors = 0
@@ -2893,8 +5689,8 @@ def chroot_setup():
 		if len(unres_users) > 0:
 			user = unres_users[0] # e.g. 'deathmist'
 
-			# Move ccache over to 1st unrestricted user
-			if use_ccache:
+			# Move ccache over to 1st unrestricted user unless it's kept on the package cache
+			if use_ccache and not pkgcache_enabled:
 				dest = f'/home/{user}/.ccache/'
 				Cmd.log(f'mkdir -p {dest} && mv /home/aurhelper/.ccache/* {dest}')
 
@@ -2902,7 +5698,9 @@ def chroot_setup():
 			dest = f'/home/{user}/.cache/yay/'
 			Cmd.log(f'mkdir -p {dest} && mv /home/aurhelper/.cache/yay/* {dest}')
 
+		Shell.stop_all('aurhelper')
 		Cmd.log('userdel -f -r aurhelper')
+		if pkgcache_enabled: AurCache.unregister()
 	elif not sudo_ask_pass:
 		# Give wheel group users sudo permission w/o pass
 		Cmd.log("chmod 770 /etc/sudoers")
@@ -2917,6 +5715,9 @@ def chroot_setup():
 	# Clear orphan pkgs
 	Cmd.log('pacman -Rns $(pacman -Qdtq) --noconfirm')
 
+	# Use the regular mirrors again on the new system
+	if offline: Pkg.online_dbs()
+
 	# TEMP: Delete currently unused /README.md file for DEs without proper configs
 	if os.path.isfile('/README.md'):
 		Cmd.log('rm -f /README.md')
@@ -2925,10 +5726,15 @@ def chroot_setup():
 
 	passwd_setup()
 
+	Stats.print_slowest(slowest_cmds_shown)
+	DryRun.record()
+
 	log("\n#\n# End of chroot log\n#")
 
-	# Move log to /var/log/
-	Cmd.log('mv /setup.log /var/log/')
+	# Move command stats to /var/log/; the log is copied there after leaving the chroot
+	record_stats = False
+	Stats.close()
+	Cmd.log('mv /setup-stats.jsonl /var/log/')
 
 
 
@@ -2939,12 +5745,21 @@ def chroot_setup():
 # Run env sanity checks
 check_env()
 
+# Write the remaining log records when exiting
+atexit.register(Log.close)
+atexit.register(Stats.close)
+
 # Check privileges
 check_privs()
 
 args = ' '.join(sys.argv[1:]) # e.g. '-v --test'
 if len(args) > 0:
 	log(f"[setup.py] Script start arguments: '{args}'")
+profile_path = next((arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--profile=')), install_profile) # e.g. '/root/profile.json'
+args = ' '.join(arg for arg in sys.argv[1:] if not arg.startswith('--profile=')) # Flags only as e.g. '-d' could be part of the path
+prebuild = '--prebuild-aur' in args
+offline = '-N' in args
+plan_only = '--plan' in args
 
 # Continue install if in chroot
 if in_chroot == 1:
@@ -2954,18 +5769,41 @@ if in_chroot == 1:
 log(f"[setup.py] Device boot mode: '{boot_mode}'")
 
 # TODO Add -R arg flag for chroot repair operations menu etc
-# TODO Add -N arg flag to run without internet and use only cached packages (show /pkgcache as mandatory, skip mirrorlist sorting, somehow update package databases / store database on cachedrive & replace system one?)
-# https://wiki.archlinux.org/index.php/Pacman/Restore_local_database
 
 debug = '-d' in args.lower()
-if debug: Cmd.suppress('rm /tmp/setup.log') # Remove possible old log
+if debug: Log.clear() # Remove possible old log
 
 # Load color scheme
 load_colors()
 
+# Only show what the install would consist of without touching any disks
+if plan_only:
+	print_header('Install plan')
+	write_msg('Loading ' + ('cached ' if offline else '') + f'package databases into {plan_dir}...', 1)
+	ret_val = DryRun.isolate() # The live system's pacman config & databases stay untouched
+	write_status(ret_val)
+	if not offline:
+		write_msg('Refreshing pacman package databases, please wait...', 1)
+		ret_val = Pkg.refresh_dbs()
+		write_status(ret_val)
+	repos_setup() # Packages of the optional repositories must be found as well
+	ret_val = DryRun.report()
+	shutil.rmtree(plan_dir, True)
+	exit(ret_val)
+
+# Only compare the package compression formats on the cached AUR packages
+if '--bench-compression' in args:
+	print_header('Package compression benchmark')
+	ret_val = PkgCompression.bench(f'/mnt{aur_cache}')
+	exit(ret_val)
+
+# Validate the unattended install profile before anything is changed
+if len(profile_path) > 0:
+	profile = Profile.load(profile_path)
+
 write_msg('Arch §7Linux ')
-write(f'§4{boot_mode} §0live environment was detected. Press ENTER to continue...')
-if not debug:
+write(f'§4{boot_mode} §0live environment was detected. ' + ('Installing unattended...' if profile is not None else 'Press ENTER to continue...'))
+if not debug and profile is None:
 	input()
 else:
 	write_ln()
@@ -2976,19 +5814,22 @@ write_msg('Loaded customized color scheme', 2)
 # Load keymap
 load_kbmap()
 
-# Check internet
-check_connectivity()
+# Check internet & refresh package databases (offline installs use the ones cached on /pkgcache once it's mounted)
+if not offline:
+	check_connectivity()
 
-# Refresh package databases
-write_msg('Refreshing pacman package databases, please wait...', 1)
-ret_val = Pkg.refresh_dbs()
-write_status(ret_val)
+	write_msg('Refreshing pacman package databases, please wait...', 1)
+	ret_val = Pkg.refresh_dbs()
+	write_status(ret_val)
+
+	# Start downloading packages while partitioning & mounting
+	Prefetch.start()
 
 # Load font
 load_font()
 
 # TODO global outdated_pkgs?
-outdated_pkgs = Cmd.output('pacman -Qqu')
+outdated_pkgs = PkgDb.get().outdated() if not offline else []
 
 # Update used out-of-date installer packages
 # TODO Don't do partial updates?
@@ -3004,23 +5845,32 @@ if 'archlinux-keyring' in outdated_pkgs:
 
 # TODO Make detect up-to-date pkgs
 # TODO Don't run linux initcpios
-write_msg('Updating live environment partitioning utilities...', 1)
-ret_val = Pkg.install('parted btrfs-progs xfsprogs f2fs-tools', False) # e2fsprogs efitools
-write_status(ret_val)
+if not offline:
+	write_msg('Updating live environment partitioning utilities...', 1)
+	ret_val = Pkg.install('parted btrfs-progs xfsprogs f2fs-tools', False) # e2fsprogs efitools
+	write_status(ret_val)
 
 # NTP time synchronization
 ntp_setup()
 
-write_msg('Entering disk partitioning menu...', 1)
-time.sleep(0.25)
-partitioning_menu()
+if profile is None:
+	write_msg('Entering disk partitioning menu...', 1)
+	time.sleep(0.25)
+	partitioning_menu()
+else:
+	print_header('Disk Partitioning')
+	Profile.partition()
 
 log('\n[setup.py] Block device map after partitioning:')
 Cmd.log(lsblk_cmd)
 #log('\n')
 Cmd.log(blkid_cmd)
 
-mounting_menu()
+if profile is None:
+	mounting_menu()
+else:
+	print_header('Mounting Partitions')
+	Profile.mount()
 
 sys_root = '/' # TODO Change for Btrfs volumes
 sys_root = f'/mnt{sys_root}'
@@ -3031,8 +5881,9 @@ if 'arch-install-scripts' in outdated_pkgs:
 	Pkg.install('arch-install-scripts', False)
 write_status()
 
-if '-M' not in args: sort_mirrors()
+if '-M' not in args and not offline: sort_mirrors()
 
+install_started = time.time()
 base_install(sys_root)
 
 start_chroot(sys_root)
@@ -3040,7 +5891,7 @@ start_chroot(sys_root)
 # Install done! Cleanup & reboot etc.
 
 # Clean up setup files
-Cmd.suppress(f'rm -f {sys_root}root/{{setup,config}}.py')
+Cmd.suppress(f'rm -f {sys_root}root/{{setup,config}}.py {sys_root}root/{state_fn}')
 #Cmd.suppress(f'rm -f {sys_root}root/config.py')
 
 if pkgcache_enabled:
@@ -3057,8 +5908,9 @@ if pkgcache_enabled:
 	Cmd.suppress('cd && umount /mnt/pkgcache && rm -rf /mnt/pkgcache')
 	Cmd.suppress('mv /etc/pacman.conf.bak /etc/pacman.conf')
 
-# Move log on new system to '/var/log/setup.log'
-Cmd.suppress(f'cp -f {sys_root}var/log/setup.log /tmp/')
+# Keep the log on the new system as '/var/log/setup.log'
+Log.flush()
+Cmd.suppress(f'cp -f /tmp/setup.log /tmp/setup.log.jsonl {sys_root}var/log/')
 #Cmd.suppress(f'cd && umount -R {sys_root[:-1]}') # TODO Fix /mnt being "busy"
 
 # END OF SCRIPT
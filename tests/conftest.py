@@ -0,0 +1,46 @@
+# Shared fixtures: setup.py is a script, so it's definitions (everything before the 'Actual script' section)
+# are loaded into a fresh namespace for each test without running the installer
+import os, sys, threading, http.server
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_path = os.path.join(root, 'setup.py')
+
+def load_setup():
+	with open(script_path) as f:
+		src = f.read()
+	src = src[:src.index('###############################\n# Actual script')]
+	if root not in sys.path: sys.path.insert(0, root) # config.py
+	ns = { '__name__': 'setup', '__file__': script_path }
+	exec(compile(src, script_path, 'exec'), ns)
+	return ns
+
+@pytest.fixture
+def setup():
+	ns = load_setup()
+	ns['log_flush_interval'] = float('inf') # Keep log records in memory
+	ns['record_stats'] = False
+	return ns
+
+# Local stand-in for a web server (e.g. the AUR RPC or a mirror); 'respond' gets each request handler & returns (status, body bytes)
+# Returns: base URL of the server e.g. 'http://127.0.0.1:41234'
+@pytest.fixture
+def http_server():
+	servers = []
+	def serve(respond):
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				status, body = respond(self)
+				self.send_response(status)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, *args): pass
+		server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		servers.append(server)
+		return f'http://127.0.0.1:{server.server_address[1]}'
+	yield serve
+	for server in servers:
+		server.shutdown()
+		server.server_close()
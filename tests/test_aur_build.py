@@ -0,0 +1,59 @@
+# AUR dependency resolution & build order; see AurBuild
+
+import os, subprocess
+import pytest
+
+class FakeDb:
+	def __init__(self, repo=(), installed=()):
+		self.repo, self.local = set(repo), set(installed)
+	def installed(self, name): return '1-1' if name in self.local else None
+	def info(self, name): return {} if name in self.repo else None
+	def providers(self, name): return []
+
+def fake_aur(setup, monkeypatch, pkgs, db):
+	infos = { name: dict({ 'Name': name, 'Version': '1-1', 'PackageBase': name }, **info) for name, info in pkgs.items() }
+	monkeypatch.setattr(setup['Pkg'], 'aur_info', staticmethod(lambda names: { name: infos[name] for name in names if name in infos }))
+	monkeypatch.setattr(setup['PkgDb'], 'get', staticmethod(lambda: db))
+
+def test_check_depends_are_skipped_like_check(setup, monkeypatch):
+	fake_aur(setup, monkeypatch, {
+		'app': { 'Depends': [ 'lib' ], 'MakeDepends': [ 'python-build' ], 'CheckDepends': [ 'testlib>=2', 'python-pytest' ] },
+		'lib': {}, 'testlib': {}
+	}, FakeDb(repo=[ 'python-build', 'python-pytest' ]))
+	graph = setup['AurBuild'].resolve('app')
+	assert graph['aur_deps'] == { 'lib' }
+	assert graph['repo_deps'] == [ 'python-build' ]
+	assert graph['bases']['app']['deps'] == { 'lib' }
+	assert graph['levels'] == [ [ 'lib' ], [ 'app' ] ]
+
+def test_requested_dependencies_are_installed_explicitly(setup, monkeypatch):
+	fake_aur(setup, monkeypatch, { 'app': { 'Depends': [ 'lib', 'other' ] }, 'lib': {}, 'other': {} }, FakeDb())
+	setup['pkgcache_enabled'] = False
+	monkeypatch.setattr(setup['AurBuild'], 'build', staticmethod(lambda base, names, jobs=1: { name: f'/build/{name}-1-1-x86_64.pkg.tar.zst' for name in names }))
+	installs = []
+	monkeypatch.setattr(setup['Pkg'], 'install', staticmethod(lambda pkgs, only_needed=True, now=False: installs.append(pkgs) or 0))
+	assert setup['AurBuild'].install('app lib') == 0
+	assert installs == [
+		'--asdeps /build/other-1-1-x86_64.pkg.tar.zst', # Only a dependency
+		'/build/lib-1-1-x86_64.pkg.tar.zst',            # Requested as well => not '--asdeps'
+		'/build/app-1-1-x86_64.pkg.tar.zst'
+	]
+
+def test_sources_are_verified(setup, monkeypatch):
+	cmds = []
+	monkeypatch.setattr(setup['Cmd'], 'log', staticmethod(lambda cmd, exec_user='', log_cmd=True: cmds.append(cmd) or 1))
+	assert setup['AurBuild'].build('app', [ 'app' ]) is None
+	assert '--skippgpcheck' not in cmds[0]
+	assert 'gpg --batch -q --recv-keys' in cmds[0]
+
+@pytest.mark.parametrize('gpg_exit', [ 0, 2 ]) # 2 = e.g. the keyserver can't be reached
+def test_key_import_failures_are_left_to_makepkg(setup, monkeypatch, tmp_path, gpg_exit):
+	cmds = []
+	monkeypatch.setattr(setup['Cmd'], 'log', staticmethod(lambda cmd, exec_user='', log_cmd=True: cmds.append(cmd) or 1))
+	setup['AurBuild'].build('app', [ 'app' ])
+	import_keys = cmds[0][cmds[0].index('{ keys='):cmds[0].index('; }') + 3]
+	(tmp_path / 'gpg').write_text(f'#!/bin/sh\nexit {gpg_exit}\n')
+	(tmp_path / 'gpg').chmod(0o755)
+	(tmp_path / '.SRCINFO').write_text('pkgbase = app\n\tvalidpgpkeys = 0123456789ABCDEF\n')
+	res = subprocess.run([ 'bash', '-c', f'{import_keys} && echo makepkg' ], cwd=tmp_path, env=dict(os.environ, PATH=f"{tmp_path}:{os.environ['PATH']}"), capture_output=True, text=True)
+	assert res.stdout == 'makepkg\n'
@@ -0,0 +1,44 @@
+# AUR RPC lookups & the cache of built AUR packages; see Pkg.aur_info() & AurCache
+
+import json, urllib.parse
+
+def aur_rpc(http_server, versions):
+	queries = []
+	def respond(handler):
+		query = urllib.parse.parse_qs(urllib.parse.urlparse(handler.path).query)
+		queries.append(query['arg[]'])
+		results = [ { 'Name': name, 'Version': versions[name] } for name in query['arg[]'] if name in versions ]
+		return (200, json.dumps({ 'version': 5, 'type': 'multiinfo', 'results': results }).encode())
+	return (http_server(respond) + '/rpc/', queries)
+
+def test_lookups_are_batched(setup, http_server):
+	setup['aur_rpc_url'], queries = aur_rpc(http_server, { 'a': '1-1', 'b': '2-1', 'c': '3-1', 'e': '5-1' })
+	setup['aur_rpc_batch'] = 2
+	infos = setup['Pkg'].aur_info([ 'a', 'b', 'c', 'd', 'e' ])
+	assert queries == [ [ 'a', 'b' ], [ 'c', 'd' ], [ 'e' ] ]
+	assert sorted(infos) == [ 'a', 'b', 'c', 'e' ] # 'd' isn't in the AUR
+	assert infos['c']['Version'] == '3-1'
+
+def test_failed_lookup(setup, http_server):
+	setup['aur_rpc_url'] = http_server(lambda handler: (500, b'')) + '/rpc/'
+	assert setup['Pkg'].aur_info([ 'a' ]) is None
+	assert setup['Pkg'].aur_versions([ 'a' ]) == {}
+
+def test_cache_hits_are_up_to_date_versions(setup, http_server, tmp_path):
+	setup['aur_rpc_url'], queries = aur_rpc(http_server, { 'polybar': '3.4.0-1', 'yay-bin': '9.0-1', 'spotify': '1.1-1' })
+	cache = tmp_path / 'aur'
+	cache.mkdir()
+	for f_name in ('polybar-3.3.0-1-x86_64.pkg.tar.xz', 'polybar-3.4.0-1-x86_64.pkg.tar.xz', 'yay-bin-8.0-1-x86_64.pkg.tar.zst', 'polybar-3.4.0-1-x86_64.pkg.tar.xz.sig'):
+		(cache / f_name).write_bytes(b'')
+	setup['aur_cache'] = str(cache)
+	versions = setup['Pkg'].aur_versions([ 'polybar', 'yay-bin', 'spotify' ])
+	assert len(queries) == 1
+	AurCache = setup['AurCache']
+	assert AurCache.lookup('polybar', versions['polybar']) == 'polybar-3.4.0-1-x86_64.pkg.tar.xz' # Hit
+	assert AurCache.lookup('yay-bin', versions['yay-bin']) is None # Outdated
+	assert AurCache.lookup('spotify', versions['spotify']) is None # Never built
+
+	setup['aur_index'] = None # Next run => the saved index is used
+	assert json.loads((tmp_path / 'aur.index.json').read_text())['pkgs']['yay-bin'] == { '8.0-1': 'yay-bin-8.0-1-x86_64.pkg.tar.zst' }
+	(cache / 'yay-bin-9.0-1-x86_64.pkg.tar.zst').write_bytes(b'') # Built since => rescanned
+	assert AurCache.lookup('yay-bin', versions['yay-bin']) == 'yay-bin-9.0-1-x86_64.pkg.tar.zst'
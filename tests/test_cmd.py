@@ -0,0 +1,68 @@
+# Running commands without a shell where possible; see Cmd.argv() & Cmd.run()
+
+import pytest
+
+@pytest.mark.parametrize('cmd, argv', [
+	('systemctl enable sddm', [ 'systemctl', 'enable', 'sddm' ]),
+	('  pacman  -Qq  ', [ 'pacman', '-Qq' ]),
+	# Quoted arguments
+	("sed -i 's/^#Color/Color/' /etc/pacman.conf", [ 'sed', '-i', 's/^#Color/Color/', '/etc/pacman.conf' ]),
+	('git commit -m "a | b; c > d"', [ 'git', 'commit', '-m', 'a | b; c > d' ]),
+	("echo-like 'it''s' \"x\"'y'", [ 'echo-like', 'its', 'xy' ]),
+	("grep '$HOME' .bashrc", [ 'grep', '$HOME', '.bashrc' ]), # Single quotes keep '$' literal
+	("printf-like '*.conf'", [ 'printf-like', '*.conf' ]),
+	('mkdir "/tmp/a b"', [ 'mkdir', '/tmp/a b' ]),
+	('ls a=b', [ 'ls', 'a=b' ]), # Only an assignment before the program needs a shell
+	# Pipes, lists & redirections
+	('pacman -Qq | grep eog', None),
+	('cd /tmp && make', None),
+	('true || false', None),
+	('sleep 1 &', None),
+	('echo a; echo b', None),
+	('lsblk > /tmp/lsblk', None),
+	('cat < /etc/hostname', None),
+	('(ls)', None),
+	('ls\npwd', None),
+	# Globs & expansions
+	('rm -f /tmp/*.part', None),
+	('ls /dev/sd?', None),
+	('ls /dev/sd[ab]', None),
+	('touch {a,b}', None),
+	('ls ~', None),
+	# Variables & substitutions
+	('echo $HOME', None),
+	('ls "$HOME"', None),
+	('ls ${HOME}', None),
+	('ls "`pwd`"', None),
+	('ls $(pwd)', None),
+	('ls "a\\"b"', None),
+	('ls "!!"', None),
+	# Builtins & assignments
+	('cd /tmp', None),
+	('export LANG=C', None),
+	('source /etc/profile', None),
+	('[ -f /etc/hostname ]', None),
+	('if true; then ls; fi', None),
+	('LANG=C ls', None),
+	('VAR=x cmd arg', None),
+	# Comments & unbalanced quotes
+	('ls # comment', None),
+	('ls#x', None),
+	("echo 'unterminated", None),
+	('echo "unterminated', None),
+	('', None),
+])
+def test_argv(setup, cmd, argv):
+	assert setup['Cmd'].argv(cmd) == argv
+
+@pytest.mark.parametrize('args, shell, ret_val', [
+	([ 'no-such-program-x', '-l' ], False, 127),
+	('no-such-program-x -l', False, 127), # A whole command line as the program
+	('/', False, 126),
+])
+def test_run_failures_are_logged_like_the_shell(setup, tmp_path, args, shell, ret_val):
+	log_path = tmp_path / 'cmd.log'
+	res = setup['Cmd'].run(args, 2, str(log_path), shell)
+	assert res.returncode == ret_val
+	prog = args[0] if isinstance(args, list) else args.split()[0]
+	assert log_path.read_text().startswith(f'{prog}: ')
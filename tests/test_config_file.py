@@ -0,0 +1,138 @@
+# Line edits of config files; see ConfigFile & GrubConfig
+
+import os
+import pytest
+
+@pytest.fixture
+def conf_file(setup, tmp_path):
+	def load(text):
+		f_path = tmp_path / 'test.conf'
+		f_path.write_text(text)
+		return f_path, setup['ConfigFile'](str(f_path))
+	return load
+
+pacman_conf = '#[options]\n#CacheDir = /var/cache/pacman/pkg/\nColor\n#ParallelDownloads = 5\n[core]\nInclude = /etc/pacman.d/mirrorlist\n[extra]\nInclude = /etc/pacman.d/mirrorlist\n'
+
+@pytest.mark.parametrize('search_ln, start, expected', [
+	('Include', 0, 5),
+	('Include', 6, 7),
+	('Include', 8, -1),
+	('#Paral', 0, 3),
+	('#P', 0, 3),        # Shorter than config_prefix_len => linear scan
+	('C', 0, 2),
+	('[', 5, 6),
+	('#CacheDir =', 0, 1),
+	('#CacheDir=', 0, -1),
+	('Colour', 0, -1),
+	('', 4, 4),
+])
+def test_find(conf_file, search_ln, start, expected):
+	assert conf_file(pacman_conf)[1].find(search_ln, start) == expected
+
+def test_set_ln_keeps_the_index_up_to_date(setup, conf_file):
+	conf = conf_file(pacman_conf)[1]
+	assert conf.find('Include') == 5 # Builds the index
+	assert conf.replace_ln('#ParallelDownloads', 'ParallelDownloads = 5') == 0
+	assert conf.uncomment_ln('CacheDir') == 0
+	assert conf.find('#Paral') == -1 and conf.find('Parallel') == 3
+	assert conf.find('#Cache') == -1 and conf.find('CacheDir = /var') == 1
+	assert conf.index['Par'] == [ 3 ] and conf.index['#Pa'] == []
+	conf.set_ln(0, '[options]')
+	assert conf.find('[') == 0 and conf.index['[op'] == [ 0 ]
+
+@pytest.mark.parametrize('edit, lines', [
+	(lambda conf: conf.insert_ln('[core]', 'SigLevel = Required'), [ '#[options]', '#CacheDir = /var/cache/pacman/pkg/', 'Color', '#ParallelDownloads = 5', '[core]', 'SigLevel = Required', 'Include = /etc/pacman.d/mirrorlist', '[extra]', 'Include = /etc/pacman.d/mirrorlist' ]),
+	(lambda conf: conf.insert_ln('[core]', '[testing]', False), [ '#[options]', '#CacheDir = /var/cache/pacman/pkg/', 'Color', '#ParallelDownloads = 5', '[testing]', '[core]', 'Include = /etc/pacman.d/mirrorlist', '[extra]', 'Include = /etc/pacman.d/mirrorlist' ]),
+	(lambda conf: conf.remove_ln('[core]', 2), [ '#[options]', '#CacheDir = /var/cache/pacman/pkg/', 'Color', '#ParallelDownloads = 5', '[extra]', 'Include = /etc/pacman.d/mirrorlist' ]),
+	(lambda conf: conf.remove_ln('#C'), [ '#[options]', 'Color', '#ParallelDownloads = 5', '[core]', 'Include = /etc/pacman.d/mirrorlist', '[extra]', 'Include = /etc/pacman.d/mirrorlist' ]),
+])
+def test_line_count_changes_reset_the_index(conf_file, edit, lines):
+	conf = conf_file(pacman_conf)[1]
+	assert conf.find('[core]') == 4 # Builds the index
+	assert edit(conf) == 0
+	assert conf.index is None
+	assert conf.lines == lines
+	for i, line in enumerate(lines): # Found at their new indexes
+		assert conf.find(line) == lines.index(line)
+	assert conf.find('Include', conf.find('[extra]')) == len(lines) - 1
+
+def test_missing_lines_and_files(setup, conf_file, tmp_path):
+	conf = conf_file(pacman_conf)[1]
+	assert [ conf.replace_ln('Missing', ''), conf.uncomment_ln('Missing'), conf.insert_ln('Missing', ''), conf.remove_ln('Missing'), conf.get_ln_number('Missing') ] == [ 1, 1, 1, 1, -1 ]
+	assert conf.changed is False
+	missing = setup['ConfigFile'](str(tmp_path / 'missing.conf'))
+	assert [ missing.replace_ln('A', ''), missing.append_ln(''), missing.get_ln_number('A'), missing.commit() ] == [ 2, 2, -2, 2 ]
+
+@pytest.mark.parametrize('only_first_match, expected', [
+	(True, '[core]\nServer = https://mirror.local/$repo/os/$arch\n[extra]\nInclude = /etc/pacman.d/mirrorlist\n'),
+	(False, '[core]\nServer = https://mirror.local/$repo/os/$arch\n[extra]\nServer = https://mirror.local/$repo/os/$arch\n'),
+])
+def test_replace_all_matches(conf_file, only_first_match, expected):
+	f_path, conf = conf_file('[core]\nInclude = /etc/pacman.d/mirrorlist\n[extra]\nInclude = /etc/pacman.d/mirrorlist\n')
+	assert conf.replace_ln('Include', 'Server = https://mirror.local/$repo/os/$arch', only_first_match) == 0
+	assert conf.commit() == 0
+	assert f_path.read_text() == expected
+
+def test_commit_keeps_mode_owner_and_symlinks(setup, tmp_path):
+	f_path = tmp_path / 'real.conf'
+	f_path.write_text('#Color\n')
+	os.chmod(f_path, 0o640)
+	if os.geteuid() == 0: os.chown(f_path, 1234, 5678)
+	stat = os.stat(f_path)
+	link = tmp_path / 'link.conf'
+	link.symlink_to(f_path)
+	conf = setup['ConfigFile'](str(link))
+	assert conf.uncomment_ln('Color') == 0
+	assert conf.commit() == 0
+	assert link.is_symlink() and f_path.read_text() == 'Color\n'
+	assert (os.stat(f_path).st_mode, os.stat(f_path).st_uid, os.stat(f_path).st_gid) == (stat.st_mode, stat.st_uid, stat.st_gid)
+	assert sorted(os.listdir(tmp_path)) == [ 'link.conf', 'real.conf' ] # No temporary copy left behind
+
+def test_commit_writes_only_changes(setup, conf_file):
+	f_path, conf = conf_file('Color  \n\n\n')
+	assert conf.commit() == 0
+	assert f_path.read_text() == 'Color  \n\n\n' # Untouched
+	setup['dry_run'] = []
+	assert conf.append_ln('ILoveCandy') == 0
+	assert conf.commit() == 0
+	assert f_path.read_text() == 'Color  \n\n\n' # Not written while dry running
+	setup['dry_run'] = None
+	assert conf.commit() == 0
+	assert f_path.read_text() == 'Color\n\n\nILoveCandy\n'
+
+@pytest.fixture
+def grub(setup, tmp_path):
+	f_path = tmp_path / 'grub'
+	f_path.write_text('GRUB_DEFAULT=0\nGRUB_TIMEOUT=5\nGRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet"\n#GRUB_SAVEDEFAULT=true\n')
+	setup['grub_conf'] = str(f_path)
+	return f_path
+
+def test_grub_edits_keep_changes_made_since_loading(setup, grub):
+	conf = setup['GrubConfig'].load()
+	conf.set('GRUB_TIMEOUT', '0')
+	conf.add_params('loglevel=4 apparmor=1')
+	with open(grub, 'a') as f: # e.g. a GRUB theme installer
+		f.write('GRUB_THEME="/boot/grub/themes/Tela/theme.txt"\n')
+	grub.write_text(grub.read_text().replace('GRUB_DEFAULT=0', 'GRUB_DEFAULT=saved'))
+	assert conf.commit() == 0
+	assert grub.read_text() == 'GRUB_DEFAULT=saved\nGRUB_TIMEOUT=0\nGRUB_CMDLINE_LINUX_DEFAULT="loglevel=4 quiet apparmor=1"\n#GRUB_SAVEDEFAULT=true\nGRUB_THEME="/boot/grub/themes/Tela/theme.txt"\n'
+	assert conf.get('GRUB_THEME') == '/boot/grub/themes/Tela/theme.txt' # The model follows the written file
+	assert conf.commit() == 0 # Nothing left to replay
+
+cmdline = 'GRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet"'
+
+@pytest.mark.parametrize('edit, old_ln, new_ln', [
+	(lambda conf: conf.add_params('loglevel=4'), cmdline, 'GRUB_CMDLINE_LINUX_DEFAULT="loglevel=4 quiet"'),
+	(lambda conf: conf.add_params('quiet loglevel=3'), cmdline, cmdline),
+	(lambda conf: conf.add_params('apparmor=1 security=apparmor loglevel=4'), cmdline, 'GRUB_CMDLINE_LINUX_DEFAULT="loglevel=4 quiet apparmor=1 security=apparmor"'),
+	(lambda conf: conf.add_params('splash') or conf.add_params('splash'), cmdline, 'GRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet splash"'),
+	(lambda conf: conf.set('GRUB_SAVEDEFAULT', 'false'), '#GRUB_SAVEDEFAULT=true', 'GRUB_SAVEDEFAULT=false'), # Commented key => set in place
+	(lambda conf: conf.set('GRUB_TIMEOUT', '0'), 'GRUB_TIMEOUT=5', 'GRUB_TIMEOUT=0'),
+	(lambda conf: conf.set('GRUB_THEME', '/boot/grub/themes/Tela/theme.txt', True), None, 'GRUB_THEME="/boot/grub/themes/Tela/theme.txt"'), # Missing key => appended
+])
+def test_grub_edits(setup, grub, edit, old_ln, new_ln):
+	text = grub.read_text()
+	conf = setup['GrubConfig'].load()
+	assert edit(conf) == 0
+	assert conf.commit() == 0
+	assert grub.read_text() == (text.replace(f'{old_ln}\n', f'{new_ln}\n') if old_ln is not None else f'{text}{new_ln}\n')
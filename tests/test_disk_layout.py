@@ -0,0 +1,98 @@
+# Disk layouts e.g. '/dev/sda 512M:/efi 8G:swap *:/'; see DiskLayout
+
+import pytest
+
+@pytest.fixture
+def layout(setup):
+	def use(boot_mode):
+		setup['boot_mode'] = boot_mode
+		return setup['DiskLayout']
+	return use
+
+@pytest.mark.parametrize('boot_mode, spec, disk_mib, expected', [
+	('UEFI', '/dev/sda 512M:/efi 8G:swap 30%:/ *:/home:xfs', 100 * 1024,
+		'sgdisk -Z -a 2048 -n 1:0:+512M -t 1:ef00 -n 2:0:+8192M -t 2:8200 -n 3:0:+28108M -t 3:8300 -n 4:0:0 -t 4:8302 /dev/sda'),
+	('UEFI', '/dev/nvme0n1 1G:/efi *:/', 100 * 1024,
+		'sgdisk -Z -a 2048 -n 1:0:+1024M -t 1:ef00 -n 2:0:0 -t 2:8300 /dev/nvme0n1'),
+	('BIOS/CSM', '/dev/sda 512M:/boot 8G:swap 30%:/ *:/home:xfs', 100 * 1024,
+		"printf '%s\\n' 'label: dos' 'size=512MiB, type=L, bootable' 'size=8192MiB, type=S' 'size=28108MiB, type=L' type=L | sfdisk -q --wipe always /dev/sda"),
+	('BIOS/CSM', '/dev/sda 2G:swap 50%:/', 10 * 1024, # No '*' => the rest stays unpartitioned
+		"printf '%s\\n' 'label: dos' 'size=2048MiB, type=S' 'size=4095MiB, type=L, bootable' | sfdisk -q --wipe always /dev/sda"),
+])
+def test_script(layout, boot_mode, spec, disk_mib, expected):
+	disk_layout = layout(boot_mode)
+	disk, pars = disk_layout.parse(spec)
+	assert disk_layout.script(disk, pars, disk_layout.sizes(disk, pars, disk_mib)) == expected
+
+@pytest.mark.parametrize('boot_mode, spec, disk_mib, expected', [
+	('UEFI', '/dev/sda 512M:/efi *:/', 1024, [ 512, None ]),
+	('UEFI', '/dev/sda 100K:/efi *:/', 1024, [ 1, None ]), # At least 1 MiB
+	('UEFI', '/dev/sda 1T:/efi *:/', 2 * 1024 ** 2, [ 1024 ** 2, None ]),
+	('UEFI', '/dev/sda 24M:/efi 25%:/ 75%:/home', 1024 + 2, [ 24, 250, 750 ]), # Percentages of what's left after the fixed sizes
+	('UEFI', '/dev/sda 24M:/efi 12.5%:/ *:/home', 1024 + 2, [ 24, 125, None ]),
+	('BIOS/CSM', '/dev/sda 50%:/ 50%:/home', 1001, [ 500, 500 ]),
+])
+def test_sizes(layout, boot_mode, spec, disk_mib, expected):
+	disk_layout = layout(boot_mode)
+	disk, pars = disk_layout.parse(spec)
+	assert disk_layout.sizes(disk, pars, disk_mib) == expected
+
+@pytest.mark.parametrize('spec, disk_mib, error', [
+	('/dev/sda 512M:/efi *:/', 513, 'the layout of /dev/sda needs 513 MiB but only 511 MiB are usable'),
+	('/dev/sda 512M:/efi 512M:/', 1024, 'the layout of /dev/sda needs 1024 MiB but only 1022 MiB are usable'),
+	('/dev/sda 1G:/efi 101%:/', 2048, 'the layout of /dev/sda needs 2056 MiB but only 2046 MiB are usable'),
+])
+def test_sizes_that_dont_fit(layout, spec, disk_mib, error):
+	disk_layout = layout('UEFI')
+	disk, pars = disk_layout.parse(spec)
+	with pytest.raises(ValueError) as e:
+		disk_layout.sizes(disk, pars, disk_mib)
+	assert str(e.value) == error
+
+@pytest.mark.parametrize('boot_mode, spec, error', [
+	('UEFI', '/dev/sda *:/ 512M:/efi', "'*:/' of /dev/sda should start with a size e.g. '512M', '30%' or '*' (last only)"),
+	('UEFI', '/dev/sda 512M:/efi *:/ *:/home', "'*:/' of /dev/sda should start with a size e.g. '512M', '30%' or '*' (last only)"),
+	('UEFI', '/dev/sda 512:/efi *:/', "'512:/efi' of /dev/sda should start with a size e.g. '512M', '30%' or '*' (last only)"),
+	('UEFI', '/dev/sda 512M:efi *:/', "'512M:efi' of /dev/sda should have a mount point e.g. '512M:/efi' or '8G:swap'"),
+	('UEFI', '/dev/sda', "'/dev/sda' should be a disk followed by partitions e.g. '/dev/sda 512M:/efi *:/'"),
+	('BIOS/CSM', '/dev/sda 1G:/boot 8G:swap 20G:/ 20G:/var *:/home', '/dev/sda can have at most 4 partitions on an MBR partition table'),
+])
+def test_parse_errors(layout, boot_mode, spec, error):
+	with pytest.raises(ValueError) as e:
+		layout(boot_mode).parse(spec)
+	assert str(e.value) == error
+
+def test_parse(layout):
+	assert layout('UEFI').parse('/dev/sda 512M:/efi 8G:swap *:/home:XFS') == ('/dev/sda', [
+		{ 'device': '/dev/sda1', 'size': '512M', 'mount': '/efi', 'format': 'fat32' },
+		{ 'device': '/dev/sda2', 'size': '8G', 'mount': 'swap', 'format': 'swap' },
+		{ 'device': '/dev/sda3', 'size': '*', 'mount': '/home', 'format': 'xfs' },
+	])
+	assert len(layout('UEFI').parse('/dev/sda 1G:/efi 8G:swap 20G:/ 20G:/var *:/home')[1]) == 5 # GPT isn't limited to 4
+
+@pytest.mark.parametrize('disk, num, par', [
+	('/dev/sda', 1, '/dev/sda1'),
+	('/dev/sda', 10, '/dev/sda10'),
+	('/dev/vdb', 2, '/dev/vdb2'),
+	('/dev/nvme0n1', 1, '/dev/nvme0n1p1'),
+	('/dev/nvme10n1', 12, '/dev/nvme10n1p12'),
+	('/dev/mmcblk0', 2, '/dev/mmcblk0p2'),
+])
+def test_par_dev_and_disk(setup, disk, num, par):
+	assert setup['DiskLayout'].par_dev(disk, num) == par
+	assert setup['DiskLayout'].par_disk(par) == disk # e.g. the MBR GRUB device of a root partition
+
+@pytest.mark.parametrize('boot_mode, specs, mbr_grub_dev', [
+	('BIOS/CSM', [ '/dev/nvme0n1 8G:swap *:/' ], '/dev/nvme0n1'),
+	('BIOS/CSM', [ '/dev/sdb *:/home', '/dev/sda 1G:/boot *:/' ], '/dev/sda'),
+	('UEFI', [ '/dev/nvme0n1 512M:/efi *:/' ], ''),
+])
+def test_profile_layouts_set_the_mbr_grub_device(setup, monkeypatch, boot_mode, specs, mbr_grub_dev):
+	setup['boot_mode'], setup['mbr_grub_dev'] = boot_mode, ''
+	setup['profile'] = { 'layout': specs }
+	monkeypatch.setattr(setup['DiskLayout'], 'apply', staticmethod(lambda spec: 0))
+	monkeypatch.setattr(setup['Cmd'], 'suppress', staticmethod(lambda cmd: 0))
+	for name in [ 'write_msg', 'write_status' ]:
+		monkeypatch.setitem(setup, name, lambda *args: None)
+	setup['Profile'].partition()
+	assert setup['mbr_grub_dev'] == mbr_grub_dev
@@ -0,0 +1,41 @@
+# Install plan dry runs ('--plan'); see DryRun
+
+def fake_steps(setup, monkeypatch, *steps):
+	monkeypatch.setitem(setup, 'load_hw_info', lambda: None)
+	monkeypatch.setitem(setup, 'base_extra_pkgs', lambda: '')
+	monkeypatch.setitem(setup, 'services_setup', lambda: None)
+	monkeypatch.setitem(setup, 'setup_phases', lambda: [ (name, func, [], []) for name, func in steps ])
+	setup['base_pkgs'] = 'base'
+	setup['bat_present'] = False
+	setup['run_custom_setup'] = False
+
+def test_aborting_step_is_reported(setup, monkeypatch):
+	Pkg = setup['Pkg']
+	def abort(): exit(12)
+	fake_steps(setup, monkeypatch, ('kernel', lambda: Pkg.install('linux')), ('bootloader', abort), ('x', lambda: Pkg.install('xorg')))
+	collected = setup['DryRun'].run()
+	assert collected['aborted'] == ('bootloader', 12)
+	assert collected['failed'] == []
+	assert collected['repo'] == [ 'base', 'linux' ] # Steps after the abort aren't evaluated
+
+def test_failing_step_is_only_a_warning(setup, monkeypatch):
+	def broken(): raise ValueError('no output')
+	fake_steps(setup, monkeypatch, ('vga', broken))
+	collected = setup['DryRun'].run()
+	assert collected['aborted'] is None
+	assert collected['failed'] == [ 'vga' ]
+
+def test_plan_refreshes_its_own_databases(setup, monkeypatch):
+	cmds = []
+	monkeypatch.setattr(setup['Cmd'], 'log', staticmethod(lambda cmd, exec_user='', log_cmd=True: cmds.append(cmd) or 0))
+	setup['pacman_conf'], setup['pacman_db_path'], setup['pkgcache_enabled'] = ('/tmp/setup-plan/pacman.conf', '/tmp/setup-plan/db', False)
+	assert setup['Pkg'].refresh_dbs() == 0
+	assert cmds == [ 'pacman -Sy --config /tmp/setup-plan/pacman.conf --dbpath /tmp/setup-plan/db' ]
+
+def test_prebuild_builds_the_aur_packages_of_the_install(setup, monkeypatch):
+	Pkg, built = (setup['Pkg'], [])
+	fake_steps(setup, monkeypatch, ('x', lambda: Pkg.install('xorg')), ('de', lambda: Pkg.aur_install('polybar') + Pkg.aur_install('yay-bin polybar')))
+	monkeypatch.setattr(setup['AurBuild'], 'install', staticmethod(lambda pkgs, only_needed=True, install_targets=True: built.append((pkgs, install_targets)) or 0))
+	setup['pkgcache_enabled'], setup['enable_aur'] = (True, True)
+	setup['prebuild_aur']()
+	assert built == [ ('polybar yay-bin', False) ] # Only built, nothing installed
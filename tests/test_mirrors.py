@@ -0,0 +1,30 @@
+# Mirror ranking; see Mirrors
+
+import time
+
+def mirror(http_server, delay, paths, status=200):
+	def respond(handler):
+		paths.append(handler.path)
+		time.sleep(delay)
+		return (status, b'x' * 256 * 1024)
+	return http_server(respond) + '/archlinux/'
+
+def test_faster_mirrors_rank_first(setup, http_server):
+	setup['mirror_probe_path'] = 'core/os/x86_64/core.db'
+	setup['mirror_probe_timeout'] = 0.5
+	setup['mirror_count'] = 5
+	paths = []
+	slow = mirror(http_server, 0.2, paths)
+	fast = mirror(http_server, 0, paths)
+	broken = mirror(http_server, 0, paths, 404)
+	stalled = mirror(http_server, 1, paths) # Exceeds the timeout
+	ranked = setup['Mirrors'].rank([ slow, broken, stalled, fast ])
+	assert [ res['url'] for res in ranked ] == [ fast, slow ]
+	assert ranked[0]['rate'] > ranked[1]['rate']
+	assert ranked[1]['ttfb'] >= 0.2
+	assert set(paths) == { '/archlinux/core/os/x86_64/core.db' }
+
+def test_ranking_is_limited_to_mirror_count(setup, http_server):
+	setup['mirror_count'] = 1
+	fast, slow = (mirror(http_server, 0, []), mirror(http_server, 0.2, []))
+	assert [ res['url'] for res in setup['Mirrors'].rank([ slow, fast ]) ] == [ fast ]
@@ -0,0 +1,38 @@
+# Deferral of pacman hooks; see PacmanHooks
+
+import pytest
+
+@pytest.fixture
+def hooks(setup, tmp_path):
+	setup['hook_dir'] = str(tmp_path / 'hooks')
+	setup['hook_override_dir'] = str(tmp_path / 'overrides')
+	setup['hook_state_dir'] = str(tmp_path / 'state')
+	(tmp_path / 'hooks').mkdir()
+	return tmp_path
+
+def write_hook(hooks, name, needs_targets):
+	(hooks / 'hooks' / f'{name}.hook').write_text('\n'.join([ '[Trigger]', 'Type = Path', 'Operation = Install', 'Target = usr/share/x/*', '',
+		'[Action]', 'When = PostTransaction', 'Exec = /usr/bin/true' ] + ([ 'NeedsTargets' ] if needs_targets else [])) + '\n')
+
+def override(hooks, name):
+	return (hooks / 'overrides' / f'{name}.hook').read_text()
+
+def test_only_hooks_needing_targets_read_them(setup, hooks):
+	write_hook(hooks, 'fontconfig', False)
+	write_hook(hooks, 'gtk-update-icon-cache', True)
+	setup['PacmanHooks'].defer()
+	assert f"Exec = /usr/bin/touch {hooks}/state/fontconfig" in override(hooks, 'fontconfig')
+	assert f"Exec = /usr/bin/sh -c 'cat >>{hooks}/state/gtk-update-icon-cache'" in override(hooks, 'gtk-update-icon-cache')
+
+def test_hooks_are_deferred_before_being_installed(setup, hooks):
+	PacmanHooks = setup['PacmanHooks']
+	PacmanHooks.defer() # e.g. before the transaction installing mkinitcpio
+	known = override(hooks, '90-mkinitcpio-install')
+	assert 'Target = usr/lib/modules/*/vmlinuz' in known
+	assert 'NeedsTargets' in known
+	assert setup['hooks_deferred']['90-mkinitcpio-install'] is False
+
+	write_hook(hooks, '90-mkinitcpio-install', True)
+	PacmanHooks.sync() # The real hook's triggers replace the known ones
+	assert 'Target = usr/share/x/*' in override(hooks, '90-mkinitcpio-install')
+	assert setup['hooks_deferred']['90-mkinitcpio-install'] is True
@@ -0,0 +1,63 @@
+# Package database indexes & version comparison; see PkgDb
+
+import threading
+import pytest
+
+def test_index_reloads_while_other_threads_read(setup, tmp_path):
+	PkgDb = setup['PkgDb']
+	setup['pkgdb_dir'] = str(tmp_path / 'idx')
+	source = tmp_path / 'core.db'
+	source.write_text('0')
+	reader = lambda sources: { 'pkgs': { f'pkg{i}': [ open(sources[0]).read() ] for i in range(500) } }
+	index = PkgDb.Index('sync', [ str(source) ], reader)
+	errors, done = ([], threading.Event())
+	def read():
+		try:
+			while not done.is_set():
+				assert index.find('pkgs', 'pkg250') is not None
+				assert len(index.keys('pkgs')) == 500
+		except Exception as e: # e.g. "ValueError: mmap closed or invalid"
+			errors.append(e)
+	readers = [ threading.Thread(target=read) for _ in range(4) ]
+	for thread in readers: thread.start()
+	for i in range(1, 50): # e.g. a database refresh while Prefetch reads the index
+		source.write_text(str(i))
+		index.refresh([ str(source) ])
+	done.set()
+	for thread in readers: thread.join()
+	assert errors == []
+	assert index.find('pkgs', 'pkg0') == [ '49' ]
+
+# (a, b, expected) as pacman's vercmp reports them; unlike RPM, pacman has no special case for '~', it's a separator like '.'
+vercmp_cases = [
+	# Plain & mixed length versions
+	('1.5.0', '1.5.0', 0), ('1.5.1', '1.5.0', 1), ('1.5.1', '1.5', 1), ('1.10', '1.9', 1), ('1.01', '1.1', 0),
+	# pkgrel, only compared when both have one
+	('1.5.0-1', '1.5.0-1', 0), ('1.5.0-1', '1.5.0-2', -1), ('1.5.0-2', '1.5.1-1', -1), ('1.5-2', '1.5.1-1', -1),
+	('1.5', '1.5-1', 0), ('1.1-1', '1.1', 0), ('1.0-1', '1.1', -1), ('1.5-1.1', '1.5-1', 1), ('1.5-10', '1.5-9', 1),
+	# Epochs
+	('0:1.0', '0:1.0', 0), ('0:1.0', '0:1.1', -1), ('1:1.0', '0:1.1', 1), ('1:1.0', '2:1.1', -1),
+	('1:1.0', '0:1.0-1', 1), ('1:1.0-1', '0:1.1-1', 1), ('0:1.0', '1.0', 0), ('1:1.0', '1.1', 1), (':1.0', '1.0', 0),
+	# Alpha & numeric segments
+	('1.5b-1', '1.5-1', -1), ('1.5b', '1.5.1', -1), ('1.0a', '1.0alpha', -1), ('1.0alpha', '1.0b', -1),
+	('1.0beta', '1.0rc', -1), ('1.0rc', '1.0', -1), ('1.5.a', '1.5', 1), ('1.5.1', '1.5.b', 1), ('1.5-1', '1.5.b', -1),
+	('1.0a1', '1.0a', 1), ('1a', '1.1', -1), ('r1234.abcdef', 'r999.ffffff', 1),
+	# Separators
+	('2.0', '2_0', 0), ('2.0_a', '2_0.a', 0), ('2.0a', '2.0.a', -1), ('2___a', '2_a', 1),
+	# Tildes
+	('1.0~rc1', '1.0', 1), ('1.0~rc1', '1.0~rc2', -1), ('1.0~rc1', '1.0.rc1', 0), ('1.0~rc1', '1.0rc1', 1), ('1.0~1', '1.0', 1),
+]
+
+@pytest.mark.parametrize('a, b, expected', vercmp_cases)
+def test_vercmp(setup, a, b, expected):
+	vercmp = setup['PkgDb'].vercmp
+	assert vercmp(a, b) == expected
+	assert vercmp(b, a) == -expected
+
+@pytest.mark.parametrize('a, b, expected', [
+	('1', '1', 0), ('2', '10', -1), ('a', 'b', -1), ('1', 'a', 1), ('1.0', '1', 1), ('1.a', '1', 1), ('1a', '1', -1), ('0001', '1', 0), ('', '0', -1),
+])
+def test_rpmvercmp(setup, a, b, expected):
+	rpmvercmp = setup['PkgDb'].rpmvercmp
+	assert rpmvercmp(a, b) == expected
+	assert rpmvercmp(b, a) == -expected
@@ -0,0 +1,87 @@
+# Install planning; see Pkg.begin_plan()
+
+def fake_pacman(setup, monkeypatch, failing=()):
+	cmds = []
+	def log(cmd, exec_user='', log_cmd=True):
+		cmds.append(cmd)
+		return 1 if any(pkg in cmd.split() for pkg in failing) else 0
+	monkeypatch.setattr(setup['Cmd'], 'log', staticmethod(log))
+	return cmds
+
+def test_planned_installs_are_committed_in_one_transaction(setup, monkeypatch):
+	cmds = fake_pacman(setup, monkeypatch)
+	Pkg = setup['Pkg']
+	Pkg.begin_plan()
+	assert Pkg.install('vim htop') == 0
+	assert Pkg.install('htop tree') == 0
+	assert cmds == []
+	assert Pkg.end_plan() == 0
+	assert cmds == [ 'pacman -S --noconfirm --noprogressbar --needed vim htop tree' ]
+
+def test_failed_planned_install_is_reported(setup, monkeypatch, capsys):
+	cmds = fake_pacman(setup, monkeypatch, failing=('bad-pkg',))
+	Pkg = setup['Pkg']
+	Pkg.begin_plan()
+	assert Pkg.install('vim bad-pkg') == 0 # Only planned
+	assert Pkg.install('htop') == 0
+	assert Pkg.end_plan() == 1
+	assert len(cmds) == 3 # The whole transaction & each install separately
+	out = capsys.readouterr().out
+	assert "Planned install of 'vim bad-pkg' failed" in out
+	assert "'htop'" not in out
+	assert any("ERROR: Planned install of 'vim bad-pkg' failed" in text for _, _, text in setup['log_buffer'])
+
+def test_checked_install_runs_right_away(setup, monkeypatch):
+	cmds = fake_pacman(setup, monkeypatch, failing=('linux-zen',))
+	Pkg = setup['Pkg']
+	Pkg.begin_plan()
+	Pkg.install('vim')
+	assert Pkg.install('linux-zen linux-zen-headers', True, True) == 1 # e.g. the kernel fallback sees the failure
+	assert cmds[0].endswith('--needed vim') # Planned packages first
+	assert Pkg.end_plan() == 0
+
+def test_only_commands_depending_on_planned_packages_commit_the_plan(setup, tmp_path):
+	Pkg = setup['Pkg']
+	existing = tmp_path / 'existing.conf'
+	existing.write_text('')
+	assert not Pkg.needs_plan(f"sed 's/a/b/' -i {existing}")
+	assert not Pkg.needs_plan(f'echo x >>{existing}')
+	assert Pkg.needs_plan(f"sed 's/a/b/' -i {tmp_path}/missing.conf")
+	assert Pkg.needs_plan('pacman -Qqs | grep qt4')
+	assert Pkg.needs_plan('not-installed-program-xyz --version')
+	assert Pkg.needs_plan('makepkg -f', 'aurhelper')
+
+def test_other_threads_keep_planning_during_a_commit(setup, monkeypatch):
+	import threading
+	started, release, cmds = (threading.Event(), threading.Event(), [])
+	def log(cmd, exec_user='', log_cmd=True):
+		cmds.append(cmd)
+		if 'vim' in cmd.split():
+			started.set()
+			release.wait(5)
+		return 0
+	monkeypatch.setattr(setup['Cmd'], 'log', staticmethod(log))
+	Pkg = setup['Pkg']
+	Pkg.begin_plan()
+	Pkg.install('vim')
+	committer = threading.Thread(target=Pkg.commit_plan)
+	committer.start()
+	assert started.wait(5)
+	planner = threading.Thread(target=Pkg.install, args=('htop',))
+	planner.start()
+	planner.join(5)
+	assert not planner.is_alive() # Not blocked by the running transaction
+	release.set()
+	committer.join(5)
+	assert Pkg.end_plan() == 0
+	assert cmds[-1].endswith('--needed htop')
+
+def test_only_package_transactions_take_the_pacman_lock(setup):
+	Cmd = setup['Cmd']
+	assert Cmd.uses_pacman('pacman -S --noconfirm vim')
+	assert Cmd.uses_pacman('LANG=C /usr/bin/pacman -Rns foo &>/dev/null')
+	assert Cmd.uses_pacman('cd /tmp/yay && makepkg -si --noconfirm')
+	assert not Cmd.uses_pacman("sed -i 's/^#Color/Color/' /etc/pacman.conf")
+	assert not Cmd.uses_pacman('grep -q multilib /etc/pacman.conf && echo pacman')
+	assert not Cmd.uses_pacman('cd /tmp/yay && makepkg -f')
+	assert not Cmd.uses_pacman('pacman -Sw --dbpath /tmp/db --noconfirm vim')
@@ -0,0 +1,81 @@
+# Unattended install profiles; see Profile.expand() & Profile.validate()
+
+import pytest
+
+pw_hash = '$6$salt$hash'
+
+@pytest.fixture
+def profile(setup):
+	setup['boot_mode'] = 'UEFI'
+	setup['users'] = 'alice'
+	setup['passwdless_users'] = ''
+	setup['offline'] = False
+	def problems(data):
+		return setup['Profile'].expand(data) + setup['Profile'].validate(data)
+	return problems
+
+layout = [ '/dev/sda 512M:/efi *:/' ]
+passwords = { 'root': pw_hash, 'alice': pw_hash }
+
+@pytest.mark.parametrize('data, expected', [
+	({ 'layout': layout, 'passwords': passwords }, []),
+	({ 'partitions': [ { 'device': '/dev/sda1', 'mount': '/efi' }, { 'device': '/dev/sda2', 'mount': '/' } ], 'passwords': passwords }, []),
+	# Missing root
+	({ 'layout': [ '/dev/sda 512M:/efi *:/home' ], 'passwords': passwords }, [ "no partition is mounted to '/'" ]),
+	({ 'passwords': passwords }, [ "'partitions' should be a list of partitions" ]),
+	# Missing passwords
+	({ 'layout': layout, 'passwords': { 'root': pw_hash } }, [ "'passwords' is missing a password hash for 'alice'" ]),
+	({ 'layout': layout }, [ "'passwords' is missing a password hash for 'root'", "'passwords' is missing a password hash for 'alice'" ]),
+	({ 'layout': layout, 'passwords': { 'root': 'hunter2', 'alice': pw_hash } }, [ "the password of 'root' should be a crypt(3) hash e.g. from 'openssl passwd -6'" ]),
+	({ 'layout': layout, 'passwords': dict(passwords, bob=pw_hash) }, [ "'bob' in 'passwords' isn't one of the users: alice" ]),
+	# Bad layouts
+	({ 'layout': '/dev/sda 512M:/efi *:/', 'passwords': passwords }, [ "'layout' should be a list of disk layouts e.g. '/dev/sda 512M:/efi *:/'", "'partitions' should be a list of partitions" ]),
+	({ 'layout': [ 'sda 512M:/efi *:/' ], 'passwords': passwords }, [ "'sda 512M:/efi *:/' should be a disk followed by partitions e.g. '/dev/sda 512M:/efi *:/'", "'partitions' should be a list of partitions" ]),
+	({ 'layout': [ '/dev/sda 512M *:/' ], 'passwords': passwords }, [ "'512M' of /dev/sda should have a mount point e.g. '512M:/efi' or '8G:swap'", "'partitions' should be a list of partitions" ]),
+	({ 'layout': [ '/dev/sda 512M:/efi *:/ 8G:swap' ], 'passwords': passwords }, [ "'*:/' of /dev/sda should start with a size e.g. '512M', '30%' or '*' (last only)", "'partitions' should be a list of partitions" ]),
+	({ 'layout': layout + [ '/dev/sdb *:/' ], 'passwords': passwords }, [ "more than one partition is mounted to '/'" ]),
+	({ 'layout': [ '/dev/sda 512M:/efi 8G:/ *:/home:swap' ], 'passwords': passwords }, [ '/dev/sda3 should be both formatted & used as swap' ]),
+])
+def test_profile_problems(profile, data, expected):
+	assert profile(data) == expected
+
+def test_unsupported_filesystem_type(setup, profile):
+	problems = profile({ 'layout': [ '/dev/sda 512M:/efi *:/:zfs' ], 'passwords': passwords })
+	assert problems == [ f"'zfs' of /dev/sda isn't a supported filesystem type: {', '.join(setup['par_fs_types'])}", "'partitions' should be a list of partitions" ]
+
+def test_layout_partitions_come_before_explicit_ones(setup, profile):
+	data = { 'layout': [ '/dev/nvme0n1 512M:/efi *:/' ], 'partitions': [ { 'device': '/dev/sdb1', 'mount': '/home' } ], 'passwords': passwords }
+	assert profile(data) == []
+	assert [ par['device'] for par in data['partitions'] ] == [ '/dev/nvme0n1p1', '/dev/nvme0n1p2', '/dev/sdb1' ]
+	assert data['partitions'][0]['format'] == 'fat32'
+
+@pytest.mark.parametrize('boot_mode, offline, data, expected', [
+	('BIOS/CSM', False, { 'layout': [ '/dev/sda 512M:/efi *:/' ] }, [ "'/efi' is only used in the UEFI boot mode" ]),
+	('BIOS/CSM', False, { 'layout': [ '/dev/sda *:/' ] }, []),
+	('UEFI', False, { 'layout': [ '/dev/sda *:/' ] }, [ "no partition is mounted to '/efi' for the UEFI boot mode" ]),
+	('UEFI', True, { 'layout': layout }, [ "no partition is mounted to '/pkgcache' for the offline install" ]),
+	('UEFI', True, { 'layout': layout, 'partitions': [ { 'device': '/dev/sdb1', 'mount': '/pkgcache' } ] }, []),
+])
+def test_boot_mode_and_offline_mounts(setup, profile, boot_mode, offline, data, expected):
+	setup['boot_mode'], setup['offline'] = boot_mode, offline
+	data['passwords'] = passwords
+	assert profile(data) == expected
+
+@pytest.mark.parametrize('pkgcache_enabled, mounts, exits', [
+	(True, 'root:/dev/sda2,/efi:/dev/sda1,/pkgcache:/dev/sdb1,', False),
+	(False, 'root:/dev/sda2,/efi:/dev/sda1,/pkgcache:/dev/sdb1,', True), # e.g. no cached package databases on it
+	(True, 'root:/dev/sda2,/efi:/dev/sda1,', True),
+])
+def test_offline_mount_needs_a_package_cache(setup, monkeypatch, pkgcache_enabled, mounts, exits):
+	setup['offline'], setup['pkgcache_enabled'] = True, pkgcache_enabled
+	setup['profile'] = { 'partitions': [ { 'device': '/dev/sda2', 'mount': '/' } ] }
+	monkeypatch.setattr(setup['DiskLayout'], 'format_all', staticmethod(lambda pars: 0))
+	monkeypatch.setitem(setup, 'use_par', lambda *args: 0)
+	monkeypatch.setitem(setup, 'load_mounts', lambda: setup.update(mounts=mounts))
+	monkeypatch.setitem(setup, 'write_ln', lambda *args: None)
+	if exits:
+		with pytest.raises(SystemExit) as e:
+			setup['Profile'].mount()
+		assert e.value.code == 14
+	else:
+		setup['Profile'].mount()
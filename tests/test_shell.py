@@ -0,0 +1,29 @@
+# Persistent worker shells; see Shell
+
+import threading
+
+def run(shell, cmd, io_stream_type=1):
+	res = []
+	thread = threading.Thread(target=lambda: res.append(shell.run(cmd, io_stream_type)), daemon=True)
+	thread.start()
+	thread.join(10)
+	assert not thread.is_alive(), f'{cmd!r} hung the worker shell'
+	return res[0]
+
+def test_syntax_error_is_a_failed_command(setup):
+	shell = setup['Shell']('')
+	try:
+		assert run(shell, "echo 'unterminated")[0] == 2
+		assert run(shell, 'if true; then echo x')[0] == 2
+		assert run(shell, 'echo ok')[:2] == (0, 'ok\n') # The worker is still usable
+	finally:
+		shell.stop()
+
+def test_commands_run_in_a_subshell(setup, tmp_path):
+	shell = setup['Shell']('')
+	try:
+		assert run(shell, f'cd {tmp_path} && X=1 && exit 3')[0] == 3
+		assert run(shell, 'echo "$X" "$PWD"')[1] != f'1 {tmp_path}'
+		assert run(shell, "printf '%s\\n' \"a b\" | wc -l")[1].strip() == '1'
+	finally:
+		shell.stop()
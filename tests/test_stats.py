@@ -0,0 +1,34 @@
+# Command resource usage stats; see Stats
+
+import subprocess
+
+def record(setup, cmd, wall):
+	res = subprocess.CompletedProcess(cmd, 0)
+	setup['Stats'].record(cmd, 'argv', 0.0, wall, res)
+
+def test_stats_file_stays_open(setup, monkeypatch, tmp_path):
+	Stats = setup['Stats']
+	monkeypatch.setattr(Stats, 'path', staticmethod(lambda: str(tmp_path / 'setup-stats.jsonl')))
+	setup['record_stats'] = True
+	record(setup, 'true', 0.1)
+	f = setup['stats_file']
+	record(setup, 'false', 0.2)
+	assert setup['stats_file'] is f
+	Stats.close()
+	assert setup['stats_file'] is None
+	assert len((tmp_path / 'setup-stats.jsonl').read_text().splitlines()) == 2
+
+def test_live_stats_reach_the_chroot_summary(setup, monkeypatch, tmp_path, capsys):
+	Stats, live, sys_root = (setup['Stats'], tmp_path / 'setup-stats.jsonl', tmp_path / 'mnt')
+	sys_root.mkdir()
+	monkeypatch.setattr(Stats, 'path', staticmethod(lambda: str(live)))
+	setup['record_stats'] = True
+	record(setup, 'pacstrap /mnt base', 300.0)
+	assert Stats.share(f'{sys_root}/') == 0
+
+	live = sys_root / 'setup-stats.jsonl' # In chroot
+	record(setup, 'pacman -S gnome', 120.0)
+	Stats.print_slowest(2)
+	out = capsys.readouterr().out
+	assert '2 commands took 420s' in out
+	assert out.index('pacstrap') < out.index('pacman -S gnome')